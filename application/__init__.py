@@ -6,7 +6,8 @@ from werkzeug.utils import import_string
 
 from flask_login import LoginManager
 from flask_migrate import Migrate
-from flask_sqlalchemy import SQLAlchemy
+
+from application.database import Database
 
 # Possible configurations
 # TODO :: Make production the default at some point
@@ -16,8 +17,20 @@ config_dict = {
     "default": "application.config.TestConfig"
 }
 
+# Blueprints, the paths they serve (to load them on first use, see
+# `application.startup`), and their registration options
+BLUEPRINTS = (
+    ("application.home.home_routes.home_bp", ("/", "/about"), {"url_prefix": "/"}),
+    ("application.loggedin.loggedin_routes.loggedin_bp", ("/dashboard",), {}),
+    ("application.signup.signup_routes.signup_bp", ("/signup", "/success"), {}),
+    ("application.login.login_routes.login_bp", ("/login", "/logout"), {}),
+    ("application.admin.admin_routes.admin_bp", ("/admin",), {}),
+    ("application.analytics.analytics_routes.analytics_bp", ("/analytics",), {}),
+    ("application.metrics.metrics_routes.metrics_bp", ("/metrics",), {})
+)
+
 # Set globals
-db = SQLAlchemy()
+db = Database()
 migrate = Migrate()
 login_manager = LoginManager()
 
@@ -36,24 +49,80 @@ def create_app(test_config=True):
     # Initialize plug-ins
     db.init_app(app)
     db.app = app
+    from application import database
+    database.init_app(app)
     migrate.init_app(app, db)
     login_manager.init_app(app)
 
+    # Request metrics, first so they time every other hook
+    from application import telemetry
+    telemetry.init_app(app)
+
+    # Page, fragment and compiled template caches
+    from application import page_cache
+    page_cache.init_app(app)
+
+    # Fingerprinted static assets
+    from application import assets
+    assets.init_app(app)
+
     with app.app_context():
 
-        # Import the the Blueprints
-        # (this has to happen inside the app context)
-        from application.home.home_routes import home_bp
-        from application.loggedin.loggedin_routes import loggedin_bp
-        from application.signup.signup_routes import signup_bp
-        from application.login.login_routes import login_bp
-        from application.admin.admin_routes import admin_bp
-
-        # Register Blueprints
-        app.register_blueprint(home_bp, url_prefix='/')
-        app.register_blueprint(loggedin_bp)
-        app.register_blueprint(signup_bp)
-        app.register_blueprint(login_bp)
-        app.register_blueprint(admin_bp)
+        # Register the Blueprints, now or on first use
+        from application import startup
+        startup.register_blueprints(app, BLUEPRINTS)
+
+        # Time every statement, per endpoint
+        from application import instrumentation
+        instrumentation.init_app(app, database.get_engines(app).values())
+
+        # Bounded pool for password hashing
+        from application import passwords
+        passwords.init_app(app)
+
+        # Throttle logins and signups
+        from application import ratelimit
+        ratelimit.init_app(app)
+
+        # Cache users between requests for Flask-Login
+        from application import user_cache
+        user_cache.init_app(app)
+
+        # Cache fund performance between settlements
+        from application import performance
+        performance.init_app(app)
+
+        # Live dashboard updates
+        from application import events
+        events.init_app(app)
+
+        # Batched vote writes
+        from application import votes
+        votes.init_app(app)
+
+        # Register the model listeners and commands
+        from application import lines, tally  # noqa: F401
+        from application.balances import balances_cli
+        app.cli.add_command(balances_cli)
+
+        from application.advisor import index_advisor_command
+        app.cli.add_command(index_advisor_command)
+
+        from application.ingest import ingest_lines_command
+        app.cli.add_command(ingest_lines_command)
+
+        from application.settlement import settle_command
+        app.cli.add_command(settle_command)
+
+        from application.partitions import partitions_cli
+        app.cli.add_command(partitions_cli)
+
+        from application.strategies import strategies_cli
+        app.cli.add_command(strategies_cli)
+
+        from application.backtest import backtest_command
+        app.cli.add_command(backtest_command)
+
+        app.cli.add_command(assets.assets_cli)
 
         return app
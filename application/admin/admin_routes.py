@@ -1,29 +1,61 @@
-from flask import Blueprint, jsonify
+from flask import (Blueprint, Response, abort, jsonify, request,
+                   stream_with_context, url_for)
 
-from application.models import User
+from application import db
+from application.database import read_only
+from application.export import (DEFAULT_LIMIT, EXPORTS, MAX_LIMIT, fetch_page,
+                                stream_ndjson)
 from flask_login import login_required
 
 admin_bp = Blueprint('admin_bp', __name__, template_folder='templates')
 
+NDJSON = 'application/x-ndjson'
+
 
 @admin_bp.route('/admin', methods=['GET', 'POST'])
+@admin_bp.route('/admin/<table>', methods=['GET'])
 @login_required
-def admin():
+@read_only
+def admin(table='users'):
     """
     Admin end point.
 
     TODO :: This DEFINITELY needs to be updated. We'll
     want to build out an actual admin end point with
     `flask_admin`, most likely. For now, this just
-    returns all of the user data from the database.
+    exports the data from the database.
+
+    Query parameters
+    ----------------
+    after_id :
+        Only return rows after this primary key (keyset pagination).
+    limit : int
+        The page size, up to `MAX_LIMIT`. The next page is linked in the
+        `Link` response header.
+    format : str
+        `ndjson` streams every row after `after_id` instead of a page.
     """
-    users = User.query.all()
-    users_json = [{
-        'id': u.id,
-        'first': u.first_name,
-        'last': u.last_name,
-        'email': u.email_address,
-        'pass': u.password
-    } for u in users]
-
-    return jsonify(users_json)
+    export = EXPORTS.get(table)
+    if export is None:
+        abort(404)
+
+    after_id = request.args.get('after_id')
+    if after_id is not None:
+        try:
+            after_id = export.parse_key(after_id)
+        except ValueError:
+            abort(400)
+
+    # stream the whole table, a chunk at a time
+    if request.args.get('format') == 'ndjson' or request.accept_mimetypes.best == NDJSON:
+        chunks = stream_ndjson(export, db.session.get_bind(), after_id)
+        return Response(stream_with_context(chunks), mimetype=NDJSON)
+
+    limit = min(request.args.get('limit', DEFAULT_LIMIT, type=int), MAX_LIMIT)
+    rows, next_id = fetch_page(export, after_id, max(limit, 1))
+
+    response = jsonify(rows)
+    if next_id is not None:
+        next_url = url_for('admin_bp.admin', table=table, after_id=next_id, limit=limit)
+        response.headers['Link'] = f'<{next_url}>; rel="next"'
+    return response
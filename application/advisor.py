@@ -0,0 +1,191 @@
+"""
+Index advisor for the application's hot queries.
+
+Every query the app relies on being indexed is registered here by name,
+with sample parameters. `flask index-advisor` runs EXPLAIN for each of
+them and flags any plan that falls back to a sequential scan.
+"""
+import json
+import sys
+from datetime import datetime
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import create_engine, text
+
+from application import db
+
+SAMPLE_TIME = datetime(2020, 1, 1)
+
+# name -> (sql, sample parameters)
+NAMED_QUERIES = {
+    'user_by_email': (
+        'SELECT id, password FROM users WHERE email_address = :email_address',
+        {'email_address': 'admin@admin.com'}
+    ),
+    'user_by_id': (
+        'SELECT * FROM users WHERE id = :id',
+        {'id': 1}
+    ),
+    'funds_for_user': (
+        'SELECT fund_id FROM fund_users WHERE user_id = :user_id',
+        {'user_id': 1}
+    ),
+    'votes_for_line_member': (
+        'SELECT id, units FROM line_votes WHERE line_id = :line_id AND fund_user_id = :fund_user_id',
+        {'line_id': 'line', 'fund_user_id': 1}
+    ),
+    'votes_for_day': (
+        'SELECT fund_user_id, line_id, units FROM line_votes WHERE timestamp >= :start AND timestamp < :end',
+        {'start': SAMPLE_TIME, 'end': SAMPLE_TIME}
+    ),
+    'open_lines_for_day': (
+        'SELECT id FROM lines WHERE sport = :sport AND status = :status '
+        'AND starts_at >= :start AND starts_at < :end ORDER BY starts_at',
+        {'sport': 'NBA', 'status': 'open', 'start': SAMPLE_TIME, 'end': SAMPLE_TIME}
+    ),
+    'fund_investments_since': (
+        'SELECT id, amount FROM investments WHERE fund_id = :fund_id AND timestamp >= :since',
+        {'fund_id': 1, 'since': SAMPLE_TIME}
+    ),
+    'result_for_investment': (
+        'SELECT id, amount, is_win FROM results WHERE investment_id = :investment_id',
+        {'investment_id': 1}
+    ),
+    'user_ledger_tail': (
+        'SELECT SUM(amount) FROM user_ledgers WHERE user_id = :user_id AND timestamp > :since',
+        {'user_id': 1, 'since': SAMPLE_TIME}
+    ),
+    'fund_ledger_tail': (
+        'SELECT SUM(amount) FROM fund_ledgers WHERE fund_id = :fund_id AND timestamp > :since',
+        {'fund_id': 1, 'since': SAMPLE_TIME}
+    ),
+    'fund_user_ledger_tail': (
+        'SELECT SUM(amount) FROM fund_user_ledgers WHERE fund_user_id = :fund_user_id AND timestamp > :since',
+        {'fund_user_id': 1, 'since': SAMPLE_TIME}
+    ),
+    'fund_balance_snapshot': (
+        'SELECT balance, timestamp FROM fund_balance_snapshots '
+        'WHERE fund_id = :fund_id AND timestamp <= :as_of ORDER BY timestamp DESC LIMIT 1',
+        {'fund_id': 1, 'as_of': SAMPLE_TIME}
+    ),
+    'fund_user_balance_snapshot': (
+        'SELECT balance, timestamp FROM fund_user_balance_snapshots '
+        'WHERE fund_user_id = :fund_user_id AND timestamp <= :as_of ORDER BY timestamp DESC LIMIT 1',
+        {'fund_user_id': 1, 'as_of': SAMPLE_TIME}
+    ),
+}
+
+
+def register_query(name, sql, params=None):
+    """
+    Register a named query for the index advisor.
+    """
+    NAMED_QUERIES[name] = (sql, params or {})
+
+
+def _explain_sqlite(connection, sql, params):
+    """
+    Get the plan lines and sequential scans for SQLite.
+    """
+    rows = connection.execute(text(f'EXPLAIN QUERY PLAN {sql}'), params).fetchall()
+    plan = [row[-1] for row in rows]
+
+    # `SCAN <table>` (with or without a covering index) visits every row
+    scans = [line for line in plan if line.startswith('SCAN')]
+    return plan, scans
+
+
+def _plan_nodes(node):
+    """
+    Walk a Postgres JSON plan tree.
+    """
+    yield node
+    for child in node.get('Plans', []):
+        yield from _plan_nodes(child)
+
+
+def _explain_postgresql(connection, sql, params):
+    """
+    Get the plan lines and sequential scans for Postgres.
+
+    Sequential scans are disabled for the transaction, so the planner only
+    falls back to one when no usable index exists (rather than because the
+    table happens to be small).
+    """
+    transaction = connection.begin()
+    try:
+        connection.execute(text('SET LOCAL enable_seqscan = off'))
+        result = connection.execute(text(f'EXPLAIN (FORMAT JSON) {sql}'), params).scalar()
+    finally:
+        transaction.rollback()
+
+    if isinstance(result, str):
+        result = json.loads(result)
+
+    nodes = list(_plan_nodes(result[0]['Plan']))
+    plan = [' '.join(filter(None, [n['Node Type'], n.get('Relation Name'), n.get('Index Name')]))
+            for n in nodes]
+    scans = [line for line, n in zip(plan, nodes) if n['Node Type'] == 'Seq Scan']
+    return plan, scans
+
+
+EXPLAINERS = {
+    'sqlite': _explain_sqlite,
+    'postgresql': _explain_postgresql,
+}
+
+
+def advise(engine, names=None):
+    """
+    EXPLAIN every named query and report the sequential scans.
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+        The database to explain against.
+    names : list of str, optional
+        The queries to check. Defaults to all of them.
+
+    Returns
+    -------
+    list of dict
+        One report per query, with `name`, `plan` and `scans` keys.
+    """
+    explain = EXPLAINERS.get(engine.dialect.name)
+    if explain is None:
+        raise ValueError(f'No index advisor for the `{engine.dialect.name}` dialect.')
+
+    reports = []
+    with engine.connect() as connection:
+        for name in names or sorted(NAMED_QUERIES):
+            sql, params = NAMED_QUERIES[name]
+            plan, scans = explain(connection, sql, params)
+            reports.append({'name': name, 'plan': plan, 'scans': scans})
+    return reports
+
+
+@click.command('index-advisor')
+@click.option('--url', default=None,
+              help='Database to check. Defaults to the configured database.')
+@click.option('--query', 'names', multiple=True,
+              help='Only check this named query (repeatable).')
+@with_appcontext
+def index_advisor_command(url, names):
+    """
+    Flag named queries whose plan falls back to a sequential scan.
+    """
+    engine = create_engine(url) if url else db.engine
+    reports = advise(engine, list(names) or None)
+
+    flagged = 0
+    for report in reports:
+        status = 'SEQ SCAN' if report['scans'] else 'ok'
+        click.echo(f"{status:<9} {report['name']}")
+        for line in report['plan']:
+            click.echo(f'          {line}')
+        flagged += bool(report['scans'])
+
+    click.echo(f'{flagged} of {len(reports)} queries fall back to a sequential scan.')
+    if flagged:
+        sys.exit(1)
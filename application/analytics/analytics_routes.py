@@ -0,0 +1,47 @@
+from flask import Blueprint, abort, jsonify
+from flask_login import current_user, login_required
+
+from application import db
+from application.database import read_only
+from application.models import FundUser
+from application.performance import get_performance
+
+analytics_bp = Blueprint('analytics_bp', __name__)
+
+
+def _member_fund_ids():
+    """
+    Get the funds the current user belongs to.
+    """
+    return [fund_id for fund_id, in db.session.query(FundUser.fund_id)
+            .filter(FundUser.user_id == current_user.id)
+            .order_by(FundUser.fund_id)]
+
+
+@analytics_bp.route('/analytics/funds', methods=['GET'])
+@login_required
+@read_only
+def funds():
+    """
+    Performance summaries of the current user's funds.
+    """
+    performance = get_performance()
+    return jsonify([performance[fund_id]['summary'] for fund_id in _member_fund_ids()
+                    if fund_id in performance])
+
+
+@analytics_bp.route('/analytics/funds/<int:fund_id>', methods=['GET'])
+@login_required
+@read_only
+def fund(fund_id):
+    """
+    Performance summary and daily time-series of one of the current
+    user's funds.
+    """
+    if fund_id not in _member_fund_ids():
+        abort(404)
+
+    performance = get_performance().get(fund_id)
+    if performance is None:
+        return jsonify({'summary': None, 'series': None})
+    return jsonify(performance)
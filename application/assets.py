@@ -0,0 +1,245 @@
+"""
+Static assets :: fingerprinted, precompressed, and cached for good.
+
+`flask assets build` copies every file of `application/static` into
+`static/build`, named after a hash of its content (`img/logo.png` becomes
+`build/img/logo.1a2b3c4d5e6f.png`), with gzip and (if the `brotli` package
+is installed) brotli variants of the files that compress well. CSS `url()`s
+to other assets are rewritten to their fingerprinted names. The mapping is
+written to `build/manifest.json`.
+
+With a manifest, `url_for('static', ...)` builds fingerprinted URLs, and
+those are served with `Cache-Control: immutable` for a year: a changed
+file gets a new name, so a cached copy is never stale. The precompressed
+variant the browser accepts is sent as is, never compressed per request.
+Files go out through `wsgi.file_wrapper`, which gunicorn implements with
+`sendfile(2)`; behind nginx, set `USE_X_SENDFILE` to hand them off
+entirely. Files missing from the manifest are served as before.
+
+Old builds are kept, so pages rendered by the previous release still find
+their assets during a rolling deploy (`--clean` removes them).
+"""
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import posixpath
+import re
+import shutil
+
+import click
+from flask import current_app, request, send_from_directory
+from flask.cli import AppGroup
+
+# the build, inside the static folder
+BUILD_DIR = 'build'
+MANIFEST = 'manifest.json'
+
+# a year, the most `max-age` caches honour
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+# extensions worth compressing (images and fonts mostly are already)
+COMPRESSIBLE = ('.css', '.js', '.map', '.json', '.svg', '.html', '.txt', '.xml', '.ico', '.ttf', '.otf')
+
+# keep a compressed variant only below this fraction of the original
+MIN_SAVING = 0.9
+
+# the variants, preferred first, with their file suffixes
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+_CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'"()]+)\1\s*\)''')
+
+
+def fingerprint(path, data):
+    """
+    Name a file after a hash of its content.
+    """
+    root, ext = posixpath.splitext(path)
+    return f'{root}.{hashlib.sha1(data).hexdigest()[:12]}{ext}'
+
+
+def _gzip(data):
+    # no timestamp, so the same input builds the same file
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=9, mtime=0) as f:
+        f.write(data)
+    return buffer.getvalue()
+
+
+def _compressors():
+    compressors = {'gzip': _gzip}
+    try:
+        import brotli
+    except ImportError:
+        click.echo('The `brotli` package is not installed, skipping brotli variants.', err=True)
+    else:
+        compressors['br'] = lambda data: brotli.compress(data, quality=11)
+    return compressors
+
+
+def _rewrite_css(path, data, assets):
+    """
+    Point a stylesheet's relative `url()`s at fingerprinted assets.
+    """
+    directory = posixpath.dirname(path)
+
+    def replace(match):
+        quote, url = match.groups()
+        if url.startswith(('/', 'data:', 'http:', 'https:', '#')):
+            return match.group(0)
+        target, _, suffix = url.partition('?')
+        built = assets.get(posixpath.normpath(posixpath.join(directory, target)))
+        if built is None:
+            return match.group(0)
+        # both files live under the build directory, so stay relative
+        relative = posixpath.relpath(built['path'], posixpath.join(BUILD_DIR, directory))
+        return f"url({quote}{relative}{'?' + suffix if suffix else ''}{quote})"
+
+    return _CSS_URL.sub(replace, data.decode('utf-8')).encode('utf-8')
+
+
+def build(static_folder, clean=False):
+    """
+    Fingerprint and precompress every static file, and write the manifest.
+
+    Returns
+    -------
+    dict
+        Logical path (relative to the static folder) to the built `path`
+        and its precompressed `encodings`.
+    """
+    output = os.path.join(static_folder, BUILD_DIR)
+    if clean and os.path.isdir(output):
+        shutil.rmtree(output)
+
+    sources = []
+    for directory, dirnames, filenames in os.walk(static_folder):
+        relative = os.path.relpath(directory, static_folder)
+        if relative == BUILD_DIR or relative.startswith(BUILD_DIR + os.sep):
+            dirnames[:] = []
+            continue
+        dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+        for name in filenames:
+            if not name.startswith('.'):
+                sources.append(posixpath.normpath(posixpath.join(relative.replace(os.sep, '/'), name)))
+
+    compressors = _compressors()
+    assets = {}
+    # stylesheets last, so the assets they refer to are named already
+    for path in sorted(sources, key=lambda path: (path.endswith('.css'), path)):
+        with open(os.path.join(static_folder, path), 'rb') as f:
+            data = f.read()
+        if path.endswith('.css'):
+            data = _rewrite_css(path, data, assets)
+
+        built = posixpath.join(BUILD_DIR, fingerprint(path, data))
+        target = os.path.join(static_folder, built)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as f:
+            f.write(data)
+
+        encodings = []
+        if path.lower().endswith(COMPRESSIBLE):
+            for encoding, suffix in ENCODINGS:
+                if encoding not in compressors:
+                    continue
+                compressed = compressors[encoding](data)
+                if len(compressed) < len(data) * MIN_SAVING:
+                    with open(target + suffix, 'wb') as f:
+                        f.write(compressed)
+                    encodings.append(encoding)
+        assets[path] = {'path': built, 'encodings': encodings}
+
+    with open(os.path.join(output, MANIFEST), 'w') as f:
+        json.dump({'assets': assets}, f, indent=2, sort_keys=True)
+    return assets
+
+
+class Assets:
+    """
+    The fingerprinted assets of a build manifest, and a `version` that
+    changes with any of them.
+    """
+
+    def __init__(self, assets, version=None):
+        self.urls = {path: asset['path'] for path, asset in assets.items()}
+        self.encodings = {asset['path']: asset['encodings'] for asset in assets.values()}
+        self.version = version
+
+    @classmethod
+    def load(cls, static_folder):
+        """
+        Load the manifest of a static folder, if it was built.
+        """
+        path = os.path.join(static_folder, BUILD_DIR, MANIFEST)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            manifest = f.read()
+        return cls(json.loads(manifest)['assets'], hashlib.sha1(manifest).hexdigest()[:12])
+
+    def url_defaults(self, endpoint, values):
+        """
+        Swap static file names for their fingerprinted ones.
+        """
+        if endpoint == 'static':
+            built = self.urls.get(values.get('filename'))
+            if built is not None:
+                values['filename'] = built
+
+
+def send_static(filename):
+    """
+    Serve a static file, fingerprinted ones precompressed and immutable.
+    """
+    assets = current_app.extensions['assets']
+    encodings = assets.encodings.get(filename)
+    if encodings is None:
+        return current_app.send_static_file(filename)
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    for encoding, suffix in ENCODINGS:
+        if encoding in encodings and request.accept_encodings[encoding]:
+            response = send_from_directory(current_app.static_folder, filename + suffix, mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(current_app.static_folder, filename, mimetype=mimetype)
+
+    if encodings:
+        response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = IMMUTABLE
+    return response
+
+
+def init_app(app):
+    """
+    Serve the built assets, if there is a build (outside debug mode, where
+    static files change as they are edited).
+    """
+    if not app.config.get('ASSETS_ENABLED', True) or app.debug or not app.static_folder:
+        return
+    assets = Assets.load(app.static_folder)
+    if assets is None:
+        return
+
+    app.extensions['assets'] = assets
+    app.url_defaults(assets.url_defaults)
+    app.view_functions['static'] = send_static
+
+
+assets_cli = AppGroup('assets', help='Build the static assets.')
+
+
+@assets_cli.command('build')
+@click.option('--clean', is_flag=True, help='Remove the previous builds first.')
+def build_command(clean):
+    """
+    Fingerprint and precompress the static files.
+    """
+    assets = build(current_app.static_folder, clean=clean)
+    compressed = sum(1 for asset in assets.values() if asset['encodings'])
+    click.echo(f'{len(assets)} assets built ({compressed} precompressed) '
+               f'in {os.path.join(current_app.static_folder, BUILD_DIR)}.')
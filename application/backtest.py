@@ -0,0 +1,483 @@
+"""
+Backtests :: replay strategies over historical lines.
+
+The lines of a date range are streamed from the database in
+`(starts_at, id)` order, a chunk at a time, into a columnar snapshot on
+disk: one `.npy` file per column plus a `manifest.json`. String columns
+are stored as integer codes with their vocabulary in the manifest. Each
+line's outcome comes from the results of the investments on it, and
+lines nobody invested in (so with no outcome) are never bet.
+
+Runs (strategies, and parameter sweeps of them) are then spread over a
+process pool. Every worker memory-maps the same snapshot, so the line
+history is read from the page cache rather than copied per process. A
+run walks the days in order, sizing each day's bets from the simulated
+bankroll with the strategy's compiled `Plan`, and reports its P&L curve.
+"""
+import copy
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import click
+import numpy as np
+from flask.cli import with_appcontext
+from sqlalchemy import and_, case, func, or_, select
+
+from application import db
+from application.database import MAX_IN_PARAMS
+from application.lines import PROMOTED, parse_datetime
+from application.models import Investment, Line, Result, Strategy
+from application.money import Money, dollars_to_cents
+from application.settlement import LOSS, PUSH, WIN, decimal_odds, payouts
+from application.strategies import StrategyError, compile_strategy
+
+DEFAULT_CHUNK_SIZE = 5000
+DEFAULT_BANKROLL = '1000.00'
+
+# details keys kept in a snapshot, and how they compare
+DEFAULT_KEYS = {
+    'sport': 'object',
+    'market_type': 'object',
+    'home': 'object',
+    'away': 'object',
+    'price': 'number',
+}
+
+# outcome codes of the `outcome` column
+UNSETTLED = -1
+OUTCOME_CODES = {LOSS: 0, WIN: 1, PUSH: 2}
+OUTCOME_NAMES = np.array([LOSS, WIN, PUSH])
+
+# stakes are sized from at most this bankroll (cents), where float64
+# odds math is still exact
+MAX_BANKROLL = 2 ** 53
+
+MANIFEST = 'manifest.json'
+
+
+lines = Line.__table__
+
+
+def stream_lines(start, end, chunk_size=DEFAULT_CHUNK_SIZE, connection=None):
+    """
+    Yield the lines starting in `[start, end)` in chunks, oldest first.
+
+    Each chunk is a keyset query after the last `(starts_at, id)` seen, so
+    no chunk costs more than the ones before it.
+    """
+    connection = connection or db.session.connection()
+    columns = [lines.c.id, lines.c.details, lines.c.starts_at] + \
+        [lines.c[name] for name, _ in PROMOTED.values() if name != 'starts_at']
+
+    last = None
+    while True:
+        conditions = [lines.c.starts_at >= start, lines.c.starts_at < end]
+        if last is not None:
+            conditions.append(or_(lines.c.starts_at > last.starts_at,
+                                  and_(lines.c.starts_at == last.starts_at, lines.c.id > last.id)))
+        rows = connection.execute(
+            select(columns).where(and_(*conditions))
+            .order_by(lines.c.starts_at, lines.c.id)
+            .limit(chunk_size)
+        ).fetchall()
+        if not rows:
+            return
+        yield rows
+        last = rows[-1]
+
+
+def _outcomes(connection, line_ids):
+    """
+    Get the outcome of lines from the results of the investments on them.
+    """
+    investments = Investment.__table__
+    results = Result.__table__
+
+    outcomes = {}
+    for i in range(0, len(line_ids), MAX_IN_PARAMS):
+        for line_id, won, largest in connection.execute(
+                select([investments.c.line_id,
+                        func.max(case([(results.c.is_win, 1)], else_=0)),
+                        func.max(func.abs(results.c.amount))])
+                .select_from(results.join(investments, investments.c.id == results.c.investment_id))
+                .where(investments.c.line_id.in_(line_ids[i:i + MAX_IN_PARAMS]))
+                .group_by(investments.c.line_id)):
+            if won:
+                outcomes[line_id] = WIN
+            elif int(largest) == 0:
+                outcomes[line_id] = PUSH
+            else:
+                outcomes[line_id] = LOSS
+    return outcomes
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _odds(details):
+    try:
+        return decimal_odds(details)
+    except (KeyError, TypeError, ValueError, ZeroDivisionError):
+        return np.nan
+
+
+def build_snapshot(directory, start, end, keys=None, chunk_size=DEFAULT_CHUNK_SIZE, connection=None):
+    """
+    Write a columnar snapshot of the lines starting in `[start, end)`.
+
+    Parameters
+    ----------
+    directory : str
+        Where to write the snapshot.
+    start, end : datetime
+        The date range of the lines.
+    keys : dict, optional
+        Details key to `number` or `object`, the columns to keep besides
+        `starts_at`, `odds` and `outcome`. Defaults to `DEFAULT_KEYS`.
+
+    Returns
+    -------
+    dict
+        The manifest.
+    """
+    connection = connection or db.session.connection()
+    keys = keys or DEFAULT_KEYS
+    os.makedirs(directory, exist_ok=True)
+
+    n = connection.execute(
+        select([func.count()]).where(and_(lines.c.starts_at >= start, lines.c.starts_at < end))
+    ).scalar()
+
+    def column(name, dtype):
+        return np.lib.format.open_memmap(os.path.join(directory, f'{name}.npy'),
+                                         mode='w+', dtype=dtype, shape=(n,))
+
+    starts_at = column('starts_at', 'datetime64[us]')
+    odds = column('odds', np.float64)
+    outcome = column('outcome', np.int8)
+    columns = {key: column(key, np.float64 if kind == 'number' else np.int32)
+               for key, kind in keys.items()}
+    vocabularies = {key: {} for key, kind in keys.items() if kind == 'object'}
+
+    written = 0
+    for rows in stream_lines(start, end, chunk_size, connection):
+        # lines added since the count wait for the next snapshot
+        rows = rows[:n - written]
+        if not rows:
+            break
+        chunk = slice(written, written + len(rows))
+        details = [row.details or {} for row in rows]
+
+        starts_at[chunk] = [parse_datetime(row.starts_at) for row in rows]
+        odds[chunk] = [_odds(d) for d in details]
+        line_outcomes = _outcomes(connection, [row.id for row in rows])
+        outcome[chunk] = [OUTCOME_CODES.get(line_outcomes.get(row.id), UNSETTLED) for row in rows]
+
+        for key, kind in keys.items():
+            if key in PROMOTED:
+                values = [getattr(row, PROMOTED[key][0]) for row in rows]
+            else:
+                values = [d.get(key) for d in details]
+
+            if kind == 'number':
+                columns[key][chunk] = [_number(v) for v in values]
+            else:
+                vocabulary = vocabularies[key]
+                columns[key][chunk] = [-1 if v is None else vocabulary.setdefault(v, len(vocabulary))
+                                       for v in values]
+        written += len(rows)
+
+    for array in [starts_at, odds, outcome] + list(columns.values()):
+        array.flush()
+
+    manifest = {
+        'size': written,
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'keys': keys,
+        'vocabularies': {key: sorted(v, key=v.get) for key, v in vocabularies.items()}
+    }
+    with open(os.path.join(directory, MANIFEST), 'w') as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+def load_snapshot(directory):
+    """
+    Memory-map a snapshot written by `build_snapshot`.
+
+    Returns
+    -------
+    manifest : dict
+    columns : dict of np.memmap
+    """
+    with open(os.path.join(directory, MANIFEST)) as f:
+        manifest = json.load(f)
+
+    size = manifest['size']
+    names = ['starts_at', 'odds', 'outcome'] + list(manifest['keys'])
+    columns = {name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r')[:size]
+               for name in names}
+    return manifest, columns
+
+
+class SnapshotBatch:
+    """
+    A snapshot, seen as a batch of lines by a strategy `Plan`.
+    """
+
+    def __init__(self, manifest, columns):
+        self.manifest = manifest
+        self.columns = columns
+        self.starts_at = columns['starts_at']
+        self._decoded = {}
+
+    def __len__(self):
+        return len(self.starts_at)
+
+    def column(self, key, kind):
+        if key == 'start_time':
+            return self.starts_at
+        if key not in self.manifest['keys']:
+            raise StrategyError(f'The snapshot has no `{key}` column.')
+
+        stored = self.manifest['keys'][key]
+        if stored == 'number':
+            values = self.columns[key]
+            return values if kind == 'number' else values.astype(object)
+
+        if (key, kind) not in self._decoded:
+            # decode the vocabulary once, then index it with the codes
+            vocabulary = self.manifest['vocabularies'][key] + [None]
+            if kind == 'number':
+                decoded = np.array([_number(v) for v in vocabulary], dtype=np.float64)
+            else:
+                decoded = np.array(vocabulary, dtype=object)
+            self._decoded[key, kind] = decoded[self.columns[key]]
+        return self._decoded[key, kind]
+
+
+def simulate(plan, batch, bankroll):
+    """
+    Replay a strategy over a snapshot, a day at a time.
+
+    Parameters
+    ----------
+    plan : application.strategies.Plan
+        The compiled strategy.
+    batch : SnapshotBatch
+        The line history.
+    bankroll : int
+        The starting bankroll, in cents.
+
+    Returns
+    -------
+    dict
+        The summary of the run and its daily `curve`.
+    """
+    columns = batch.columns
+    mask = plan.mask(batch) & (columns['outcome'] != UNSETTLED) & ~np.isnan(columns['odds'])
+    days = batch.starts_at.astype('datetime64[D]')
+    day_values, day_starts = np.unique(days, return_index=True)
+    day_ends = np.r_[day_starts[1:], len(days)]
+
+    start = bankroll
+    bets = wins = staked = 0
+    curve = {'date': [], 'bets': [], 'pnl': [], 'bankroll': []}
+    path = [start]
+    for day, s, e in zip(day_values, day_starts, day_ends):
+        selected = np.flatnonzero(mask[s:e]) + s
+        if plan.max_lines is not None:
+            selected = selected[:plan.max_lines]
+        if not len(selected) or bankroll <= 0:
+            continue
+
+        # a day's bets can't stake more than the bankroll
+        sizing_bankroll = np.array([min(bankroll, MAX_BANKROLL)], dtype=np.int64)
+        stake = min(int(plan.size(sizing_bankroll)[0]), sizing_bankroll[0] // len(selected))
+        if stake <= 0:
+            continue
+        outcomes = OUTCOME_NAMES[columns['outcome'][selected]]
+        pnl = payouts(np.full(len(selected), stake, dtype=np.int64), columns['odds'][selected], outcomes)
+
+        bankroll += int(pnl.sum())
+        bets += len(selected)
+        wins += int((outcomes == WIN).sum())
+        staked += stake * len(selected)
+        curve['date'].append(str(day))
+        curve['bets'].append(len(selected))
+        curve['pnl'].append(str(Money(pnl.sum())))
+        curve['bankroll'].append(str(Money(bankroll)))
+        path.append(bankroll)
+
+    path = np.array(path, dtype=np.int64)
+    drawdown = np.maximum.accumulate(path) - path
+    return {
+        'bets': bets,
+        'wins': wins,
+        'win_rate': round(wins / bets, 4) if bets else None,
+        'staked': str(Money(staked)),
+        'pnl': str(Money(bankroll - start)),
+        'roi': round((bankroll - start) / staked, 4) if staked else None,
+        'bankroll': str(Money(bankroll)),
+        'max_drawdown': str(Money(drawdown.max())),
+        'curve': curve
+    }
+
+
+def _run(task):
+    """
+    Run one backtest in a worker process. An invalid strategy is reported
+    as the run's `error`, so it doesn't fail the other runs.
+    """
+    directory, name, details, bankroll = task
+    started = time.perf_counter()
+    manifest, columns = load_snapshot(directory)
+    try:
+        plan = compile_strategy(name, details)
+        report = simulate(plan, SnapshotBatch(manifest, columns), bankroll)
+    except StrategyError as e:
+        report = {'error': str(e)}
+    report.update(name=name, details=details, seconds=round(time.perf_counter() - started, 3))
+    return report
+
+
+def sweep(details, params):
+    """
+    Expand a strategy definition over a parameter grid.
+
+    Parameters
+    ----------
+    details : dict
+        The strategy definition.
+    params : dict
+        Dotted path (i.e. `sizing.fraction`) to the list of values to try.
+
+    Yields
+    ------
+    (dict, dict)
+        The values of the variant, and its definition.
+    """
+    paths = list(params)
+    for values in itertools.product(*(params[p] for p in paths)):
+        variant = copy.deepcopy(details)
+        for path, value in zip(paths, values):
+            *parents, leaf = path.split('.')
+            target = variant
+            for parent in parents:
+                target = target.setdefault(parent, {})
+            target[leaf] = value
+        yield dict(zip(paths, values)), variant
+
+
+def run_backtests(directory, runs, bankroll, processes=None):
+    """
+    Run backtests over a snapshot, in parallel.
+
+    Parameters
+    ----------
+    directory : str
+        The snapshot, see `build_snapshot`.
+    runs : list of (str, dict)
+        The name and definition of each run.
+    bankroll : int
+        The starting bankroll, in cents.
+    processes : int, optional
+        The number of worker processes. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    list of dict
+        The report of each run, or its `error`.
+    """
+    tasks = [(directory, name, details, bankroll) for name, details in runs]
+    processes = min(processes or os.cpu_count(), len(tasks))
+    if processes <= 1:
+        return [_run(task) for task in tasks]
+    with ProcessPoolExecutor(processes) as pool:
+        return list(pool.map(_run, tasks))
+
+
+def _parse_sweep(values):
+    """
+    Parse `--sweep path=v1,v2,...` options (values are JSON, or strings).
+    """
+    params = {}
+    for value in values:
+        path, _, options = value.partition('=')
+        if not options:
+            raise click.BadParameter(f'`{value}` is not `path=value,...`', param_hint='--sweep')
+        parsed = []
+        for option in options.split(','):
+            try:
+                parsed.append(json.loads(option))
+            except ValueError:
+                parsed.append(option)
+        params[path] = parsed
+    return params
+
+
+@click.command('backtest')
+@click.argument('codes', nargs=-1)
+@click.option('--start', type=click.DateTime(), required=True, help='First day of lines.')
+@click.option('--end', type=click.DateTime(), default=None, help='Day after the last day of lines (default: now).')
+@click.option('--bankroll', default=DEFAULT_BANKROLL, show_default=True, help='Starting bankroll.')
+@click.option('--sweep', 'sweeps', multiple=True,
+              help='Parameter grid, i.e. `sizing.fraction=0.01,0.02` (repeatable).')
+@click.option('--processes', type=int, default=None, help='Worker processes (default: CPUs).')
+@click.option('--chunk-size', default=DEFAULT_CHUNK_SIZE, show_default=True, help='Lines per query.')
+@click.option('--snapshot', 'snapshot_dir', type=click.Path(file_okay=False), default=None,
+              help='Keep the line snapshot in this directory (default: a temporary one).')
+@click.option('--output', type=click.Path(dir_okay=False), default=None,
+              help='Write the full report (with P&L curves) to this JSON file.')
+@with_appcontext
+def backtest_command(codes, start, end, bankroll, sweeps, processes, chunk_size, snapshot_dir, output):
+    """
+    Backtest strategies (by code, default all) over historical lines.
+    """
+    query = Strategy.query.order_by(Strategy.id)
+    if codes:
+        query = query.filter(Strategy.code.in_(codes))
+    strategies = query.all()
+    if not strategies:
+        raise click.UsageError('No strategies to backtest.')
+
+    params = _parse_sweep(sweeps)
+    runs = []
+    for strategy in strategies:
+        for values, details in sweep(strategy.details, params):
+            suffix = ','.join(f'{k}={v}' for k, v in values.items())
+            runs.append((f'{strategy.code}[{suffix}]' if suffix else strategy.code, details))
+
+    directory = snapshot_dir or tempfile.mkdtemp(prefix='backtest-')
+    try:
+        started = time.perf_counter()
+        manifest = build_snapshot(directory, start, end or datetime.utcnow(), chunk_size=chunk_size)
+        click.echo(f"Snapshot of {manifest['size']} lines in {time.perf_counter() - started:.1f}s.")
+
+        reports = run_backtests(directory, runs, dollars_to_cents(bankroll), processes)
+    finally:
+        if snapshot_dir is None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    for report in reports:
+        if 'error' in report:
+            click.echo(f"{report['name']}: failed, {report['error']}", err=True)
+            continue
+        click.echo(f"{report['name']}: {report['bets']} bets, P&L {report['pnl']} "
+                   f"(ROI {report['roi']}), bankroll {report['bankroll']}, "
+                   f"max drawdown {report['max_drawdown']}")
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(reports, f, indent=2)
@@ -0,0 +1,417 @@
+"""
+Materialized balances for the fund ledgers.
+
+Summing `fund_ledgers` / `fund_user_ledgers` gets slower as the ledgers
+grow, so every ledger is paired with two extra tables:
+
+* a running balance per owner (`fund_balances`, `fund_user_balances`),
+  updated in the same transaction as every ledger insert, and
+* point-in-time snapshots (`fund_balance_snapshots`, ...), which let
+  "balance as of T" start from the nearest snapshot and only add the tail.
+
+Amounts are integer cents (see `application.money`), so every sum here is
+exact, in the database and in Python alike.
+
+ORM inserts are picked up automatically by mapper events. Bulk writers
+that go through SQLAlchemy core (settlement, test data) must call
+`apply_rows` themselves, inside the same transaction.
+
+The ledgers are partitioned by month (see `application.partitions`), so
+historical lookups read the ledger's history rather than the live table.
+
+New balances are published to the live dashboards (`application.events`)
+when the transaction that changed them commits.
+"""
+from datetime import datetime
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import and_, event, func, inspect, or_, select
+
+from application import db, events, partitions
+from application.database import MAX_IN_PARAMS
+from application.models import (Fund, FundBalance, FundBalanceSnapshot,
+                                FundLedger, FundUser, FundUserBalance,
+                                FundUserBalanceSnapshot, FundUserLedger)
+from application.money import Money, MoneyType, cents, money_sum
+
+
+class BalanceSpec:
+    """
+    Ties a ledger table to its running balance and snapshot tables.
+
+    Parameters
+    ----------
+    ledger : db.Model
+        The append-only ledger model.
+    balance : db.Model
+        The running balance model, keyed by the owner.
+    snapshot : db.Model
+        The snapshot model.
+    owner : str
+        The name of the owner column, shared by all three tables.
+    """
+
+    def __init__(self, ledger, balance, snapshot, owner):
+        self.ledger = ledger.__table__
+        self.partitioned = partitions.LEDGERS[self.ledger.name]
+        self.balance = balance.__table__
+        self.snapshot = snapshot.__table__
+        self.owner = owner
+
+    def owner_of(self, table):
+        """
+        Get the owner column of one of the three tables.
+        """
+        return table.c[self.owner]
+
+
+FUND = BalanceSpec(FundLedger, FundBalance, FundBalanceSnapshot, 'fund_id')
+FUND_USER = BalanceSpec(FundUserLedger, FundUserBalance, FundUserBalanceSnapshot, 'fund_user_id')
+
+SPECS = (FUND, FUND_USER)
+
+
+def _apply(connection, spec, owner_id, amount, ledger_id=None):
+    """
+    Add `amount` to the running balance of `owner_id`.
+
+    The first row of an owner creates its balance. Concurrent first rows
+    don't both insert it: Postgres upserts, elsewhere the insert ignores
+    a conflict and the loser adds its amount with another update.
+    """
+    if connection.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+
+        statement = insert(spec.balance).values(**{
+            spec.owner: owner_id, 'balance': amount, 'ledger_id': ledger_id, 'modified_on': func.now()
+        })
+        values = {'balance': spec.balance.c.balance + statement.excluded.balance, 'modified_on': func.now()}
+        if ledger_id is not None:
+            values['ledger_id'] = statement.excluded.ledger_id
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=[spec.owner_of(spec.balance)], set_=values))
+        return
+
+    values = {'balance': spec.balance.c.balance + amount, 'modified_on': func.now()}
+    if ledger_id is not None:
+        values['ledger_id'] = ledger_id
+    update = spec.balance.update().where(spec.owner_of(spec.balance) == owner_id).values(**values)
+
+    if connection.execute(update).rowcount:
+        return
+
+    # first row for this owner (SQLite)
+    inserted = connection.execute(spec.balance.insert().prefix_with('OR IGNORE').values(**{
+        spec.owner: owner_id,
+        'balance': amount,
+        'ledger_id': ledger_id,
+        'modified_on': func.now()
+    })).rowcount
+    if not inserted:
+        connection.execute(update)
+
+
+def _publish(connection, spec, owner_ids):
+    """
+    Publish the running balances of some owners once the transaction
+    commits: the fund balance to the fund, and each member's balance to
+    that member only.
+    """
+    if not events.wanted():
+        return
+
+    owner_ids = list(owner_ids)
+    owner = spec.owner_of(spec.balance)
+    fund_users = FundUser.__table__
+    for i in range(0, len(owner_ids), MAX_IN_PARAMS):
+        chunk = owner_ids[i:i + MAX_IN_PARAMS]
+        if spec is FUND:
+            for fund_id, balance in connection.execute(
+                select([owner, spec.balance.c.balance]).where(owner.in_(chunk))
+            ):
+                events.publish(fund_id, 'balance', {'fund_id': fund_id, 'fund_balance': str(balance)},
+                               connection)
+        else:
+            for fund_user_id, fund_id, balance in connection.execute(
+                select([owner, fund_users.c.fund_id, spec.balance.c.balance])
+                .select_from(spec.balance.join(fund_users, fund_users.c.id == owner))
+                .where(owner.in_(chunk))
+            ):
+                events.publish(events.member_topic(fund_user_id), 'balance',
+                               {'fund_id': fund_id, 'balance': str(balance)}, connection)
+
+
+def apply_rows(connection, spec, rows):
+    """
+    Apply a batch of ledger rows to the running balances.
+
+    Rows are aggregated per owner first, so a batch costs one statement
+    per distinct owner rather than one per row. This must run inside the
+    transaction that inserted the rows.
+
+    Parameters
+    ----------
+    connection : sqlalchemy.engine.Connection
+        The connection the ledger rows were written with.
+    spec : BalanceSpec
+        Which ledger the rows belong to.
+    rows : iterable of dict
+        Ledger rows, with at least the owner column and `amount` (a
+        `Money`, or integer cents).
+        An `id` key is used to track the last applied row when present.
+    """
+    totals = {}
+    last_ids = {}
+    for row in rows:
+        owner_id = row[spec.owner]
+        totals[owner_id] = totals.get(owner_id, 0) + cents(row['amount'])
+        if row.get('id') is not None:
+            last_ids[owner_id] = max(last_ids.get(owner_id, 0), row['id'])
+
+    for owner_id, amount in totals.items():
+        _apply(connection, spec, owner_id, amount, last_ids.get(owner_id))
+    _publish(connection, spec, totals)
+
+
+def rebuild(spec, connection=None):
+    """
+    Recompute every running balance for a ledger from scratch.
+
+    This is a single `INSERT ... SELECT ... GROUP BY` over the live ledger
+    (whose opening balances carry the rolled up periods), so it stays in
+    the database regardless of the ledger size.
+    """
+    connection = connection or db.session.connection()
+    ledger_owner = spec.owner_of(spec.ledger)
+
+    connection.execute(spec.balance.delete())
+    connection.execute(spec.balance.insert().from_select(
+        [spec.owner, 'balance', 'ledger_id', 'modified_on'],
+        select([
+            ledger_owner,
+            money_sum(spec.ledger.c.amount),
+            func.max(spec.ledger.c.id),
+            func.now()
+        ]).group_by(ledger_owner)
+    ))
+
+
+def _latest_snapshots(spec, as_of):
+    """
+    Subquery of the most recent snapshot at or before `as_of` per owner.
+    """
+    snap_owner = spec.owner_of(spec.snapshot)
+    latest = select([
+        snap_owner.label('owner_id'),
+        func.max(spec.snapshot.c.timestamp).label('timestamp')
+    ]).where(spec.snapshot.c.timestamp <= as_of).group_by(snap_owner).alias('latest')
+
+    return select([
+        snap_owner.label('owner_id'),
+        spec.snapshot.c.balance,
+        spec.snapshot.c.timestamp
+    ]).select_from(spec.snapshot.join(latest, and_(
+        snap_owner == latest.c.owner_id,
+        spec.snapshot.c.timestamp == latest.c.timestamp
+    ))).alias('snap')
+
+
+def take_snapshots(spec, as_of=None, connection=None):
+    """
+    Write a snapshot for every owner as of a point in time.
+
+    Each snapshot is computed from the previous one plus the ledger rows
+    between the two, so the cost is proportional to the tail only.
+
+    Parameters
+    ----------
+    spec : BalanceSpec
+        Which ledger to snapshot.
+    as_of : datetime, optional
+        The snapshot time. Defaults to now (UTC).
+
+    Returns
+    -------
+    int
+        The number of snapshots written.
+    """
+    as_of = as_of or datetime.utcnow()
+    connection = connection or db.session.connection()
+    ledger = partitions.history(spec.partitioned, connection=connection)
+    ledger_owner = ledger.c[spec.owner]
+    snap = _latest_snapshots(spec, as_of)
+
+    # sum the tail after each owner's latest snapshot
+    tails = dict(connection.execute(
+        select([ledger_owner, money_sum(ledger.c.amount)])
+        .select_from(ledger.outerjoin(snap, snap.c.owner_id == ledger_owner))
+        .where(and_(
+            ledger.c.timestamp <= as_of,
+            or_(snap.c.timestamp.is_(None), ledger.c.timestamp > snap.c.timestamp)
+        ))
+        .group_by(ledger_owner)
+    ).fetchall())
+    previous = {row.owner_id: row for row in connection.execute(select([snap])).fetchall()}
+
+    rows = []
+    for owner_id in set(tails) | set(previous):
+        prev = previous.get(owner_id)
+
+        # nothing changed since a snapshot at this exact time
+        if prev is not None and prev.timestamp == as_of:
+            continue
+
+        rows.append({
+            spec.owner: owner_id,
+            'balance': (prev.balance if prev is not None else Money(0)) + tails.get(owner_id, Money(0)),
+            'timestamp': as_of
+        })
+
+    if rows:
+        connection.execute(spec.snapshot.insert(), rows)
+    return len(rows)
+
+
+def get_balance(spec, owner_id):
+    """
+    Get the current balance of an owner with a primary key lookup.
+    """
+    balance = db.session.execute(
+        select([spec.balance.c.balance])
+        .where(spec.owner_of(spec.balance) == owner_id)
+    ).scalar()
+    return balance if balance is not None else Money(0)
+
+
+def get_balance_as_of(spec, owner_id, as_of):
+    """
+    Get the balance of an owner as of a point in time.
+
+    Starts from the nearest snapshot at or before `as_of`, and only adds
+    the ledger rows between that snapshot and `as_of`. When the snapshot
+    is in the live period, only the live table is read.
+    """
+    snapshot = db.session.execute(
+        select([spec.snapshot.c.balance, spec.snapshot.c.timestamp])
+        .where(and_(spec.owner_of(spec.snapshot) == owner_id,
+                    spec.snapshot.c.timestamp <= as_of))
+        .order_by(spec.snapshot.c.timestamp.desc())
+        .limit(1)
+    ).first()
+
+    since = snapshot.timestamp if snapshot is not None else None
+    ledger = partitions.history(spec.partitioned, since)
+
+    conditions = [ledger.c[spec.owner] == owner_id, ledger.c.timestamp <= as_of]
+    if since is not None:
+        conditions.append(ledger.c.timestamp > since)
+
+    tail = db.session.execute(
+        select([money_sum(ledger.c.amount)]).where(and_(*conditions))
+    ).scalar()
+
+    return (snapshot.balance if snapshot is not None else Money(0)) + tail
+
+
+def fund_balance(fund_id, as_of=None):
+    """
+    Get the balance of a fund, optionally as of a point in time.
+    """
+    if as_of is None:
+        return get_balance(FUND, fund_id)
+    return get_balance_as_of(FUND, fund_id, as_of)
+
+
+def fund_user_balance(fund_user_id, as_of=None):
+    """
+    Get the balance of a fund user, optionally as of a point in time.
+    """
+    if as_of is None:
+        return get_balance(FUND_USER, fund_user_id)
+    return get_balance_as_of(FUND_USER, fund_user_id, as_of)
+
+
+def user_fund_balances(user_id):
+    """
+    Get every fund a user belongs to with the fund and member balances.
+
+    One query, reading the running balances only.
+    """
+    return db.session.query(
+        Fund.id,
+        Fund.name,
+        func.coalesce(FundBalance.balance, 0, type_=MoneyType).label('fund_balance'),
+        func.coalesce(FundUserBalance.balance, 0, type_=MoneyType).label('balance')
+    ).join(FundUser, FundUser.fund_id == Fund.id) \
+        .outerjoin(FundBalance, FundBalance.fund_id == Fund.id) \
+        .outerjoin(FundUserBalance, FundUserBalance.fund_user_id == FundUser.id) \
+        .filter(FundUser.user_id == user_id) \
+        .order_by(Fund.name) \
+        .all()
+
+
+def _listen(spec, model):
+    """
+    Keep the running balance of `spec` in sync with ORM writes to `model`.
+    """
+
+    # load the old amount and owner before they are overwritten (even on
+    # an expired instance), so an update can be reversed exactly
+    for attribute in (model.amount, getattr(model, spec.owner)):
+        event.listen(attribute, 'set', lambda *args: None, active_history=True)
+
+    @event.listens_for(model, 'after_insert')
+    def after_insert(mapper, connection, target):
+        _apply(connection, spec, getattr(target, spec.owner), target.amount, target.id)
+        _publish(connection, spec, [getattr(target, spec.owner)])
+
+    @event.listens_for(model, 'after_update')
+    def after_update(mapper, connection, target):
+        state = inspect(target)
+        amount = state.attrs.amount.history
+        owner = state.attrs[spec.owner].history
+        if not (amount.has_changes() or owner.has_changes()):
+            return
+
+        old_amount = amount.deleted[0] if amount.deleted else target.amount
+        old_owner = owner.deleted[0] if owner.deleted else getattr(target, spec.owner)
+        _apply(connection, spec, old_owner, -old_amount)
+        _apply(connection, spec, getattr(target, spec.owner), target.amount)
+        _publish(connection, spec, {old_owner, getattr(target, spec.owner)})
+
+    @event.listens_for(model, 'after_delete')
+    def after_delete(mapper, connection, target):
+        _apply(connection, spec, getattr(target, spec.owner), -target.amount)
+        _publish(connection, spec, [getattr(target, spec.owner)])
+
+
+_listen(FUND, FundLedger)
+_listen(FUND_USER, FundUserLedger)
+
+
+balances_cli = AppGroup('balances', help='Maintain the materialized ledger balances.')
+
+
+@balances_cli.command('rebuild')
+def rebuild_command():
+    """
+    Rebuild every running balance from the ledgers.
+    """
+    for spec in SPECS:
+        rebuild(spec)
+    db.session.commit()
+    click.echo('Rebuilt balances.')
+
+
+@balances_cli.command('snapshot')
+@click.option('--as-of', type=click.DateTime(), default=None,
+              help='Snapshot time (UTC). Defaults to now.')
+def snapshot_command(as_of):
+    """
+    Snapshot every balance, so historical lookups only scan the tail.
+    """
+    for spec in SPECS:
+        n = take_snapshots(spec, as_of)
+        click.echo(f'{spec.snapshot.name}: {n} snapshots written.')
+    db.session.commit()
@@ -0,0 +1,183 @@
+"""
+Small in-process caches, with an optional Redis backend.
+
+Both backends have the same interface (`get`, `set`, `delete`, `clear`,
+`stats`), so callers pick one with `make_cache` and never care which.
+"""
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    A bounded, thread-safe LRU cache where every entry expires after `ttl`.
+
+    Parameters
+    ----------
+    maxsize : int
+        The most entries kept. The least recently used entry is evicted
+        when the cache is full.
+    ttl : float, optional
+        Seconds before an entry expires. `None` never expires.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Get a value, or `default` if missing or expired.
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires = item
+                if expires is None or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        """
+        Set a value, evicting the least recently used entry if full.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        """
+        Remove a value, if present.
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """
+        Remove every value.
+        """
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """
+        Get the hit / miss counters.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._data),
+            'maxsize': self.maxsize
+        }
+
+
+class RedisCache:
+    """
+    A cache stored in Redis, shared by every worker process.
+
+    Values are pickled, and keys are prefixed with `namespace` so several
+    caches can share one database. Requires the `redis` package.
+
+    Parameters
+    ----------
+    url : str
+        The Redis URL, i.e. `redis://localhost:6379/0`.
+    namespace : str
+        Prefix for every key.
+    ttl : float, optional
+        Seconds before an entry expires. `None` never expires.
+    """
+
+    def __init__(self, url, namespace='cache', ttl=300):
+        try:
+            import redis
+        except ImportError:
+            raise ImportError('The `redis` package is required for a Redis cache backend.')
+
+        self.client = redis.Redis.from_url(url)
+        self.namespace = namespace
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, key):
+        return f'{self.namespace}:{key}'
+
+    def get(self, key, default=None):
+        """
+        Get a value, or `default` if missing or expired.
+        """
+        raw = self.client.get(self._key(key))
+        if raw is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return pickle.loads(raw)
+
+    def set(self, key, value, ttl=None):
+        """
+        Set a value.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        if ttl is None:
+            self.client.set(self._key(key), pickle.dumps(value))
+        else:
+            self.client.setex(self._key(key), int(max(ttl, 1)), pickle.dumps(value))
+
+    def delete(self, key):
+        """
+        Remove a value, if present.
+        """
+        self.client.delete(self._key(key))
+
+    def clear(self):
+        """
+        Remove every value in this cache's namespace.
+        """
+        keys = list(self.client.scan_iter(match=self._key('*')))
+        if keys:
+            self.client.delete(*keys)
+
+    def stats(self):
+        """
+        Get the hit / miss counters (for this process).
+        """
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+def make_cache(url=None, namespace='cache', maxsize=1024, ttl=300):
+    """
+    Create a cache for a backend URL.
+
+    Parameters
+    ----------
+    url : str, optional
+        `redis://...` for a Redis cache. Anything else (including `None`)
+        gives an in-process LRU cache.
+    namespace : str
+        Key prefix, for shared backends.
+    maxsize : int
+        The most entries kept, for in-process caches.
+    ttl : float, optional
+        Seconds before an entry expires.
+    """
+    if url and url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisCache(url, namespace=namespace, ttl=ttl)
+    return LRUCache(maxsize=maxsize, ttl=ttl)
@@ -8,9 +8,140 @@ class Config:
     DEBUG = False
     TESTING = False
 
+    # Import each blueprint on its first request rather than at startup
+    # (see `application.startup`)
+    LAZY_BLUEPRINTS = os.environ.get('LAZY_BLUEPRINTS') == '1'
+
+    # Logged-in user cache (`redis://...` to share it across workers)
+    USER_CACHE_URL = os.environ.get('USER_CACHE_URL')
+    USER_CACHE_SIZE = 10000
+    USER_CACHE_TTL = 300
+
+    # Password hashing profile (see `application.passwords.PROFILES`),
+    # and the bounded pool hashes run on (0 workers hashes inline)
+    PASSWORD_HASH_PROFILE = 'default'
+    PASSWORD_HASH_WORKERS = 4
+    PASSWORD_HASH_QUEUE = 32
+    PASSWORD_HASH_TIMEOUT = 2.0
+
+    # Login and signup throttling (see `application.ratelimit`): attempts
+    # per window (seconds), per client address and per email address, kept
+    # in-process or in Redis to share them across workers
+    RATELIMIT_ENABLED = True
+    RATELIMIT_URL = os.environ.get('RATELIMIT_URL')
+    RATELIMIT_SIZE = 100000
+    RATELIMITS = {
+        'login': {'ip': (20, 60), 'email': (5, 300)},
+        'signup': {'ip': (5, 600), 'email': (3, 600)}
+    }
+
+    # Fund performance: rolling Sharpe windows (days), and its cache
+    ANALYTICS_WINDOWS = (7, 30, 90)
+    ANALYTICS_CACHE_URL = os.environ.get('ANALYTICS_CACHE_URL')
+    ANALYTICS_CACHE_TTL = 3600
+
+    # Page caching (see `application.page_cache`): rendered public pages
+    # and template fragments, in-process or in Redis, and for how long
+    # (seconds); how long browsers and the CDN may reuse a page; and where
+    # compiled templates are kept between restarts (a temp directory if
+    # unset)
+    PAGE_CACHE_ENABLED = True
+    PAGE_CACHE_URL = os.environ.get('PAGE_CACHE_URL')
+    PAGE_CACHE_SIZE = 256
+    PAGE_CACHE_TTL = 300
+    PAGE_CACHE_MAX_AGE = 60
+    TEMPLATE_BYTECODE_CACHE = True
+    TEMPLATE_CACHE_DIR = os.environ.get('TEMPLATE_CACHE_DIR')
+
+    # Static assets: serve the fingerprinted, precompressed build of
+    # `flask assets build` when there is one (see `application.assets`)
+    ASSETS_ENABLED = True
+
+    # Live dashboard updates: the window bursts are coalesced over and the
+    # stream heartbeat (seconds), per-stream and per-process limits, and a
+    # Redis URL to relay updates between processes
+    EVENTS_URL = os.environ.get('EVENTS_URL')
+    EVENTS_COALESCE_INTERVAL = 0.25
+    EVENTS_HEARTBEAT = 15
+    EVENTS_QUEUE_SIZE = 64
+    EVENTS_MAX_SUBSCRIBERS = 10000
+
+    # Vote submission (see `application.votes`): the most votes and units
+    # per slate, and the writer coalescing slates: write after this long
+    # (seconds, 0 writes in the request) or this many votes, the most
+    # votes waiting, and how long a request waits for its votes
+    VOTES_MAX_PER_REQUEST = 100
+    VOTES_MAX_UNITS = 100
+    VOTES_FLUSH_INTERVAL = 0.05
+    VOTES_FLUSH_ROWS = 1000
+    VOTES_QUEUE_ROWS = 20000
+    VOTES_TIMEOUT = 5.0
+
+    # SQL instrumentation (see `/metrics/sql`): statements slower than this
+    # (seconds) are logged, as are requests issuing more statements than
+    # this or repeating one statement shape this often (N+1)
+    SQL_INSTRUMENTATION = True
+    SQL_SLOW_QUERY_THRESHOLD = 0.25
+    SQL_SLOW_REQUEST_QUERIES = 50
+    SQL_NPLUSONE_THRESHOLD = 10
+    SQL_SLOWEST_KEPT = 5
+
+    # Request metrics (see `/metrics`): a directory shared by the workers
+    # of a multi-process server, how often each process flushes its values
+    # (seconds), and the bearer token scrapers must send (with
+    # `METRICS_REQUIRE_TOKEN`, `/metrics` isn't served without one)
+    METRICS_ENABLED = True
+    METRICS_DIR = os.environ.get('METRICS_DIR')
+    METRICS_FLUSH_INTERVAL = 1.0
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    METRICS_REQUIRE_TOKEN = False
+
+    # Database engines (see `application.database`): connections pooled
+    # per process, the checkout timeout, connection recycling and the
+    # statement timeout (seconds), and a read replica for read-only views
+    DATABASE_POOL_SIZE = 5
+    DATABASE_POOL_MAX_OVERFLOW = 10
+    DATABASE_POOL_TIMEOUT = 30
+    DATABASE_POOL_RECYCLE = -1
+    DATABASE_POOL_PRE_PING = False
+    DATABASE_STATEMENT_TIMEOUT = None
+    DATABASE_REPLICA_URL = os.environ.get('DATABASE_REPLICA_URL')
+
+    # SQLite pragmas, run on every new connection
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,
+        'temp_store': 'MEMORY',
+        'cache_size': -16000
+    }
+
 
 class ProductionConfig(Config):
-    pass
+    PASSWORD_HASH_PROFILE = 'strong'
+
+    # an in-process user cache is invalidated in its own worker only, so
+    # edits made through another worker (or the CLI) show after the TTL;
+    # keep it short unless the cache is shared
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', 300 if Config.USER_CACHE_URL else 10))
+
+    # the metrics are not public
+    METRICS_REQUIRE_TOKEN = True
+
+    SECRET_KEY = os.environ.get('SECRET_KEY')
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL')
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # every worker holds its own pool, so workers * (size + overflow)
+    # must stay under the server's `max_connections`; connections are
+    # recycled before the server or a proxy drops them idle, and checked
+    # before use after a failover
+    DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE', 10))
+    DATABASE_POOL_MAX_OVERFLOW = int(os.environ.get('DATABASE_POOL_MAX_OVERFLOW', 10))
+    DATABASE_POOL_TIMEOUT = 5
+    DATABASE_POOL_RECYCLE = 1800
+    DATABASE_POOL_PRE_PING = True
+    DATABASE_STATEMENT_TIMEOUT = 30
 
 
 class TestConfig(Config):
@@ -19,6 +150,9 @@ class TestConfig(Config):
     DEBUG = True
     TESTING = True
 
+    # cheap hashes, so test data and logins are quick
+    PASSWORD_HASH_PROFILE = 'fast'
+
     # get test database default
     db_dir = TOP_DIR.parent / '..' / 'tests' / 'database'
     db_dir.mkdir(parents=True, exist_ok=True)
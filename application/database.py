@@ -0,0 +1,191 @@
+"""
+Database engines :: pool settings, per-dialect tuning and a read replica.
+
+* Every bind gets a `QueuePool` sized by the `DATABASE_POOL_*` settings
+  (size, overflow, checkout timeout, recycle and pre-ping).
+* PostgreSQL connections run with a `statement_timeout`
+  (`DATABASE_STATEMENT_TIMEOUT`, seconds), so a runaway query is cancelled
+  rather than holding its connection.
+* SQLite (the local mode) runs the `SQLITE_PRAGMAS` on every new
+  connection: WAL, so readers don't block the writer, and a busy timeout
+  instead of failing straight away on a locked database.
+* With `DATABASE_REPLICA_URL` set, the statements of views wrapped in
+  `read_only` go to the `replica` bind. Those views must not write.
+
+Pool capacity, checked out connections, checkout wait time and timeouts
+are recorded per bind in `application.telemetry`.
+"""
+import functools
+import os
+import time
+
+from flask import g, has_app_context
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import event, exc, orm
+from sqlalchemy.pool import QueuePool
+
+from application.telemetry import Counter, Gauge, Histogram
+
+REPLICA = 'replica'
+
+# keep IN lists under SQLite's bound parameter limit
+MAX_IN_PARAMS = 900
+
+# seconds waiting for a pooled connection
+WAIT_BUCKETS = (.0005, .001, .005, .01, .05, .1, .5, 1.0, 5.0, 30.0)
+
+POOL_WAIT = Histogram(
+    'db_pool_wait_seconds', 'Time waiting to check a connection out of the pool.', ('bind',), WAIT_BUCKETS)
+POOL_TIMEOUTS = Counter(
+    'db_pool_timeouts', 'Checkouts that gave up waiting for a connection.', ('bind',))
+POOL_CHECKED_OUT = Gauge(
+    'db_pool_checked_out', 'Connections checked out of the pool.', ('bind',))
+POOL_CAPACITY = Gauge(
+    'db_pool_capacity', 'The most connections the pool holds (size plus overflow).', ('bind',))
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    A `QueuePool` that records how long checkouts wait, and timeouts.
+    """
+    bind = 'default'
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            POOL_TIMEOUTS.inc(self.bind)
+            raise
+        finally:
+            POOL_WAIT.observe(time.perf_counter() - start, self.bind)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.bind = self.bind
+        return pool
+
+
+class RoutingSession(SignallingSession):
+    """
+    A session that sends everything to the replica inside `read_only` views.
+    """
+
+    def __init__(self, db, **options):
+        self._db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if has_app_context() and g.get('read_replica') and \
+                REPLICA in (self.app.config.get('SQLALCHEMY_BINDS') or {}):
+            return self._db.get_engine(self.app, bind=REPLICA)
+        return super().get_bind(mapper, clause)
+
+
+class Database(SQLAlchemy):
+    """
+    `SQLAlchemy`, with sessions that can be routed to the read replica.
+    """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def read_only(view):
+    """
+    Run a view's statements on the read replica (when there is one).
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        g.read_replica = True
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def engine_options(config):
+    """
+    Build `SQLALCHEMY_ENGINE_OPTIONS` from the database settings. Options
+    set there explicitly win.
+    """
+    uri = config.get('SQLALCHEMY_DATABASE_URI') or ''
+    options = dict(config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    connect_args = dict(options.get('connect_args') or {})
+
+    # an in-memory SQLite database is a single, static connection
+    if uri.startswith('sqlite') and uri.rstrip('/').endswith((':memory:', 'sqlite:')):
+        return options
+
+    options.setdefault('poolclass', InstrumentedQueuePool)
+    options.setdefault('pool_size', config.get('DATABASE_POOL_SIZE', 5))
+    options.setdefault('max_overflow', config.get('DATABASE_POOL_MAX_OVERFLOW', 10))
+    options.setdefault('pool_timeout', config.get('DATABASE_POOL_TIMEOUT', 30))
+    options.setdefault('pool_recycle', config.get('DATABASE_POOL_RECYCLE', -1))
+    options.setdefault('pool_pre_ping', config.get('DATABASE_POOL_PRE_PING', False))
+
+    timeout = config.get('DATABASE_STATEMENT_TIMEOUT')
+    if uri.startswith('sqlite'):
+        # pooled connections move between request threads
+        connect_args.setdefault('check_same_thread', False)
+    elif uri.startswith('postgres') and timeout:
+        connect_args.setdefault('options', f'-c statement_timeout={int(timeout * 1000)}')
+
+    if connect_args:
+        options['connect_args'] = connect_args
+    return options
+
+
+def _sqlite_pragmas(pragmas):
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+        cursor.close()
+    return connect
+
+
+def _track_checkouts(engine, bind):
+    if isinstance(engine.pool, InstrumentedQueuePool):
+        engine.pool.bind = bind
+
+    counted = set()
+
+    @event.listens_for(engine, 'checkout')
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        # capacity is per process, so it is counted again after a fork
+        pool = engine.pool
+        if isinstance(pool, QueuePool) and (id(pool), os.getpid()) not in counted:
+            counted.add((id(pool), os.getpid()))
+            POOL_CAPACITY.inc(bind, amount=pool.size() + pool._max_overflow)
+        POOL_CHECKED_OUT.inc(bind)
+
+    @event.listens_for(engine, 'checkin')
+    def checkin(dbapi_connection, connection_record):
+        POOL_CHECKED_OUT.dec(bind)
+
+
+def init_app(app):
+    """
+    Configure the engines of the app's `Database`, and instrument them.
+    """
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    if app.config.get('DATABASE_REPLICA_URL'):
+        binds[REPLICA] = app.config['DATABASE_REPLICA_URL']
+    app.config['SQLALCHEMY_BINDS'] = binds or None
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
+
+    db = app.extensions['sqlalchemy'].db
+    engines = {}
+    for bind in [None] + list(binds):
+        engine = db.get_engine(app, bind)
+        if engine.dialect.name == 'sqlite' and app.config.get('SQLITE_PRAGMAS'):
+            event.listen(engine, 'connect', _sqlite_pragmas(app.config['SQLITE_PRAGMAS']))
+        _track_checkouts(engine, bind or 'default')
+        engines[bind or 'default'] = engine
+    app.extensions['database_engines'] = engines
+
+
+def get_engines(app):
+    """
+    Get every engine of the app, by bind name.
+    """
+    return app.extensions['database_engines']
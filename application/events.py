@@ -0,0 +1,347 @@
+"""
+Live dashboard updates :: an in-process pub/sub with per-topic coalescing.
+
+Writers publish small updates (a fund's balance, its vote tallies, changed
+lines) to a topic: a fund identifier, a member (`member_topic`), or
+`BROADCAST` for every subscriber. Bursts are coalesced: updates to the same
+topic and kind are merged into one pending event, and pending events are
+flushed every `EVENTS_COALESCE_INTERVAL` seconds, serialized once per topic
+however many subscribers there are.
+
+Subscribers are the `/dashboard/events` server-sent event streams. They
+only ever wait on an event object, so with the gevent worker (see
+`gunicorn.conf.py`) an idle stream costs a greenlet rather than a thread.
+
+Updates published with a connection are held until its transaction
+commits, and dropped if it rolls back.
+
+The broker lives in one process. Set `EVENTS_URL` to a Redis URL to relay
+updates between processes (the CLI, and every web worker).
+"""
+import itertools
+import json
+import threading
+import time
+from collections import deque
+
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from application.startup import ProcessThread
+
+BROADCAST = None
+
+# `Connection.info` key of the updates waiting for a commit
+PENDING = 'pending_events'
+
+# milliseconds a disconnected browser waits before reconnecting
+RETRY_MS = 3000
+
+
+def member_topic(fund_user_id):
+    """
+    The topic of one member's own updates.
+    """
+    return ('member', fund_user_id)
+
+
+def _merge(pending, data):
+    """
+    Merge an update into a pending one. Nested dicts are merged a level
+    deep, so a burst of per-line updates keeps every line.
+    """
+    for key, value in data.items():
+        if isinstance(value, dict) and isinstance(pending.get(key), dict):
+            pending[key] = {**pending[key], **value}
+        else:
+            pending[key] = value
+
+
+def format_event(event_id, kind, data):
+    """
+    Serialize an update as a server-sent event.
+    """
+    return f'id: {event_id}\nevent: {kind}\ndata: {json.dumps(data, default=str)}\n\n'
+
+
+class Subscription:
+    """
+    One subscriber's outbox of serialized events.
+
+    Parameters
+    ----------
+    topics : iterable
+        The topics to receive, on top of `BROADCAST`.
+    maxsize : int
+        The most events held for a slow reader. Past that, they are
+        replaced by a single `reset` event (the page should reload).
+    """
+
+    def __init__(self, topics, maxsize=64):
+        self.topics = frozenset(topics) | {BROADCAST}
+        self.maxsize = maxsize
+        self._outbox = deque()
+        self._ready = threading.Event()
+
+    def put(self, message):
+        """
+        Queue a serialized event.
+        """
+        if len(self._outbox) >= self.maxsize:
+            self._outbox.clear()
+            message = format_event(0, 'reset', {})
+        self._outbox.append(message)
+        self._ready.set()
+
+    def get(self, timeout=None):
+        """
+        Wait for events, and take every queued one.
+
+        Returns
+        -------
+        list of str
+            The serialized events (empty on timeout).
+        """
+        if not self._ready.wait(timeout):
+            return []
+        self._ready.clear()
+        messages = []
+        while self._outbox:
+            messages.append(self._outbox.popleft())
+        return messages
+
+
+class RedisRelay:
+    """
+    Relays updates between processes over a Redis channel.
+
+    Every process publishes to the channel, and every process with
+    subscribers listens to it (its own updates included). Requires the
+    `redis` package.
+
+    Parameters
+    ----------
+    url : str
+        The Redis URL, i.e. `redis://localhost:6379/0`.
+    channel : str
+        The pub/sub channel.
+    """
+
+    def __init__(self, url, channel='events'):
+        try:
+            import redis
+        except ImportError:
+            raise ImportError('The `redis` package is required to relay events.')
+
+        self.client = redis.Redis.from_url(url)
+        self.channel = channel
+
+    def publish(self, topic, kind, data):
+        """
+        Send an update to every process.
+        """
+        self.client.publish(self.channel, json.dumps([topic, kind, data], default=str))
+
+    def listen(self, callback):
+        """
+        Call `callback(topic, kind, data)` for every relayed update, from
+        a background thread.
+        """
+        def run():
+            pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(self.channel)
+            for message in pubsub.listen():
+                topic, kind, data = json.loads(message['data'])
+                # JSON turned tuple topics into lists
+                callback(tuple(topic) if isinstance(topic, list) else topic, kind, data)
+
+        threading.Thread(target=run, name='events-relay', daemon=True).start()
+
+
+class Broker:
+    """
+    Fans coalesced updates out to subscriptions.
+
+    Parameters
+    ----------
+    interval : float
+        Seconds updates are held (and merged) before they are flushed.
+    maxsize : int
+        The outbox size of each subscription.
+    max_subscribers : int, optional
+        The most subscriptions at once.
+    relay : RedisRelay, optional
+        Relay updates through other processes.
+    """
+
+    def __init__(self, interval=0.25, maxsize=64, max_subscribers=None, relay=None):
+        self.interval = interval
+        self.maxsize = maxsize
+        self.max_subscribers = max_subscribers
+        self.relay = relay
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._subscribers = {}
+        self._count = 0
+        self._ids = itertools.count(1)
+        self._wake = threading.Event()
+        self._flusher = ProcessThread(self._run, 'events-flusher')
+
+    def wanted(self):
+        """
+        Whether a published update can reach anyone.
+        """
+        return self.relay is not None or self._count > 0
+
+    def _start(self):
+        """
+        Start the flusher (and the relay listener) in this process.
+        """
+        if self._flusher.start() and self.relay is not None:
+            self.relay.listen(self._add)
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            # let the burst build up before flushing it
+            time.sleep(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    def publish(self, topic, kind, data):
+        """
+        Publish an update (a dict) of some kind to a topic.
+        """
+        if self.relay is not None:
+            self.relay.publish(topic, kind, data)
+        else:
+            self._add(topic, kind, data)
+
+    def _add(self, topic, kind, data):
+        with self._lock:
+            if topic not in self._subscribers:
+                return
+            _merge(self._pending.setdefault((topic, kind), {}), data)
+        self._wake.set()
+
+    def flush(self):
+        """
+        Send every pending update to its subscribers.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            targets = {topic: list(self._subscribers.get(topic, ()))
+                       for topic, _ in pending}
+
+        for (topic, kind), data in pending.items():
+            message = format_event(next(self._ids), kind, data)
+            for subscription in targets[topic]:
+                subscription.put(message)
+
+    def subscribe(self, topics):
+        """
+        Subscribe to some topics (and `BROADCAST`).
+
+        Returns
+        -------
+        Subscription or None
+            `None` when the broker is full.
+        """
+        self._start()
+        subscription = Subscription(topics, self.maxsize)
+        with self._lock:
+            if self.max_subscribers is not None and self._count >= self.max_subscribers:
+                return None
+            for topic in subscription.topics:
+                self._subscribers.setdefault(topic, set()).add(subscription)
+            self._count += 1
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        Remove a subscription.
+        """
+        with self._lock:
+            for topic in subscription.topics:
+                subscribers = self._subscribers.get(topic)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscribers[topic]
+            self._count -= 1
+
+    def stream(self, subscription, heartbeat=15):
+        """
+        Yield a subscription as a server-sent event stream, with a comment
+        every `heartbeat` seconds so proxies keep the connection open.
+        """
+        try:
+            yield f'retry: {RETRY_MS}\n\n'
+            while True:
+                messages = subscription.get(heartbeat)
+                yield ''.join(messages) if messages else ': keep-alive\n\n'
+        finally:
+            self.unsubscribe(subscription)
+
+
+def init_app(app):
+    """
+    Create the broker from the app configuration.
+    """
+    url = app.config.get('EVENTS_URL')
+    app.extensions['events'] = Broker(
+        interval=app.config.get('EVENTS_COALESCE_INTERVAL', 0.25),
+        maxsize=app.config.get('EVENTS_QUEUE_SIZE', 64),
+        max_subscribers=app.config.get('EVENTS_MAX_SUBSCRIBERS'),
+        relay=RedisRelay(url) if url else None
+    )
+
+
+def get_broker():
+    """
+    Get the broker of the current app.
+    """
+    return current_app.extensions['events']
+
+
+def wanted():
+    """
+    Whether publishing is worth it (so callers can skip building updates).
+    """
+    return has_app_context() and 'events' in current_app.extensions and get_broker().wanted()
+
+
+def publish(topic, kind, data, connection=None):
+    """
+    Publish an update.
+
+    Parameters
+    ----------
+    topic : hashable
+        A fund identifier, a `member_topic` or `BROADCAST`.
+    kind : str
+        The event name, i.e. `balance`.
+    data : dict
+        The update. JSON serializable, after `str` of anything else.
+    connection : sqlalchemy.engine.Connection, optional
+        Hold the update until this connection's transaction commits.
+    """
+    if not wanted():
+        return
+    broker = get_broker()
+    if connection is not None and connection.in_transaction():
+        connection.info.setdefault(PENDING, []).append((broker, topic, kind, data))
+    else:
+        broker.publish(topic, kind, data)
+
+
+@event.listens_for(Engine, 'commit')
+def _commit(connection):
+    for broker, topic, kind, data in connection.info.pop(PENDING, ()):
+        broker.publish(topic, kind, data)
+
+
+@event.listens_for(Engine, 'rollback')
+def _rollback(connection):
+    connection.info.pop(PENDING, None)
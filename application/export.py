@@ -0,0 +1,146 @@
+"""
+Table exports for the admin end point.
+
+Every exportable table is registered with the columns it exposes. Rows
+are read with keyset pagination on the primary key (`WHERE id > :after_id
+ORDER BY id LIMIT :limit`), either one page at a time or streamed as
+NDJSON from a server-side cursor, so memory stays flat regardless of the
+table size.
+"""
+import json
+from datetime import date, datetime
+from decimal import Decimal
+
+from sqlalchemy import select
+
+from application import db
+from application.models import (Fund, FundLedger, FundUser, FundUserLedger,
+                                Investment, Line, LineVote, Result, Strategy,
+                                User, UserLedger)
+from application.money import Money
+
+MAX_LIMIT = 10000
+DEFAULT_LIMIT = 1000
+
+
+class Export:
+    """
+    An exportable table.
+
+    Parameters
+    ----------
+    model : db.Model
+        The model to export.
+    fields : list of 2-tuples, optional
+        `(output name, column name)` pairs. Defaults to every column
+        under its own name.
+    """
+
+    def __init__(self, model, fields=None):
+        self.table = model.__table__
+        self.key = self.table.c.id
+        fields = fields or [(c.name, c.name) for c in self.table.columns]
+        self.names = [name for name, _ in fields]
+        self.columns = [self.table.c[column] for _, column in fields]
+
+        # the output name of the key, which is also the page cursor
+        self.key_name = dict((column, name) for name, column in fields)[self.key.name]
+
+    def parse_key(self, value):
+        """
+        Convert a cursor from the query string to the key's type.
+        """
+        return self.key.type.python_type(value)
+
+    def to_dict(self, row):
+        """
+        Key a row by the output names. Money is exported as an exact
+        decimal string (i.e. `"12.34"`).
+        """
+        return {name: str(value) if isinstance(value, Money) else value
+                for name, value in zip(self.names, row)}
+
+    def query(self, after_id=None, limit=None):
+        """
+        The keyset query for the rows after `after_id`.
+        """
+        query = select(self.columns).order_by(self.key)
+        if after_id is not None:
+            query = query.where(self.key > after_id)
+        if limit is not None:
+            query = query.limit(limit)
+        return query
+
+
+EXPORTS = {
+    'users': Export(User, [
+        ('id', 'id'),
+        ('first', 'first_name'),
+        ('last', 'last_name'),
+        ('email', 'email_address'),
+        ('pass', 'password')
+    ]),
+    'funds': Export(Fund),
+    'fund_users': Export(FundUser),
+    'strategies': Export(Strategy),
+    'lines': Export(Line),
+    'line_votes': Export(LineVote),
+    'investments': Export(Investment),
+    'results': Export(Result),
+    'user_ledgers': Export(UserLedger),
+    'fund_ledgers': Export(FundLedger),
+    'fund_user_ledgers': Export(FundUserLedger),
+}
+
+
+def to_json(value):
+    """
+    JSON encoder fallback for column values.
+    """
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def fetch_page(export, after_id=None, limit=DEFAULT_LIMIT):
+    """
+    Fetch one page of rows.
+
+    Returns
+    -------
+    rows : list of dict
+        The rows, keyed by the export's output names.
+    next_id : optional
+        The cursor for the next page, or `None` if this is the last.
+    """
+    result = db.session.execute(export.query(after_id, limit + 1))
+    rows = [export.to_dict(row) for row in result.fetchall()]
+
+    next_id = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_id = rows[-1][export.key_name]
+    return rows, next_id
+
+
+def stream_ndjson(export, engine=None, after_id=None, chunk_size=DEFAULT_LIMIT):
+    """
+    Stream every row after `after_id` as NDJSON chunks.
+
+    The rows come from a server-side cursor (where the driver has one), so
+    only `chunk_size` rows are held in memory at a time.
+    """
+    engine = engine or db.engine
+    connection = engine.connect().execution_options(stream_results=True)
+    try:
+        result = connection.execute(export.query(after_id))
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield ''.join(json.dumps(export.to_dict(row), default=to_json) + '\n'
+                          for row in rows)
+    finally:
+        connection.close()
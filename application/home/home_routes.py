@@ -1,9 +1,12 @@
 from flask import Blueprint, render_template
 
+from application.page_cache import cached_page
+
 home_bp = Blueprint('home_bp', __name__, template_folder='templates')
 
 
 @home_bp.route('/', methods=['GET', 'POST'])
+@cached_page
 def home():
     """
     Homepage route.
@@ -19,6 +22,7 @@ def home():
 
 
 @home_bp.route('/about', methods=['GET'])
+@cached_page
 def about():
     """
     About page route.
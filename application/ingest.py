@@ -0,0 +1,218 @@
+"""
+Line ingestion :: bulk upserts of betting lines from a feed.
+
+A feed is JSONL, one line per row, either `{"id": ..., "details": {...}}`
+or a flat object whose other keys are the details. Each payload is hashed
+(`Line.details_hash`), so lines that have not changed since the last feed
+are skipped without being written. Changed lines are upserted in batches,
+one transaction per batch, and published to the live dashboards
+(`application.events`) as each batch commits.
+"""
+import json
+import time
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import bindparam, literal_column, select
+
+from application import db, events
+from application.database import MAX_IN_PARAMS
+from application.lines import PROMOTED, details_hash, promoted_values
+from application.models import Line
+
+DEFAULT_BATCH_SIZE = 5000
+
+
+lines = Line.__table__
+
+# every column an update rewrites
+WRITTEN_COLUMNS = ['details', 'details_hash'] + [column for column, _ in PROMOTED.values()]
+
+
+def parse_record(record):
+    """
+    Turn a feed record into a `lines` row.
+    """
+    if 'details' in record:
+        details = record['details']
+    else:
+        details = {k: v for k, v in record.items() if k != 'id'}
+
+    return {
+        'id': str(record['id']),
+        'details': details,
+        'details_hash': details_hash(details),
+        **promoted_values(details)
+    }
+
+
+def read_feed(path):
+    """
+    Yield the records of a JSONL feed, skipping blank lines.
+    """
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def _existing_hashes(connection, ids):
+    """
+    Get the stored hash of every line in `ids` that already exists.
+    """
+    existing = {}
+    for i in range(0, len(ids), MAX_IN_PARAMS):
+        existing.update(connection.execute(
+            select([lines.c.id, lines.c.details_hash])
+            .where(lines.c.id.in_(ids[i:i + MAX_IN_PARAMS]))
+        ).fetchall())
+    return existing
+
+
+def _upsert_postgresql(connection, rows):
+    """
+    Upsert a batch with a single `INSERT ... ON CONFLICT DO UPDATE`.
+
+    Rows whose hash is unchanged are filtered by the `WHERE` of the
+    conflict clause, so they are never rewritten.
+    """
+    from sqlalchemy.dialects.postgresql import insert
+
+    statement = insert(lines).values(rows)
+    statement = statement.on_conflict_do_update(
+        index_elements=[lines.c.id],
+        set_={column: statement.excluded[column] for column in WRITTEN_COLUMNS},
+        where=lines.c.details_hash.is_distinct_from(statement.excluded.details_hash)
+    ).returning(lines.c.id, literal_column('xmax = 0'))
+
+    written = connection.execute(statement).fetchall()
+    return ([line_id for line_id, inserted in written if inserted],
+            [line_id for line_id, inserted in written if not inserted])
+
+
+def _upsert_generic(connection, rows):
+    """
+    Upsert a batch by looking up the stored hashes first, then running
+    one `executemany` for the inserts and one for the updates.
+    """
+    existing = _existing_hashes(connection, [row['id'] for row in rows])
+
+    inserts = [row for row in rows if row['id'] not in existing]
+    updates = [{'line_id': row['id'], **row} for row in rows
+               if row['id'] in existing and existing[row['id']] != row['details_hash']]
+
+    if inserts:
+        connection.execute(lines.insert(), inserts)
+    if updates:
+        connection.execute(
+            lines.update()
+            .where(lines.c.id == bindparam('line_id'))
+            .values({column: bindparam(column, type_=lines.c[column].type)
+                     for column in WRITTEN_COLUMNS}),
+            updates
+        )
+    return [row['id'] for row in inserts], [row['line_id'] for row in updates]
+
+
+def upsert_batch(connection, rows):
+    """
+    Insert new lines and update changed ones.
+
+    Returns
+    -------
+    inserted, updated : list of str
+        The identifiers of the lines written, of each kind.
+    unique : int
+        The lines of the batch: a feed can mention a line more than once,
+        and the last one wins.
+    """
+    rows = list({row['id']: row for row in rows}.values())
+    if connection.dialect.name == 'postgresql':
+        inserted, updated = _upsert_postgresql(connection, rows)
+    else:
+        inserted, updated = _upsert_generic(connection, rows)
+    return inserted, updated, len(rows)
+
+
+def publish_lines(connection, rows, line_ids):
+    """
+    Publish the written lines of a batch to every live dashboard, once
+    the transaction commits.
+    """
+    if not line_ids or not events.wanted():
+        return
+
+    rows = {row['id']: row for row in rows}
+    events.publish(events.BROADCAST, 'lines', {'lines': {
+        line_id: {
+            'status': rows[line_id]['status'],
+            'price': rows[line_id]['details'].get('price'),
+            'starts_at': rows[line_id]['starts_at']
+        }
+        for line_id in line_ids
+    }}, connection)
+
+
+def ingest(records, batch_size=DEFAULT_BATCH_SIZE, engine=None):
+    """
+    Ingest an iterable of feed records.
+
+    Parameters
+    ----------
+    records : iterable of dict
+        Feed records (see `parse_record`).
+    batch_size : int
+        Records per transaction.
+    engine : sqlalchemy.engine.Engine, optional
+        Defaults to the app's engine.
+
+    Returns
+    -------
+    dict
+        Counts of records `read`, `inserted`, `updated` and `unchanged`,
+        and of `duplicates`, records superseded by a later record of the
+        same line in their batch.
+    """
+    engine = engine or db.engine
+    stats = {'read': 0, 'inserted': 0, 'updated': 0, 'unchanged': 0, 'duplicates': 0}
+
+    def flush(batch):
+        with engine.begin() as connection:
+            inserted, updated, unique = upsert_batch(connection, batch)
+            publish_lines(connection, batch, inserted + updated)
+        stats['inserted'] += len(inserted)
+        stats['updated'] += len(updated)
+        stats['unchanged'] += unique - len(inserted) - len(updated)
+        stats['duplicates'] += len(batch) - unique
+
+    batch = []
+    for record in records:
+        batch.append(parse_record(record))
+        if len(batch) == batch_size:
+            flush(batch)
+            stats['read'] += len(batch)
+            batch = []
+    if batch:
+        flush(batch)
+        stats['read'] += len(batch)
+    return stats
+
+
+@click.command('ingest-lines')
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch-size', default=DEFAULT_BATCH_SIZE, show_default=True,
+              help='Records per transaction.')
+@with_appcontext
+def ingest_lines_command(paths, batch_size):
+    """
+    Upsert betting lines from JSONL feed files.
+    """
+    for path in paths:
+        start = time.perf_counter()
+        stats = ingest(read_feed(path), batch_size)
+        elapsed = time.perf_counter() - start
+        click.echo(f"{path}: {stats['read']} read, {stats['inserted']} inserted, "
+                   f"{stats['updated']} updated, {stats['unchanged']} unchanged, "
+                   f"{stats['duplicates']} duplicates "
+                   f"({stats['read'] / max(elapsed, 1e-9):.0f} lines/s)")
@@ -0,0 +1,266 @@
+"""
+SQL instrumentation :: statement counts, DB time and slow queries per route.
+
+Cursor events on the app's engines time every statement. Inside a request
+they are tallied on `g`, and when the request ends the tally is folded
+into per-endpoint aggregates (see `/metrics/sql`):
+
+* the number of statements and the total DB time,
+* the slowest statements, and
+* N+1 patterns: one statement shape (the SQL with literals and `IN`
+  lists collapsed) repeated `SQL_NPLUSONE_THRESHOLD` times or more.
+
+Statements slower than `SQL_SLOW_QUERY_THRESHOLD` seconds go to the
+`application.sql` log, inside a request or not, as do requests that
+issue more than `SQL_SLOW_REQUEST_QUERIES` statements or look like N+1.
+Parameters are never recorded, only statement text.
+"""
+import functools
+import heapq
+import logging
+import re
+import threading
+import time
+
+from flask import current_app, g, has_app_context, has_request_context, request
+from sqlalchemy import event
+
+logger = logging.getLogger('application.sql')
+
+# attribute of a statement's execution context holding its start time,
+# which goes away with the statement even when it fails
+START = '_query_start'
+
+_WHITESPACE = re.compile(r'\s+')
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_PARAMETER_LISTS = re.compile(r'\(\s*(?:\?|%\(\w+\)s|%s|:\w+)(?:\s*,\s*(?:\?|%\(\w+\)s|%s|:\w+))*\s*\)')
+
+
+@functools.lru_cache(maxsize=1024)
+def statement_shape(statement):
+    """
+    Normalize a statement, so repeats with other values (or `IN` lists of
+    another length) compare equal. Statements are compiled once and
+    reused, so the same strings come back and the cache hits.
+    """
+    shape = _WHITESPACE.sub(' ', statement).strip()
+    shape = _LITERALS.sub('?', shape)
+    return _PARAMETER_LISTS.sub('(?)', shape)
+
+
+class RequestStats:
+    """
+    The statements of one request.
+
+    Parameters
+    ----------
+    keep : int
+        How many of the slowest statements to keep.
+    """
+
+    def __init__(self, keep=5):
+        self.keep = keep
+        self.queries = 0
+        self.duration = 0.0
+        self.slowest = []
+        self.shapes = {}
+
+    def add(self, statement, duration):
+        self.queries += 1
+        self.duration += duration
+        shape = statement_shape(statement)
+        self.shapes[shape] = self.shapes.get(shape, 0) + 1
+
+        item = (duration, shape)
+        if len(self.slowest) < self.keep:
+            heapq.heappush(self.slowest, item)
+        elif item > self.slowest[0]:
+            heapq.heapreplace(self.slowest, item)
+
+    def repeated(self, threshold):
+        """
+        Get the statement shapes run at least `threshold` times.
+        """
+        return {shape: count for shape, count in self.shapes.items() if count >= threshold}
+
+
+class EndpointStats:
+    """
+    Running aggregates of the requests to one endpoint.
+    """
+
+    def __init__(self, keep=5):
+        self.keep = keep
+        self.requests = 0
+        self.queries = 0
+        self.max_queries = 0
+        self.duration = 0.0
+        self.nplusone = 0
+        self.slowest = []
+        self.repeated = {}
+
+    def add(self, stats, repeated):
+        self.requests += 1
+        self.queries += stats.queries
+        self.max_queries = max(self.max_queries, stats.queries)
+        self.duration += stats.duration
+        if repeated:
+            self.nplusone += 1
+            for shape, count in repeated.items():
+                self.repeated[shape] = max(self.repeated.get(shape, 0), count)
+
+        for item in stats.slowest:
+            if len(self.slowest) < self.keep:
+                heapq.heappush(self.slowest, item)
+            elif item > self.slowest[0]:
+                heapq.heapreplace(self.slowest, item)
+
+    def to_dict(self):
+        return {
+            'requests': self.requests,
+            'queries': self.queries,
+            'queries_per_request': round(self.queries / max(self.requests, 1), 2),
+            'max_queries': self.max_queries,
+            'db_time': round(self.duration, 6),
+            'db_time_per_request': round(self.duration / max(self.requests, 1), 6),
+            'nplusone_requests': self.nplusone,
+            'repeated_statements': [{'statement': shape, 'count': count} for shape, count
+                                    in sorted(self.repeated.items(), key=lambda item: -item[1])],
+            'slowest': [{'statement': shape, 'duration': round(duration, 6)}
+                        for duration, shape in sorted(self.slowest, reverse=True)]
+        }
+
+
+class Instrumentation:
+    """
+    The per-endpoint aggregates of one app (in this process).
+    """
+
+    def __init__(self, slow_query=0.25, slow_request_queries=50, nplusone=10, keep=5):
+        self.slow_query = slow_query
+        self.slow_request_queries = slow_request_queries
+        self.nplusone = nplusone
+        self.keep = keep
+        self.started = time.time()
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, stats):
+        """
+        Fold a finished request into its endpoint's aggregates.
+        """
+        repeated = stats.repeated(self.nplusone)
+        with self._lock:
+            if endpoint not in self._endpoints:
+                self._endpoints[endpoint] = EndpointStats(self.keep)
+            self._endpoints[endpoint].add(stats, repeated)
+        return repeated
+
+    def snapshot(self):
+        """
+        Get every endpoint's aggregates, most DB time first.
+        """
+        with self._lock:
+            endpoints = {endpoint: stats.to_dict() for endpoint, stats in self._endpoints.items()}
+        return {
+            'since': self.started,
+            'thresholds': {
+                'slow_query': self.slow_query,
+                'slow_request_queries': self.slow_request_queries,
+                'nplusone': self.nplusone
+            },
+            'endpoints': dict(sorted(endpoints.items(), key=lambda item: -item[1]['db_time']))
+        }
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+            self.started = time.time()
+
+
+def _endpoint():
+    return request.endpoint or 'unknown'
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        setattr(context, START, time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, START, None)
+    if started is None:
+        return
+    duration = time.perf_counter() - started
+
+    if not has_request_context():
+        instrumentation = current_app.extensions.get('instrumentation') if has_app_context() else None
+        if instrumentation is not None and duration >= instrumentation.slow_query:
+            logger.warning('Slow query (%.3fs, outside a request): %s', duration, statement_shape(statement))
+        return
+
+    instrumentation = current_app.extensions['instrumentation']
+    stats = g.get('sql_stats')
+    if stats is None:
+        stats = g.sql_stats = RequestStats(instrumentation.keep)
+    stats.add(statement, duration)
+
+    if duration >= instrumentation.slow_query:
+        logger.warning('Slow query (%.3fs) in %s: %s', duration, _endpoint(), statement_shape(statement))
+
+
+def _server_timing(response):
+    """
+    Report the request's DB time so far in a `Server-Timing` header.
+    """
+    stats = g.get('sql_stats')
+    if stats is not None:
+        response.headers.add('Server-Timing', f'db;dur={stats.duration * 1000:.1f};desc="{stats.queries} queries"')
+    return response
+
+
+def _record(exception=None):
+    """
+    Fold the request's statements into its endpoint's aggregates. This
+    runs on teardown, so failed and streamed requests count too.
+    """
+    stats = g.pop('sql_stats', None)
+    if stats is None:
+        return
+
+    instrumentation = current_app.extensions['instrumentation']
+    endpoint = _endpoint()
+    repeated = instrumentation.record(endpoint, stats)
+
+    for shape, count in repeated.items():
+        logger.warning('Possible N+1 in %s: %d x %s', endpoint, count, shape)
+    if stats.queries > instrumentation.slow_request_queries:
+        logger.warning('%s issued %d statements (%.3fs in the database).',
+                       endpoint, stats.queries, stats.duration)
+
+
+def init_app(app, engines):
+    """
+    Instrument some engines, and aggregate their statements per endpoint.
+    """
+    if not app.config.get('SQL_INSTRUMENTATION', True):
+        return
+
+    app.extensions['instrumentation'] = Instrumentation(
+        slow_query=app.config.get('SQL_SLOW_QUERY_THRESHOLD', 0.25),
+        slow_request_queries=app.config.get('SQL_SLOW_REQUEST_QUERIES', 50),
+        nplusone=app.config.get('SQL_NPLUSONE_THRESHOLD', 10),
+        keep=app.config.get('SQL_SLOWEST_KEPT', 5)
+    )
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+    app.after_request(_server_timing)
+    app.teardown_request(_record)
+
+
+def get_instrumentation():
+    """
+    Get the instrumentation of the current app, if enabled.
+    """
+    return current_app.extensions.get('instrumentation')
@@ -0,0 +1,142 @@
+"""
+Promoted `Line.details` keys, and a query helper that uses them.
+
+The hot keys of a line's details are copied into real, indexed columns
+on every write, along with the `details_hash` ingestion compares feeds
+against: by the ORM listeners below, and by the bulk ingestion path
+through `promoted_values`. `line_filters` takes filters on details
+keys and routes each one to its column when the key is promoted, or to a
+JSON extraction otherwise, so callers never need to know which is which.
+"""
+import hashlib
+import json
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import event
+
+from application.models import Line
+
+
+def details_hash(details):
+    """
+    SHA-256 of the canonical JSON of a line's details.
+    """
+    canonical = json.dumps(details, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def parse_datetime(value):
+    """
+    Parse an ISO 8601 string into a naive UTC datetime.
+    """
+    if value is None or isinstance(value, datetime):
+        parsed = value
+    else:
+        parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+
+    if parsed is not None and parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def _string(value):
+    return None if value is None else str(value)
+
+
+# details key -> (column name, converter)
+PROMOTED = {
+    'sport': ('sport', _string),
+    'market_type': ('market_type', _string),
+    'status': ('status', _string),
+    'start_time': ('starts_at', parse_datetime),
+}
+
+OPERATORS = {
+    'eq': lambda column, value: column == value,
+    'ne': lambda column, value: column != value,
+    'lt': lambda column, value: column < value,
+    'lte': lambda column, value: column <= value,
+    'gt': lambda column, value: column > value,
+    'gte': lambda column, value: column >= value,
+    'in': lambda column, value: column.in_(list(value)),
+}
+
+
+def promoted_values(details):
+    """
+    Get the promoted column values of a details payload.
+
+    Keys that are missing, or whose values can't be converted, are
+    stored as NULL rather than failing the write.
+    """
+    values = {}
+    for key, (column, convert) in PROMOTED.items():
+        try:
+            values[column] = convert(details.get(key))
+        except (TypeError, ValueError):
+            values[column] = None
+    return values
+
+
+def _json_value(key, sample):
+    """
+    Extract a details key as SQL, typed after the value it's compared to.
+    """
+    if isinstance(sample, (list, tuple, set)):
+        sample = next(iter(sample), None)
+    if isinstance(sample, bool):
+        return Line.details[key].as_boolean()
+    if isinstance(sample, (int, float)):
+        return Line.details[key].as_float()
+    return Line.details[key].as_string()
+
+
+def line_filters(**criteria):
+    """
+    Build filter conditions on the details of a line.
+
+    Keys are details keys, optionally with an operator suffix
+    (`__ne`, `__lt`, `__lte`, `__gt`, `__gte`, `__in`), i.e.
+
+        Line.query.filter(*line_filters(sport='NBA', status='open',
+                                        start_time__gte=start))
+
+    Promoted keys compare against their indexed column (converted the
+    same way as on write). Anything else falls back to the JSON value.
+    """
+    conditions = []
+    for name, value in criteria.items():
+        key, _, op = name.partition('__')
+        compare = OPERATORS[op or 'eq']
+
+        if key in PROMOTED:
+            column, convert = PROMOTED[key]
+            value = [convert(v) for v in value] if op == 'in' else convert(value)
+            conditions.append(compare(getattr(Line, column), value))
+        else:
+            conditions.append(compare(_json_value(key, value), value))
+    return conditions
+
+
+def open_lines(sport, day):
+    """
+    Query the open lines of a sport that start on a given day.
+
+    An index range scan on `(sport, status, starts_at)`.
+    """
+    start = datetime(day.year, day.month, day.day)
+    return Line.query.filter(*line_filters(
+        sport=sport,
+        status='open',
+        start_time__gte=start,
+        start_time__lt=start + timedelta(days=1)
+    )).order_by(Line.starts_at)
+
+
+@event.listens_for(Line, 'before_insert')
+@event.listens_for(Line, 'before_update')
+def sync_promoted(mapper, connection, target):
+    for column, value in promoted_values(target.details or {}).items():
+        setattr(target, column, value)
+    # or a feed reverting an edit would look unchanged, and be skipped
+    target.details_hash = details_hash(target.details) if target.details is not None else None
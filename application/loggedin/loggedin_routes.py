@@ -1,5 +1,11 @@
-from flask import Blueprint, render_template
-from flask_login import login_required
+from flask import (Blueprint, Response, abort, current_app, jsonify,
+                   render_template, request)
+from flask_login import current_user, login_required
+
+from application import db, events, votes
+from application.balances import user_fund_balances
+from application.models import FundUser
+from application.performance import fund_summaries
 
 loggedin_bp = Blueprint('loggedin_bp', __name__, template_folder='templates')
 
@@ -12,9 +18,71 @@ def dashboard():
 
     TODO :: This will be updated.
     """
+    funds = user_fund_balances(current_user.id)
     return render_template(
         'dashboard.html',
         title='Dashboard',
         template='template main',
-        body="Dashboard"
+        body="Dashboard",
+        funds=funds,
+        performance=fund_summaries([fund.id for fund in funds])
+    )
+
+
+@loggedin_bp.route('/dashboard/events', methods=['GET'])
+@login_required
+def dashboard_events():
+    """
+    Live dashboard updates, as a server-sent event stream: the balances
+    and vote totals of the current user's funds, and changed lines.
+    """
+    topics = []
+    for fund_user_id, fund_id in db.session.query(FundUser.id, FundUser.fund_id) \
+            .filter(FundUser.user_id == current_user.id):
+        topics += [fund_id, events.member_topic(fund_user_id)]
+
+    broker = events.get_broker()
+    subscription = broker.subscribe(topics)
+    if subscription is None:
+        return Response('Too many live connections.', status=503, headers={'Retry-After': '30'})
+
+    # the stream outlives the request, so don't hold a connection for it
+    db.session.remove()
+    return Response(
+        broker.stream(subscription, current_app.config.get('EVENTS_HEARTBEAT', 15)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
     )
+
+
+@loggedin_bp.route('/dashboard/votes', methods=['POST'])
+@login_required
+def submit_votes():
+    """
+    Submit a slate of votes in one of the current user's funds, as JSON:
+    `{"fund_id": 1, "votes": [{"line_id": "...", "units": 2}, ...]}`.
+    Voting on a line again the same day replaces the vote.
+    """
+    try:
+        fund_id, slate = votes.parse_slate(
+            request.get_json(silent=True),
+            max_votes=current_app.config.get('VOTES_MAX_PER_REQUEST', 100),
+            max_units=current_app.config.get('VOTES_MAX_UNITS', 100)
+        )
+        fund_user_id = votes.validate(current_user.id, fund_id, slate)
+    except votes.InvalidVotes as error:
+        return jsonify({'error': str(error)}), 400
+    if fund_user_id is None:
+        abort(404)
+
+    # don't hold a connection while waiting for the writer
+    db.session.close()
+    try:
+        written = votes.submit(fund_user_id, slate)
+    except votes.VotesBusy:
+        return jsonify({'error': 'Too many votes right now, please try again.'}), 503, {'Retry-After': '1'}
+
+    # accepted, and still being written
+    if not written:
+        return jsonify({'fund_id': fund_id, 'votes': len(slate)}), 202
+    return jsonify({'fund_id': fund_id, 'votes': len(slate)})
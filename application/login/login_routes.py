@@ -1,14 +1,16 @@
 from flask import Blueprint, flash, redirect, render_template, request, url_for
 
-from application import login_manager
 from application.forms import LogInForm
-from application.models import User
+from application.models import User, db
+from application.passwords import HashingBusy
+from application.ratelimit import rate_limited
 from flask_login import current_user, login_required, login_user, logout_user
 
 login_bp = Blueprint('login_bp', __name__, template_folder='templates')
 
 
 @login_bp.route('/login', methods=['GET', 'POST'])
+@rate_limited('login')
 def login():
     """
     End point for login page.
@@ -31,9 +33,20 @@ def login():
 
             # if the password is correct, the log the user in and
             # redirect them to the dashboard
-            if user and user.check_password(password=password):
-                login_user(user)
-                return redirect(url_for('loggedin_bp.dashboard'))
+            try:
+                if user and user.check_password(password=password):
+
+                    # upgrade hashes made with an old profile while
+                    # we have the plain text password
+                    if user.password_needs_rehash():
+                        user.set_password(password)
+                        db.session.commit()
+
+                    login_user(user)
+                    return redirect(url_for('loggedin_bp.dashboard'))
+            except HashingBusy:
+                flash('We are experiencing heavy traffic, please try again.')
+                return redirect(url_for('login_bp.login'))
 
         # otherwise, tell them the password is invalid
         # and send them back to the login page to try again
@@ -58,12 +71,3 @@ def logout():
     logout_user()
     return redirect(url_for('login_bp.login'))
 
-
-@login_manager.user_loader
-def load_user(user_id):
-    """
-    Check if user is logged-in on every page load.
-    """
-    if user_id is not None:
-        return User.query.get(user_id)
-    return None
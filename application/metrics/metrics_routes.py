@@ -0,0 +1,57 @@
+import hmac
+
+from flask import Blueprint, Response, abort, current_app, jsonify, request
+from flask_login import login_required
+
+from application.instrumentation import get_instrumentation
+from application.telemetry import CONTENT_TYPE
+
+metrics_bp = Blueprint('metrics_bp', __name__)
+
+
+def _check_token():
+    """
+    Refuse requests without the `METRICS_TOKEN` bearer token, if one is
+    configured, and every request when a token is required but missing.
+    """
+    token = current_app.config.get('METRICS_TOKEN')
+    if not token:
+        if current_app.config.get('METRICS_REQUIRE_TOKEN'):
+            abort(404)
+        return
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        abort(401)
+
+
+@metrics_bp.route('/metrics/sql', methods=['GET', 'DELETE'])
+@login_required
+def sql():
+    """
+    SQL statement counts, DB time, N+1 patterns and the slowest statements
+    of every endpoint (in this process). `DELETE` resets them. Both need
+    the metrics token, like `/metrics`.
+    """
+    instrumentation = get_instrumentation()
+    if instrumentation is None:
+        abort(404)
+
+    _check_token()
+    if request.method == 'DELETE':
+        instrumentation.reset()
+    return jsonify(instrumentation.snapshot())
+
+
+@metrics_bp.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Request metrics of every worker, in the Prometheus text format.
+
+    Scrapers authenticate with `Authorization: Bearer <METRICS_TOKEN>`
+    when a token is configured. Production requires one.
+    """
+    registry = current_app.extensions.get('telemetry')
+    if registry is None:
+        abort(404)
+
+    _check_token()
+    return Response(registry.exposition(), content_type=CONTENT_TYPE)
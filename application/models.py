@@ -1,8 +1,10 @@
+from datetime import datetime
+
 from flask_login import UserMixin
 from sqlalchemy.sql import func
-from werkzeug.security import check_password_hash, generate_password_hash
 
-from application import db
+from application import db, passwords
+from application.money import MoneyType
 
 
 class User(UserMixin, db.Model):
@@ -28,6 +30,9 @@ class User(UserMixin, db.Model):
     """
 
     __tablename__ = "users"
+    __table_args__ = (
+        db.Index('ix_users_email_address', 'email_address'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     first_name = db.Column(db.String(256), nullable=False)
@@ -42,13 +47,19 @@ class User(UserMixin, db.Model):
         """
         Create hashed password.
         """
-        self.password = generate_password_hash(password, method="sha256")
+        self.password = passwords.hash_password(password)
 
     def check_password(self, password):
         """
         Check hashed password.
         """
-        return check_password_hash(self.password, password)
+        return passwords.check_password(self.password, password)
+
+    def password_needs_rehash(self):
+        """
+        Was the password hashed with an outdated profile?
+        """
+        return passwords.needs_rehash(self.password)
 
     def __repr__(self):
         return f"<User `{self.id}`>"
@@ -64,17 +75,24 @@ class UserLedger(db.Model):
         The primary key and user identifier.
     user_id : int
         The user identifier.
-    amount : float
+    amount : Money
         Transaction value.
     timestamp : datetime
         Timestamp of transaction.
+    is_opening : bool
+        Is this an opening balance, carried forward from the periods that
+        were rolled up (see `application.partitions`)?
     """
 
     __tablename__ = "user_ledgers"
+    __table_args__ = (
+        db.Index('ix_user_ledgers_user_id_timestamp', 'user_id', 'timestamp', 'amount'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
-    amount = db.Column(db.Float, nullable=False)
+    amount = db.Column(MoneyType, nullable=False)
     timestamp = db.Column(db.DateTime(timezone=True), default=func.now())
+    is_opening = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
 
     # relationships
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
@@ -104,6 +122,7 @@ class FundUser(db.Model):
     __tablename__ = "fund_users"
     __table_args__ = (
         db.UniqueConstraint('fund_id', 'user_id', name='unique_idx_fund_id_user_id'),
+        db.Index('ix_fund_users_user_id', 'user_id'),
     )
 
     id = db.Column(db.Integer, primary_key=True)
@@ -126,17 +145,47 @@ class Line(db.Model):
         The primary key and line identifier.
     details : dict
         All metadata around an event betting line.
+    details_hash : str
+        SHA-256 of the canonical `details` JSON, used by ingestion to
+        skip lines that have not changed.
+    sport : str
+        Copy of `details["sport"]`.
+    market_type : str
+        Copy of `details["market_type"]`.
+    status : str
+        Copy of `details["status"]`.
+    starts_at : datetime
+        Copy of `details["start_time"]`, in UTC.
+
+    The copied fields are filled from `details` on every write (see
+    `application.lines`) so they can be indexed.
     """
 
     __tablename__ = "lines"
+    __table_args__ = (
+        db.Index('ix_lines_sport_status_starts_at', 'sport', 'status', 'starts_at'),
+        db.Index('ix_lines_starts_at', 'starts_at'),
+    )
 
     id = db.Column(db.String(64), primary_key=True)
     details = db.Column(db.JSON, nullable=False)
+    details_hash = db.Column(db.String(64), nullable=True)
+
+    # promoted from `details`
+    sport = db.Column(db.String(32), nullable=True)
+    market_type = db.Column(db.String(32), nullable=True)
+    status = db.Column(db.String(16), nullable=True)
+    starts_at = db.Column(db.DateTime(timezone=True), nullable=True)
 
     def __repr__(self):
         return f"<Line `{self.id}`>"
 
 
+def _vote_day(context):
+    timestamp = context.get_current_parameters().get('timestamp')
+    return (timestamp or datetime.utcnow()).date()
+
+
 class LineVote(db.Model):
     """
     SQLAlchemy object :: `line_votes` table.
@@ -156,13 +205,22 @@ class LineVote(db.Model):
         Weight of vote.
     timestamp : datetime
         Timestamp of vote.
+    vote_day : date
+        The day of `timestamp` (or of the write, without one). A fund user
+        has one vote per line and day.
     """
 
     __tablename__ = "line_votes"
+    __table_args__ = (
+        db.Index('ix_line_votes_line_id_fund_user_id', 'line_id', 'fund_user_id'),
+        db.Index('ix_line_votes_timestamp', 'timestamp', 'fund_user_id', 'line_id', 'units'),
+        db.Index('uq_line_votes_fund_user_id_line_id_vote_day', 'fund_user_id', 'line_id', 'vote_day', unique=True),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     units = db.Column(db.Integer, nullable=True)
     timestamp = db.Column(db.DateTime(timezone=True), nullable=True)
+    vote_day = db.Column(db.Date, nullable=False, default=_vote_day)
 
     # relationships
     line_id = db.Column(db.String(64), db.ForeignKey("lines.id"), nullable=False)
@@ -182,17 +240,24 @@ class FundUserLedger(db.Model):
         The primary key and fund user ledger identifier.
     fund_user_id : int
         The fund user identifier.
-    amount : float
+    amount : Money
         Transaction value.
     timestamp : datetime
         Timestamp of transaction.
+    is_opening : bool
+        Is this an opening balance, carried forward from the periods that
+        were rolled up (see `application.partitions`)?
     """
 
     __tablename__ = "fund_user_ledgers"
+    __table_args__ = (
+        db.Index('ix_fund_user_ledgers_fund_user_id_timestamp', 'fund_user_id', 'timestamp', 'amount'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
-    amount = db.Column(db.Float, nullable=False)
+    amount = db.Column(MoneyType, nullable=False)
     timestamp = db.Column(db.DateTime(timezone=True), default=func.now())
+    is_opening = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
 
     # relationships
     fund_user_id = db.Column(db.Integer, db.ForeignKey("fund_users.id"), nullable=False)
@@ -211,17 +276,24 @@ class FundLedger(db.Model):
         The primary key and fund ledger identifier.
     fund_id : int
         The fund identifier.
-    amount : float
+    amount : Money
         Transaction value.
     timestamp : datetime
         Timestamp of transaction.
+    is_opening : bool
+        Is this an opening balance, carried forward from the periods that
+        were rolled up (see `application.partitions`)?
     """
 
     __tablename__ = "fund_ledgers"
+    __table_args__ = (
+        db.Index('ix_fund_ledgers_fund_id_timestamp', 'fund_id', 'timestamp', 'amount'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
-    amount = db.Column(db.Float, nullable=False)
+    amount = db.Column(MoneyType, nullable=False)
     timestamp = db.Column(db.DateTime(timezone=True), default=func.now())
+    is_opening = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
 
     # relationships
     fund_id = db.Column(db.Integer, db.ForeignKey("funds.id"), nullable=False)
@@ -230,6 +302,180 @@ class FundLedger(db.Model):
         return f"<FundLedger `{self.id}`>"
 
 
+class LedgerPeriod(db.Model):
+    """
+    SQLAlchemy object :: `ledger_periods` table.
+
+    A closed month of a ledger, rolled up out of the live table into its
+    own cold table (see `application.partitions`).
+
+    Fields
+    ------
+    id : int
+        The primary key and period identifier.
+    ledger : str
+        The ledger table, i.e. `fund_ledgers`.
+    table_name : str
+        The cold table holding the rows of the period.
+    period_start, period_end : datetime
+        The period, `[period_start, period_end)`.
+    row_count : int
+        The number of rows in the period.
+    path : str
+        Where the period was archived to, if it was.
+    is_dropped : bool
+        Were the rows of the cold table rolled up to one per owner after
+        archiving?
+    """
+
+    __tablename__ = "ledger_periods"
+    __table_args__ = (
+        db.UniqueConstraint('ledger', 'period_start', name='unique_idx_ledger_period_start'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    ledger = db.Column(db.String(32), nullable=False)
+    table_name = db.Column(db.String(64), nullable=False)
+    period_start = db.Column(db.DateTime(timezone=True), nullable=False)
+    period_end = db.Column(db.DateTime(timezone=True), nullable=False)
+    row_count = db.Column(db.Integer, nullable=False)
+    path = db.Column(db.String(256), nullable=True)
+    is_dropped = db.Column(db.Boolean, nullable=False, default=False)
+
+    def __repr__(self):
+        return f"<LedgerPeriod `{self.table_name}`>"
+
+
+class FundUserBalance(db.Model):
+    """
+    SQLAlchemy object :: `fund_user_balances` table.
+
+    Running balance for a fund user. Maintained incrementally every time a
+    row is written to `fund_user_ledgers` (see `application.balances`).
+
+    Fields
+    ------
+    fund_user_id : int
+        The primary key and fund user identifier.
+    balance : Money
+        Sum of every ledger row applied so far.
+    ledger_id : int
+        The last `fund_user_ledgers` row applied to the balance.
+    modified_on : datetime
+        When was the balance last updated.
+    """
+
+    __tablename__ = "fund_user_balances"
+
+    fund_user_id = db.Column(db.Integer, db.ForeignKey("fund_users.id"), primary_key=True)
+    balance = db.Column(MoneyType, nullable=False, default=0)
+    ledger_id = db.Column(db.Integer, nullable=True)
+    modified_on = db.Column(db.DateTime(timezone=True), default=func.now())
+
+    def __repr__(self):
+        return f"<FundUserBalance `{self.fund_user_id}`>"
+
+
+class FundUserBalanceSnapshot(db.Model):
+    """
+    SQLAlchemy object :: `fund_user_balance_snapshots` table.
+
+    Balance of a fund user as of a point in time. Includes every ledger row
+    with a timestamp at or before `timestamp`.
+
+    Fields
+    ------
+    id : int
+        The primary key and snapshot identifier.
+    fund_user_id : int
+        The fund user identifier.
+    balance : Money
+        The balance as of `timestamp`.
+    timestamp : datetime
+        Point in time the snapshot was taken for.
+    """
+
+    __tablename__ = "fund_user_balance_snapshots"
+    __table_args__ = (
+        db.UniqueConstraint('fund_user_id', 'timestamp', name='unique_idx_fund_user_id_timestamp'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    balance = db.Column(MoneyType, nullable=False)
+    timestamp = db.Column(db.DateTime(timezone=True), nullable=False)
+
+    # relationships
+    fund_user_id = db.Column(db.Integer, db.ForeignKey("fund_users.id"), nullable=False)
+
+    def __repr__(self):
+        return f"<FundUserBalanceSnapshot `{self.id}`>"
+
+
+class FundBalance(db.Model):
+    """
+    SQLAlchemy object :: `fund_balances` table.
+
+    Running balance for a fund. Maintained incrementally every time a
+    row is written to `fund_ledgers` (see `application.balances`).
+
+    Fields
+    ------
+    fund_id : int
+        The primary key and fund identifier.
+    balance : Money
+        Sum of every ledger row applied so far.
+    ledger_id : int
+        The last `fund_ledgers` row applied to the balance.
+    modified_on : datetime
+        When was the balance last updated.
+    """
+
+    __tablename__ = "fund_balances"
+
+    fund_id = db.Column(db.Integer, db.ForeignKey("funds.id"), primary_key=True)
+    balance = db.Column(MoneyType, nullable=False, default=0)
+    ledger_id = db.Column(db.Integer, nullable=True)
+    modified_on = db.Column(db.DateTime(timezone=True), default=func.now())
+
+    def __repr__(self):
+        return f"<FundBalance `{self.fund_id}`>"
+
+
+class FundBalanceSnapshot(db.Model):
+    """
+    SQLAlchemy object :: `fund_balance_snapshots` table.
+
+    Balance of a fund as of a point in time. Includes every ledger row
+    with a timestamp at or before `timestamp`.
+
+    Fields
+    ------
+    id : int
+        The primary key and snapshot identifier.
+    fund_id : int
+        The fund identifier.
+    balance : Money
+        The balance as of `timestamp`.
+    timestamp : datetime
+        Point in time the snapshot was taken for.
+    """
+
+    __tablename__ = "fund_balance_snapshots"
+    __table_args__ = (
+        db.UniqueConstraint('fund_id', 'timestamp', name='unique_idx_fund_id_timestamp'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    balance = db.Column(MoneyType, nullable=False)
+    timestamp = db.Column(db.DateTime(timezone=True), nullable=False)
+
+    # relationships
+    fund_id = db.Column(db.Integer, db.ForeignKey("funds.id"), nullable=False)
+
+    def __repr__(self):
+        return f"<FundBalanceSnapshot `{self.id}`>"
+
+
 class Fund(db.Model):
     """
     SQLAlchemy object :: `funds` table.
@@ -294,16 +540,19 @@ class Investment(db.Model):
         The fund identifier.
     line_id : str
         The line identifier.
-    amount : float
+    amount : Money
         Transaction value.
     timestamp : datetime
         Timestamp of transaction.
     """
 
     __tablename__ = "investments"
+    __table_args__ = (
+        db.Index('ix_investments_fund_id_timestamp', 'fund_id', 'timestamp'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
-    amount = db.Column(db.Float, nullable=False)
+    amount = db.Column(MoneyType, nullable=False)
     timestamp = db.Column(db.DateTime(timezone=True), default=func.now())
 
     # relationships
@@ -324,16 +573,19 @@ class Result(db.Model):
         The primary key and result identifier.
     investment_id : int
         The investment identifier.
-    amount : float
+    amount : Money
         Transaction value.
     is_win : bool
         Did the bet win?
     """
 
     __tablename__ = "results"
+    __table_args__ = (
+        db.Index('ix_results_investment_id', 'investment_id', unique=True),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
-    amount = db.Column(db.Float, nullable=False)
+    amount = db.Column(MoneyType, nullable=False)
     is_win = db.Column(db.Boolean, nullable=False)
 
     # relationships
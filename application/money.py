@@ -0,0 +1,185 @@
+"""
+Fixed-point money.
+
+Amounts are stored as integer cents (`BIGINT`), so sums in the database
+are exact and bulk ledger math can use NumPy `int64` arrays. In Python
+they are `Money` values.
+
+Where money crosses a boundary, say which unit it is in:
+
+* `cents` takes a `Money` or an integer number of **cents** (what the
+  database and NumPy hold), and refuses anything else,
+* `dollars_to_cents` takes an amount in **dollars** (`Decimal`, `str`,
+  `int` or `float`, as user input and JSON hold it), rounded half up to
+  the cent.
+"""
+from decimal import ROUND_HALF_UP, Decimal
+
+from sqlalchemy import func
+from sqlalchemy.types import BigInteger, TypeDecorator
+
+CENT = Decimal('0.01')
+
+
+def cents(value):
+    """
+    The cents of a `Money`, or of an integer number of cents.
+    """
+    if isinstance(value, Money):
+        return value.cents
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if hasattr(value, 'dtype') and value.dtype.kind in 'iu':
+        return int(value)
+    raise TypeError(f'Expected Money or integer cents, not {type(value).__name__}.')
+
+
+def dollars_to_cents(value):
+    """
+    The cents of an amount in dollars, rounded half up to the cent.
+    """
+    if isinstance(value, (Money, bool)):
+        raise TypeError(f'Expected an amount in dollars, not {type(value).__name__}.')
+    dollars = Decimal(str(value)).quantize(CENT, rounding=ROUND_HALF_UP)
+    return int(dollars * 100)
+
+
+class Money:
+    """
+    An exact amount of money, in cents.
+
+    Parameters
+    ----------
+    cents : int
+        The amount, in cents.
+    """
+
+    __slots__ = ('cents',)
+
+    def __init__(self, cents=0):
+        self.cents = int(cents)
+
+    @classmethod
+    def from_decimal(cls, value):
+        """
+        Create from an amount in dollars, i.e. `Money.from_decimal('12.34')`.
+        """
+        return cls(dollars_to_cents(value))
+
+    def to_decimal(self):
+        """
+        The amount in dollars.
+        """
+        return Decimal(self.cents) / 100
+
+    def __add__(self, other):
+        if isinstance(other, Money):
+            return Money(self.cents + other.cents)
+        if other == 0:
+            return self
+        return NotImplemented
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        if isinstance(other, Money):
+            return Money(self.cents - other.cents)
+        if other == 0:
+            return self
+        return NotImplemented
+
+    def __rsub__(self, other):
+        if other == 0:
+            return -self
+        return NotImplemented
+
+    def __neg__(self):
+        return Money(-self.cents)
+
+    def __abs__(self):
+        return Money(abs(self.cents))
+
+    def __mul__(self, factor):
+        """
+        Scale by a number, rounding half up to the cent.
+        """
+        if isinstance(factor, Money):
+            return NotImplemented
+        product = Decimal(self.cents) * Decimal(str(factor))
+        return Money(int(product.quantize(Decimal(1), rounding=ROUND_HALF_UP)))
+
+    __rmul__ = __mul__
+
+    def _cents_of(self, other):
+        if isinstance(other, Money):
+            return other.cents
+        if other == 0:
+            return 0
+        raise TypeError(f'Cannot compare Money with {type(other).__name__}.')
+
+    def __eq__(self, other):
+        if isinstance(other, Money):
+            return self.cents == other.cents
+        if isinstance(other, (int, float, Decimal)) and other == 0:
+            return self.cents == 0
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.cents)
+
+    def __lt__(self, other):
+        return self.cents < self._cents_of(other)
+
+    def __le__(self, other):
+        return self.cents <= self._cents_of(other)
+
+    def __gt__(self, other):
+        return self.cents > self._cents_of(other)
+
+    def __ge__(self, other):
+        return self.cents >= self._cents_of(other)
+
+    def __bool__(self):
+        return self.cents != 0
+
+    def __int__(self):
+        return self.cents
+
+    def __float__(self):
+        return self.cents / 100
+
+    def __str__(self):
+        sign = '-' if self.cents < 0 else ''
+        dollars, cents = divmod(abs(self.cents), 100)
+        return f'{sign}{dollars}.{cents:02d}'
+
+    def __repr__(self):
+        return f"Money('{self}')"
+
+
+class MoneyType(TypeDecorator):
+    """
+    SQLAlchemy type storing `Money` as integer cents.
+
+    Binds `Money` or integer cents, and always loads `Money`. Convert
+    amounts in dollars with `dollars_to_cents` first.
+    """
+
+    impl = BigInteger
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return cents(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return Money(value)
+
+
+def money_sum(column):
+    """
+    An exact SQL `SUM` of a money column, `Money(0)` when there are no rows.
+    """
+    return func.coalesce(func.sum(column), 0, type_=MoneyType)
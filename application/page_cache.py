@@ -0,0 +1,208 @@
+"""
+Page caching :: rendered public pages, template fragments and compiled
+templates.
+
+* `cached_page` keeps the rendered response of a view for anonymous `GET`s,
+  keyed by the URL and a version of the templates, and serves it with an
+  `ETag`, `Last-Modified` and a public `Cache-Control`, so browsers and the
+  CDN can revalidate with a `304`. Logged-in users get a fresh render,
+  still with an `ETag` but private.
+* `{% cache 'name', key... %}...{% endcache %}` in a template keeps a
+  rendered fragment (the shared navigation and meta partials), for
+  logged-in pages too.
+* Compiled templates are kept on disk (`TEMPLATE_CACHE_DIR`), so restarted
+  workers skip compiling them again.
+
+Entries are kept in-process, or in Redis with `PAGE_CACHE_URL`. Pages and
+fragments aren't cached in debug mode, where templates reload on change.
+"""
+import functools
+import hashlib
+import os
+from datetime import datetime
+
+from flask import (Response, current_app, has_request_context, make_response,
+                   request, session)
+from flask_login import current_user
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+from werkzeug.http import generate_etag
+
+from application.cache import make_cache
+
+# settings that change the URLs in rendered pages
+URL_SETTINGS = ('APPLICATION_ROOT', 'PREFERRED_URL_SCHEME', 'SERVER_NAME')
+
+
+def template_version(app):
+    """
+    A hash of the settings URLs are built with, of the static asset build
+    (pages link its fingerprinted names) and of every template's source,
+    so a deploy that changes them misses entries cached by the previous
+    release.
+    """
+    digest = hashlib.sha1(repr([app.config.get(name) for name in URL_SETTINGS]).encode())
+    assets = app.extensions.get('assets')
+    digest.update(repr(assets.version if assets is not None else None).encode())
+    loader = app.jinja_env.loader
+    for name in sorted(app.jinja_env.list_templates()):
+        source, _, _ = loader.get_source(app.jinja_env, name)
+        digest.update(name.encode())
+        digest.update(source.encode())
+    return digest.hexdigest()[:12]
+
+
+class PageCache:
+    """
+    Rendered pages and fragments, under a template version.
+
+    Parameters
+    ----------
+    app : flask.Flask
+        The app, for its templates.
+    cache : LRUCache or RedisCache
+        Where entries are kept.
+    max_age : int
+        Seconds browsers and the CDN may reuse a page without asking.
+    """
+
+    def __init__(self, app, cache, max_age=60):
+        self.app = app
+        self.cache = cache
+        self.max_age = max_age
+        self._version = None
+
+    @property
+    def version(self):
+        # computed on first use, by when the templates of anything cached
+        # are registered (even with lazy blueprints)
+        if self._version is None:
+            self._version = template_version(self.app)
+        return self._version
+
+    def key(self, kind, *parts):
+        return ':'.join([kind, self.version, *map(str, parts)])
+
+    def get(self, kind, *parts):
+        return self.cache.get(self.key(kind, *parts))
+
+    def set(self, kind, value, *parts):
+        self.cache.set(self.key(kind, *parts), value)
+
+
+def get_page_cache():
+    """
+    Get the page cache of the current app, if enabled.
+    """
+    return current_app.extensions.get('page_cache')
+
+
+def _cacheable_request():
+    # flashed messages are shown once, to one visitor
+    return request.method in ('GET', 'HEAD') and not current_user.is_authenticated \
+        and '_flashes' not in session
+
+
+def _conditional(response, etag, last_modified, public, max_age):
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    if public:
+        # shared caches must not serve it to visitors with a session
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+        response.vary.add('Cookie')
+    else:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def cached_page(view):
+    """
+    Cache a view's page for anonymous visitors, and answer conditional
+    requests with a `304`.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        cache = get_page_cache()
+        if cache is None or not _cacheable_request():
+            response = make_response(view(*args, **kwargs))
+            if request.method in ('GET', 'HEAD') and response.status_code == 200 and cache is not None:
+                return _conditional(response, generate_etag(response.get_data()),
+                                    datetime.utcnow(), public=False, max_age=0)
+            return response
+
+        url = request.script_root + request.full_path
+        entry = cache.get('page', url)
+        if entry is None:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200 or response.headers.get('Set-Cookie'):
+                return response
+            body = response.get_data()
+            entry = {
+                'body': body,
+                'mimetype': response.mimetype,
+                'etag': generate_etag(body),
+                'last_modified': datetime.utcnow().replace(microsecond=0)
+            }
+            cache.set('page', entry, url)
+
+        response = Response(entry['body'], mimetype=entry['mimetype'])
+        return _conditional(response, entry['etag'], entry['last_modified'],
+                            public=True, max_age=cache.max_age)
+    return wrapper
+
+
+class FragmentCacheExtension(Extension):
+    """
+    `{% cache 'name', key... %}...{% endcache %}`: render the block once
+    per name and keys, and reuse it.
+    """
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        parts = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            parts.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render', [nodes.List(parts)]), [], [], body) \
+            .set_lineno(lineno)
+
+    def _render(self, parts, caller):
+        cache = get_page_cache() if has_request_context() else None
+        if cache is None:
+            return caller()
+
+        # URLs in the fragment depend on where the app is mounted
+        parts = [request.script_root, *parts]
+        fragment = cache.get('fragment', *parts)
+        if fragment is None:
+            fragment = caller()
+            cache.set('fragment', fragment, *parts)
+        return fragment
+
+
+def init_app(app):
+    """
+    Set up the page and fragment cache, and the compiled template cache,
+    from the app configuration.
+    """
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    if app.config.get('TEMPLATE_BYTECODE_CACHE', True):
+        directory = app.config.get('TEMPLATE_CACHE_DIR')
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+
+    if app.config.get('PAGE_CACHE_ENABLED', True) and not app.debug:
+        app.extensions['page_cache'] = PageCache(
+            app,
+            make_cache(
+                app.config.get('PAGE_CACHE_URL'),
+                namespace='pages',
+                maxsize=app.config.get('PAGE_CACHE_SIZE', 256),
+                ttl=app.config.get('PAGE_CACHE_TTL', 300)
+            ),
+            max_age=app.config.get('PAGE_CACHE_MAX_AGE', 60)
+        )
@@ -0,0 +1,421 @@
+"""
+Monthly ledger partitions.
+
+The ledgers (`user_ledgers`, `fund_ledgers`, `fund_user_ledgers`) only
+ever grow, but almost every query is about recent activity, so they are
+split by month:
+
+* On Postgres the ledgers are natively partitioned by `RANGE (timestamp)`,
+  one `<ledger>_pYYYYMM` partition per month (`flask partitions ensure`
+  creates the upcoming ones), so a query on a time range is pruned to the
+  partitions it needs.
+* Elsewhere (SQLite) the ledger table itself is the live partition, and
+  closed months are moved out into their own `<ledger>_pYYYYMM` tables.
+
+Rolling up (`flask partitions roll-up`) closes every month before the
+current one. Each owner's balance at the end of the month is carried
+forward as a single opening-balance row (`is_opening`), and the month's
+rows leave the live table (a detached partition on Postgres, a moved
+copy otherwise). The live table still sums to every balance, so the
+running balances are unaffected, while only holding the current period.
+
+The full history is the `<ledger>_all` view: the live rows (without the
+opening balances) `UNION ALL` the cold tables. Cold periods can be
+archived (`flask partitions archive`) to compressed columnar `.npz`
+files, and then dropped: the cold table then keeps a single roll-up row
+per owner (the period's sum, at the owner's last timestamp in it), so
+the history still sums to every balance.
+"""
+import os
+from datetime import datetime
+
+import click
+import numpy as np
+from flask.cli import AppGroup
+from sqlalchemy import (BigInteger, Column, Index, MetaData, Table, and_,
+                        column, func, literal, or_, select, table, text, true,
+                        type_coerce, union_all)
+
+from application import db
+from application.lines import parse_datetime
+from application.models import (FundLedger, FundUserLedger, LedgerPeriod,
+                                UserLedger)
+
+# months of partitions to keep created ahead of time on Postgres
+MONTHS_AHEAD = 2
+
+ARCHIVE_CHUNK_SIZE = 10000
+
+ledger_periods = LedgerPeriod.__table__
+
+
+def month_start(when):
+    """
+    The start of the month `when` is in.
+    """
+    return datetime(when.year, when.month, 1)
+
+
+def next_month(start):
+    """
+    The start of the month after `start`.
+    """
+    if start.month == 12:
+        return datetime(start.year + 1, 1, 1)
+    return datetime(start.year, start.month + 1, 1)
+
+
+class PartitionedLedger:
+    """
+    A ledger table split into monthly periods.
+
+    Parameters
+    ----------
+    model : db.Model
+        The ledger model.
+    owner : str
+        The name of the owner column.
+    """
+
+    def __init__(self, model, owner):
+        self.table = model.__table__
+        self.name = self.table.name
+        self.owner = owner
+
+        # the history columns, i.e. everything but the opening balance flag
+        self.columns = [c for c in self.table.columns if c.name != 'is_opening']
+        self.view = table(f'{self.name}_all', *[column(c.name, c.type) for c in self.columns])
+
+    def period_name(self, start):
+        """
+        The name of the partition (or cold table) of a month.
+        """
+        return f'{self.name}_p{start:%Y%m}'
+
+    def cold_table(self, name):
+        """
+        A standalone table with the history columns of the ledger.
+        """
+        cold = Table(name, MetaData(), *[
+            Column(c.name, c.type, primary_key=c.primary_key, nullable=c.nullable)
+            for c in self.columns
+        ])
+        Index(f'ix_{name}_{self.owner}_timestamp', cold.c[self.owner], cold.c.timestamp, cold.c.amount)
+        return cold
+
+    def live(self):
+        """
+        The real rows of the live table, without the opening balances.
+        """
+        return select(self.columns).where(~self.table.c.is_opening)
+
+
+LEDGERS = {ledger.name: ledger for ledger in (
+    PartitionedLedger(UserLedger, 'user_id'),
+    PartitionedLedger(FundLedger, 'fund_id'),
+    PartitionedLedger(FundUserLedger, 'fund_user_id'),
+)}
+
+
+def get_periods(ledger, connection=None):
+    """
+    Get the rolled up periods of a ledger, oldest first.
+    """
+    connection = connection or db.session.connection()
+    return connection.execute(
+        select([ledger_periods])
+        .where(ledger_periods.c.ledger == ledger.name)
+        .order_by(ledger_periods.c.period_start)
+    ).fetchall()
+
+
+def live_since(ledger, connection=None):
+    """
+    When the live period of a ledger starts, i.e. the end of the last
+    period that was rolled up, or `None` if none was.
+    """
+    connection = connection or db.session.connection()
+    return connection.execute(
+        select([func.max(ledger_periods.c.period_end)])
+        .where(ledger_periods.c.ledger == ledger.name)
+    ).scalar()
+
+
+def history(ledger, since=None, connection=None):
+    """
+    The real rows of a ledger (opening balances excluded), as a selectable.
+
+    Reads the live table alone when every row after `since` is still in
+    it, and the `<ledger>_all` view otherwise. Periods that were archived
+    and dropped are there as one roll-up row per owner, so sums are
+    exact from each owner's last row in the period on.
+    """
+    boundary = live_since(ledger, connection)
+    if boundary is None or (since is not None and since >= boundary):
+        return ledger.live().alias(f'{ledger.name}_live')
+    return ledger.view
+
+
+def refresh_view(ledger, connection=None):
+    """
+    (Re)create the `<ledger>_all` view over the live and cold tables.
+    """
+    connection = connection or db.session.connection()
+    names = [period.table_name for period in get_periods(ledger, connection)]
+
+    query = ledger.live()
+    if names:
+        colds = [ledger.cold_table(name) for name in names]
+        query = union_all(query, *[select([cold.c[c.name] for c in ledger.columns])
+                                   for cold in colds])
+
+    sql = query.compile(dialect=connection.dialect, compile_kwargs={'literal_binds': True})
+    connection.execute(text(f'DROP VIEW IF EXISTS {ledger.view.name}'))
+    connection.execute(text(f'CREATE VIEW {ledger.view.name} AS {sql}'))
+
+
+def _is_partition(connection, ledger, name):
+    """
+    Is `name` an attached partition of the ledger (Postgres only)?
+    """
+    return connection.execute(text(
+        'SELECT 1 FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+        'WHERE i.inhparent = CAST(:parent AS regclass) AND c.relname = :name'
+    ), parent=ledger.name, name=name).first() is not None
+
+
+def ensure_partitions(ledger, months_ahead=MONTHS_AHEAD, connection=None):
+    """
+    Create the partitions of the current month and `months_ahead` more.
+
+    Only Postgres has native partitions, this is a no-op elsewhere.
+    """
+    connection = connection or db.session.connection()
+    if connection.dialect.name != 'postgresql':
+        return
+
+    start = month_start(datetime.utcnow())
+    for _ in range(months_ahead + 1):
+        end = next_month(start)
+        connection.execute(text(
+            f'CREATE TABLE IF NOT EXISTS {ledger.period_name(start)} PARTITION OF {ledger.name} '
+            f"FOR VALUES FROM ('{start:%Y-%m-%d}') TO ('{end:%Y-%m-%d}')"
+        ))
+        start = end
+
+
+def _close_period(connection, ledger, start, end):
+    """
+    Roll up one month: carry the balances forward, then move its rows out.
+    """
+    ledgers = ledger.table
+    owner = ledgers.c[ledger.owner]
+    in_period = and_(~ledgers.c.is_opening, ledgers.c.timestamp >= start, ledgers.c.timestamp < end)
+    carried = and_(ledgers.c.is_opening, ledgers.c.timestamp < end)
+
+    # the balance at the end of the period, from the previous opening
+    # balance and the period's rows. Rows posted late into a period that
+    # was already closed stay in the live table, and are not carried.
+    connection.execute(ledgers.insert().from_select(
+        [ledger.owner, 'amount', 'timestamp', 'is_opening'],
+        select([owner, func.sum(ledgers.c.amount), literal(end, ledgers.c.timestamp.type), true()])
+        .where(or_(in_period, carried))
+        .group_by(owner)
+        .having(func.sum(ledgers.c.amount) != 0)
+    ))
+    connection.execute(ledgers.delete().where(carried))
+
+    name = ledger.period_name(start)
+    if connection.dialect.name == 'postgresql' and _is_partition(connection, ledger, name):
+        connection.execute(text(f'ALTER TABLE {ledger.name} DETACH PARTITION {name}'))
+        row_count = connection.execute(text(f'SELECT COUNT(*) FROM {name}')).scalar()
+    else:
+        cold = ledger.cold_table(name)
+        cold.create(connection, checkfirst=True)
+        row_count = connection.execute(cold.insert().from_select(
+            [c.name for c in ledger.columns], select(ledger.columns).where(in_period)
+        )).rowcount
+        connection.execute(ledgers.delete().where(in_period))
+
+    connection.execute(ledger_periods.insert().values(
+        ledger=ledger.name,
+        table_name=name,
+        period_start=start,
+        period_end=end,
+        row_count=row_count,
+        is_dropped=False
+    ))
+    return row_count
+
+
+def roll_up(ledger, before=None, connection=None):
+    """
+    Roll up every closed month of a ledger.
+
+    Parameters
+    ----------
+    ledger : PartitionedLedger
+        The ledger to roll up.
+    before : datetime, optional
+        Roll up the months before the one `before` is in. Defaults to the
+        current month, which is never rolled up.
+
+    Returns
+    -------
+    int
+        The number of periods rolled up.
+    """
+    connection = connection or db.session.connection()
+    before = min(month_start(before or datetime.utcnow()), month_start(datetime.utcnow()))
+    ledgers = ledger.table
+
+    # the opening balances land in the next month's partition
+    ensure_partitions(ledger, connection=connection)
+
+    conditions = [~ledgers.c.is_opening, ledgers.c.timestamp < before]
+    boundary = live_since(ledger, connection)
+    if boundary is not None:
+        conditions.append(ledgers.c.timestamp >= boundary)
+    first = connection.execute(select([func.min(ledgers.c.timestamp)]).where(and_(*conditions))).scalar()
+    if first is None:
+        return 0
+
+    start = month_start(parse_datetime(first))
+    n = 0
+    while start < before:
+        end = next_month(start)
+        _close_period(connection, ledger, start, end)
+        start = end
+        n += 1
+
+    refresh_view(ledger, connection)
+    return n
+
+
+def archive(ledger, period, directory, drop=False, connection=None):
+    """
+    Write a cold period to a compressed columnar file.
+
+    The file is `<directory>/<table>.npz`, one array per column: `id`, the
+    owner, `amount` (integer cents) and `timestamp` (`datetime64[us]`,
+    UTC). Read it back with `load_archive`.
+
+    Parameters
+    ----------
+    ledger : PartitionedLedger
+        The ledger the period belongs to.
+    period : LedgerPeriod row
+        The period to archive.
+    directory : str
+        Where to write the file.
+    drop : bool
+        Once it's archived, replace the rows of the cold table with one
+        roll-up row per owner.
+
+    Returns
+    -------
+    str
+        The path of the archive.
+    """
+    connection = connection or db.session.connection()
+    cold = ledger.cold_table(period.table_name)
+
+    result = connection.execute(
+        select([cold.c.id, cold.c[ledger.owner], type_coerce(cold.c.amount, BigInteger), cold.c.timestamp])
+        .order_by(cold.c.id)
+    )
+    columns = ([], [], [], [])
+    while True:
+        rows = result.fetchmany(ARCHIVE_CHUNK_SIZE)
+        if not rows:
+            break
+        for values, row in zip(columns, zip(*rows)):
+            values.extend(row)
+
+    ids, owners, amounts, timestamps = columns
+    path = os.path.join(directory, f'{period.table_name}.npz')
+    np.savez_compressed(
+        path,
+        id=np.array(ids, dtype=np.int64),
+        amount=np.array(amounts, dtype=np.int64),
+        timestamp=np.array([parse_datetime(t) for t in timestamps], dtype='datetime64[us]'),
+        **{ledger.owner: np.array(owners, dtype=np.int64)}
+    )
+
+    connection.execute(
+        ledger_periods.update()
+        .where(ledger_periods.c.id == period.id)
+        .values(path=path, is_dropped=drop)
+    )
+    if drop:
+        _drop_rows(connection, ledger, cold)
+    return path
+
+
+def _drop_rows(connection, ledger, cold):
+    """
+    Replace the rows of a cold table with one row per owner, holding the
+    sum of their amounts at their last timestamp.
+    """
+    owner = cold.c[ledger.owner]
+    rolled_up = connection.execute(
+        select([func.min(cold.c.id).label('id'), owner, func.sum(cold.c.amount).label('amount'),
+                func.max(cold.c.timestamp).label('timestamp')])
+        .group_by(owner)
+    ).fetchall()
+    connection.execute(cold.delete())
+    if rolled_up:
+        connection.execute(cold.insert(), [dict(row) for row in rolled_up])
+
+
+def load_archive(path):
+    """
+    Load an archived period as a dict of column arrays.
+    """
+    with np.load(path) as archived:
+        return {name: archived[name] for name in archived.files}
+
+
+partitions_cli = AppGroup('partitions', help='Maintain the monthly ledger partitions.')
+
+
+@partitions_cli.command('ensure')
+@click.option('--months-ahead', default=MONTHS_AHEAD, show_default=True,
+              help='Months of partitions to create ahead of time.')
+def ensure_command(months_ahead):
+    """
+    Create the upcoming monthly partitions (Postgres).
+    """
+    for ledger in LEDGERS.values():
+        ensure_partitions(ledger, months_ahead)
+    db.session.commit()
+    click.echo('Partitions are up to date.')
+
+
+@partitions_cli.command('roll-up')
+@click.option('--before', type=click.DateTime(formats=['%Y-%m']), default=None,
+              help='Roll up the months before this one (YYYY-MM). Defaults to the current month.')
+def roll_up_command(before):
+    """
+    Compact closed months into opening balances and move them out.
+    """
+    for ledger in LEDGERS.values():
+        n = roll_up(ledger, before)
+        click.echo(f'{ledger.name}: {n} periods rolled up.')
+    db.session.commit()
+
+
+@partitions_cli.command('archive')
+@click.argument('directory', type=click.Path(file_okay=False))
+@click.option('--drop', is_flag=True, help='Roll the cold tables up to one row per owner once archived.')
+def archive_command(directory, drop):
+    """
+    Archive the cold periods that were not archived yet.
+    """
+    os.makedirs(directory, exist_ok=True)
+    for ledger in LEDGERS.values():
+        for period in get_periods(ledger):
+            if period.path is None and not period.is_dropped:
+                path = archive(ledger, period, directory, drop)
+                click.echo(f'{period.table_name}: {period.row_count} rows -> {path}')
+    db.session.commit()
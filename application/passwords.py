@@ -0,0 +1,213 @@
+"""
+Password hashing with named cost profiles.
+
+Stored hashes use werkzeug's `method$salt$hash` format, so hashes written
+before this module existed (`sha256$...`) still verify. The method of the
+active profile is compared against the stored one on every successful
+login, and stale hashes are upgraded in place (see `needs_rehash`).
+
+Hashing is deliberately slow, so it runs on a small bounded thread pool
+(hashlib releases the GIL while hashing). When the pool and its queue are
+full, `HashingBusy` is raised instead of tying up another request thread.
+Under gevent (see `gunicorn.conf.py`) a patched thread is only a greenlet
+on the worker's single hub, so the pool is a gevent `ThreadPool` of real
+threads instead, and a hash doesn't stall every other request.
+Hashing time and refusals are recorded in `application.telemetry`.
+"""
+import hashlib
+import hmac
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app, has_app_context
+from werkzeug.security import check_password_hash, gen_salt, generate_password_hash
+
+from application.telemetry import PASSWORD_HASH, PASSWORD_HASH_BUSY
+
+# name -> hashing method
+PROFILES = {
+    'fast': 'pbkdf2:sha256:1000',
+    'default': 'pbkdf2:sha256:150000',
+    'strong': 'scrypt:32768:8:1',
+}
+DEFAULT_PROFILE = 'default'
+SALT_LENGTH = 16
+
+
+class HashingBusy(Exception):
+    """
+    Raised when the hashing pool is saturated.
+    """
+
+
+def get_method(profile=None):
+    """
+    Get the hashing method of a profile, or of the configured profile.
+    """
+    profiles = PROFILES
+    if has_app_context():
+        profiles = {**PROFILES, **current_app.config.get('PASSWORD_HASH_PROFILES', {})}
+        profile = profile or current_app.config.get('PASSWORD_HASH_PROFILE')
+    return profiles[profile or DEFAULT_PROFILE]
+
+
+def _scrypt(password, salt, n, r, p):
+    """
+    Hex scrypt digest, in the same format as werkzeug >= 2.3.
+    """
+    return hashlib.scrypt(password.encode(), salt=salt.encode(), n=n, r=r, p=p,
+                          maxmem=132 * n * r * p).hex()
+
+
+def _hash(password, method):
+    """
+    Hash a password with an explicit method.
+    """
+    if method.startswith('scrypt:'):
+        n, r, p = (int(x) for x in method.split(':')[1:])
+        salt = gen_salt(SALT_LENGTH)
+        return f'{method}${salt}${_scrypt(password, salt, n, r, p)}'
+    return generate_password_hash(password, method=method, salt_length=SALT_LENGTH)
+
+
+def _check(pwhash, password):
+    """
+    Check a password against a stored hash of any supported method.
+    """
+    if pwhash.startswith('scrypt:'):
+        if pwhash.count('$') < 2:
+            return False
+        method, salt, expected = pwhash.split('$', 2)
+        n, r, p = (int(x) for x in method.split(':')[1:])
+        return hmac.compare_digest(_scrypt(password, salt, n, r, p), expected)
+    return check_password_hash(pwhash, password)
+
+
+class HashingPool:
+    """
+    A bounded pool of hashing threads.
+
+    Parameters
+    ----------
+    workers : int
+        The number of hashes computed at once.
+    queue : int
+        How many more requests may wait for a free worker.
+    timeout : float
+        Seconds to wait for a queue slot before giving up.
+    """
+
+    def __init__(self, workers=2, queue=16, timeout=1.0):
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(workers + queue)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def _submit(self, func, *args):
+        # threads don't survive a fork, so the pool is made per process
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._executor = _gevent_threadpool(self.workers) or \
+                    ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='password-hash')
+        if isinstance(self._executor, ThreadPoolExecutor):
+            return self._executor.submit(func, *args).result()
+        return self._executor.spawn(func, *args).get()
+
+    def run(self, func, *args):
+        """
+        Run `func(*args)` on the pool and wait for the result.
+        """
+        if not self._slots.acquire(timeout=self.timeout):
+            raise HashingBusy('Too many password hashes in flight.')
+        try:
+            return self._submit(func, *args)
+        finally:
+            self._slots.release()
+
+
+def _gevent_threadpool(workers):
+    """
+    A gevent pool of real (unpatched) threads, if gevent has patched
+    `threading`. Waiting on it yields to the other greenlets.
+    """
+    try:
+        from gevent import monkey
+    except ImportError:
+        return None
+    if not monkey.is_module_patched('threading'):
+        return None
+
+    from gevent.threadpool import ThreadPool
+    return ThreadPool(workers)
+
+
+def init_app(app):
+    """
+    Create the hashing pool from the app configuration.
+    """
+    workers = app.config.get('PASSWORD_HASH_WORKERS', 0)
+    if workers:
+        app.extensions['password_pool'] = HashingPool(
+            workers,
+            queue=app.config.get('PASSWORD_HASH_QUEUE', 16),
+            timeout=app.config.get('PASSWORD_HASH_TIMEOUT', 1.0)
+        )
+
+
+def _timed(func, *args):
+    """
+    Run a hashing function, and record how long it took.
+    """
+    start = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        PASSWORD_HASH.observe(time.perf_counter() - start, func.__name__.lstrip('_'))
+
+
+def _run(func, *args):
+    """
+    Run on the app's hashing pool if there is one, otherwise inline.
+    """
+    pool = current_app.extensions.get('password_pool') if has_app_context() else None
+    if pool is None:
+        return _timed(func, *args)
+    try:
+        return pool.run(_timed, func, *args)
+    except HashingBusy:
+        PASSWORD_HASH_BUSY.inc()
+        raise
+
+
+def hash_password(password, method=None):
+    """
+    Hash a password with the configured profile.
+
+    Parameters
+    ----------
+    password : str
+        The plain text password.
+    method : str, optional
+        Hash with this method instead of the configured profile.
+    """
+    return _run(_hash, password, method or get_method())
+
+
+def check_password(pwhash, password):
+    """
+    Check a password against a stored hash.
+    """
+    return _run(_check, pwhash, password)
+
+
+def needs_rehash(pwhash):
+    """
+    Whether a stored hash was made with a different method than the
+    configured profile.
+    """
+    return pwhash.split('$', 1)[0] != get_method()
@@ -0,0 +1,333 @@
+"""
+Fund performance :: ROI, win rate, drawdown, units won and rolling Sharpe.
+
+Every fund is computed at once. Results are aggregated per fund and day
+in a single query, and everything after that (running totals, drawdowns,
+rolling windows) is done on NumPy arrays of the whole batch, segmented by
+fund, rather than fund by fund.
+
+The output is cached, keyed by a watermark of the newest result, so it
+is recomputed as soon as anything is settled. Deposits and withdrawals
+don't move it: a fund's capital only weighs on the days it has settled
+bets on, which are all before a new ledger row. Call `invalidate` after
+editing results in place, or back-dating ledger rows. A worker computes
+at most one refresh at a time, and its other requests wait for it.
+"""
+import math
+import threading
+
+import numpy as np
+from flask import current_app
+from sqlalchemy import Float, case, cast, func, select
+
+from application import db, partitions
+from application.cache import make_cache
+from application.models import FundLedger, Investment, Result
+from application.money import Money
+
+DEFAULT_WINDOWS = (7, 30, 90)
+
+# days per year, to annualize the Sharpe ratio of daily returns
+PERIODS_PER_YEAR = 365
+
+CACHE_KEY = 'performance'
+
+investments = Investment.__table__
+results = Result.__table__
+
+_refreshing = threading.Lock()
+
+
+def init_app(app):
+    """
+    Create the performance cache from the app configuration.
+    """
+    app.extensions['performance_cache'] = make_cache(
+        app.config.get('ANALYTICS_CACHE_URL'),
+        namespace='performance',
+        maxsize=8,
+        ttl=app.config.get('ANALYTICS_CACHE_TTL', 3600)
+    )
+
+
+def get_cache():
+    """
+    Get the performance cache of the current app.
+    """
+    return current_app.extensions['performance_cache']
+
+
+def invalidate():
+    """
+    Drop the cached performance.
+    """
+    get_cache().delete(CACHE_KEY)
+
+
+def _days(values):
+    """
+    Convert SQL `DATE(...)` values (strings or dates) to days since epoch.
+    """
+    return np.array(values, dtype='datetime64[D]').astype(np.int64)
+
+
+def fetch_daily(connection=None):
+    """
+    Aggregate the settled investments of every fund per day.
+
+    Returns
+    -------
+    dict of np.ndarray
+        `fund_id`, `day` (days since epoch), `bets`, `wins`, `staked` and
+        `pnl` (cents) and `units` columns, sorted by fund and day.
+    """
+    connection = connection or db.session.connection()
+    day = func.date(investments.c.timestamp)
+
+    result = connection.execute(
+        select([
+            investments.c.fund_id,
+            day,
+            func.count(),
+            func.sum(case([(results.c.is_win, 1)], else_=0)),
+            func.sum(investments.c.amount),
+            func.sum(results.c.amount),
+            func.sum(cast(results.c.amount, Float) / investments.c.amount)
+        ])
+        .select_from(results.join(investments, investments.c.id == results.c.investment_id))
+        .where(investments.c.amount > 0)
+        .group_by(investments.c.fund_id, day)
+        .order_by(investments.c.fund_id, day)
+    )
+
+    # plain numbers, so read the DBAPI cursor directly
+    rows = result.cursor.fetchall()
+    result.close()
+
+    names = ['fund_id', 'day', 'bets', 'wins', 'staked', 'pnl', 'units']
+    if not rows:
+        return {name: np.empty(0, dtype=np.int64) for name in names}
+
+    fund_id, days, bets, wins, staked, pnl, units = zip(*rows)
+    return {
+        'fund_id': np.array(fund_id, dtype=np.int64),
+        'day': _days(days),
+        'bets': np.array(bets, dtype=np.int64),
+        'wins': np.array(wins, dtype=np.int64),
+        'staked': np.array(staked, dtype=np.int64),
+        'pnl': np.array(pnl, dtype=np.int64),
+        'units': np.array(units, dtype=np.float64)
+    }
+
+
+def fetch_capital(connection=None):
+    """
+    Aggregate the fund ledgers (deposits, withdrawals and P&L) per day.
+
+    Returns
+    -------
+    dict of np.ndarray
+        `fund_id`, `day` and `amount` (cents) columns, sorted by fund and day.
+    """
+    connection = connection or db.session.connection()
+    ledger = partitions.history(partitions.LEDGERS[FundLedger.__tablename__], connection=connection)
+    day = func.date(ledger.c.timestamp)
+
+    result = connection.execute(
+        select([ledger.c.fund_id, day, func.sum(ledger.c.amount)])
+        .group_by(ledger.c.fund_id, day)
+        .order_by(ledger.c.fund_id, day)
+    )
+    rows = result.cursor.fetchall()
+    result.close()
+
+    if not rows:
+        return {name: np.empty(0, dtype=np.int64) for name in ('fund_id', 'day', 'amount')}
+
+    fund_id, days, amount = zip(*rows)
+    return {
+        'fund_id': np.array(fund_id, dtype=np.int64),
+        'day': _days(days),
+        'amount': np.array(amount, dtype=np.int64)
+    }
+
+
+def _segment_cumsum(values, starts, segments):
+    """
+    Cumulative sum that restarts at every segment (fund).
+    """
+    total = np.cumsum(values)
+    return total - (total[starts] - values[starts])[segments]
+
+
+def _segment_cummax(values, segments):
+    """
+    Cumulative max that restarts at every segment (fund).
+
+    Each segment is lifted above all the previous ones, so a single
+    `maximum.accumulate` never carries a max across a segment boundary.
+    """
+    if not len(values):
+        return values
+    span = values.max() - values.min() + 1
+    lift = segments * span
+    return np.maximum.accumulate(values + lift) - lift
+
+
+def compute(daily, capital, windows=DEFAULT_WINDOWS):
+    """
+    Compute the performance of every fund.
+
+    Parameters
+    ----------
+    daily : dict of np.ndarray
+        See `fetch_daily`.
+    capital : dict of np.ndarray
+        See `fetch_capital`.
+    windows : tuple of int
+        The rolling Sharpe windows, in days.
+
+    Returns
+    -------
+    dict
+        Fund identifier to a `summary` and a columnar `series` (one entry
+        per day with settled bets). Money is in dollars: exact strings in
+        the summary, floats in the series (for charts).
+    """
+    n = len(daily['fund_id'])
+    if not n:
+        return {}
+
+    fund_ids, segments = np.unique(daily['fund_id'], return_inverse=True)
+    starts = np.searchsorted(segments, np.arange(len(fund_ids)))
+    ends = np.r_[starts[1:], n]
+
+    # (fund, day) keys, sorted the same way as the rows
+    day_span = int(max(daily['day'].max(), capital['day'].max(initial=0))) + max(windows) + 1
+    keys = segments * day_span + daily['day']
+
+    pnl = daily['pnl'].astype(np.float64)
+    cum_pnl = _segment_cumsum(pnl, starts, segments)
+    cum_staked = _segment_cumsum(daily['staked'].astype(np.float64), starts, segments)
+    cum_bets = _segment_cumsum(daily['bets'], starts, segments)
+    cum_wins = _segment_cumsum(daily['wins'], starts, segments)
+    cum_units = _segment_cumsum(daily['units'], starts, segments)
+
+    # drawdown from the running peak (starting from flat)
+    peak = np.maximum(_segment_cummax(cum_pnl, segments), 0)
+    drawdown = peak - cum_pnl
+
+    # the fund's capital at the start of each day, from its ledger
+    ledger_segments = np.searchsorted(fund_ids, capital['fund_id'])
+    known = (ledger_segments < len(fund_ids)) & \
+        (fund_ids[np.minimum(ledger_segments, len(fund_ids) - 1)] == capital['fund_id'])
+    ledger_keys = ledger_segments[known] * day_span + capital['day'][known]
+    ledger_total = np.r_[0, np.cumsum(capital['amount'][known])]
+    before_day = np.searchsorted(ledger_keys, keys, side='left')
+    fund_start = np.searchsorted(ledger_keys, segments * day_span, side='left')
+    start_capital = (ledger_total[before_day] - ledger_total[fund_start]).astype(np.float64)
+
+    returns = np.where(start_capital > 0, pnl / np.where(start_capital > 0, start_capital, 1), 0.0)
+    total_returns = np.r_[0, np.cumsum(returns)]
+    total_squares = np.r_[0, np.cumsum(returns ** 2)]
+    first_day = daily['day'][starts][segments]
+
+    series_sharpe = {}
+    for window in windows:
+        # days without bets are flat, so sums over the window's rows
+        # are sums over every day of the window
+        window_start = np.searchsorted(keys, keys - (window - 1), side='left')
+        s = total_returns[np.arange(1, n + 1)] - total_returns[window_start]
+        q = total_squares[np.arange(1, n + 1)] - total_squares[window_start]
+        variance = (q - s * s / window) / (window - 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sharpe = s / window / np.sqrt(variance) * math.sqrt(PERIODS_PER_YEAR)
+        full = (daily['day'] - first_day >= window - 1) & (variance > 0)
+        series_sharpe[window] = np.where(full, sharpe, np.nan)
+
+    def floats(values):
+        return [None if math.isnan(v) else round(v, 4) for v in values.tolist()]
+
+    def dollars(values):
+        return (values / 100).round(2).tolist()
+
+    dates = daily['day'].astype('datetime64[D]').astype(str)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        roi = np.where(cum_staked > 0, cum_pnl / cum_staked, np.nan)
+        win_rate = np.where(cum_bets > 0, cum_wins / cum_bets, np.nan)
+
+    performance = {}
+    for i, fund_id in enumerate(fund_ids.tolist()):
+        rows = slice(starts[i], ends[i])
+        last = ends[i] - 1
+        performance[fund_id] = {
+            'summary': {
+                'fund_id': fund_id,
+                'bets': int(cum_bets[last]),
+                'wins': int(cum_wins[last]),
+                'win_rate': floats(win_rate[last:last + 1])[0],
+                'staked': str(Money(cum_staked[last])),
+                'pnl': str(Money(cum_pnl[last])),
+                'roi': floats(roi[last:last + 1])[0],
+                'units': round(float(cum_units[last]), 4),
+                'max_drawdown': str(Money(drawdown[rows].max())),
+                **{f'sharpe_{w}d': floats(series_sharpe[w][last:last + 1])[0] for w in windows}
+            },
+            'series': {
+                'date': dates[rows].tolist(),
+                'pnl': dollars(pnl[rows]),
+                'cumulative_pnl': dollars(cum_pnl[rows]),
+                'drawdown': dollars(drawdown[rows]),
+                'roi': floats(roi[rows]),
+                'win_rate': floats(win_rate[rows]),
+                'units': floats(cum_units[rows]),
+                **{f'sharpe_{w}d': floats(series_sharpe[w][rows]) for w in windows}
+            }
+        }
+    return performance
+
+
+def _watermark(connection):
+    """
+    The newest result. Anything settled moves it.
+    """
+    return connection.execute(select([func.max(results.c.id)])).scalar()
+
+
+def get_performance(windows=None):
+    """
+    Get the performance of every fund, from the cache when nothing was
+    settled since it was computed.
+    """
+    windows = tuple(windows or current_app.config.get('ANALYTICS_WINDOWS', DEFAULT_WINDOWS))
+    connection = db.session.connection()
+    watermark = _watermark(connection)
+
+    cache = get_cache()
+
+    def cached():
+        entry = cache.get(CACHE_KEY)
+        if entry is not None and entry['watermark'] == watermark and entry['windows'] == windows:
+            return entry['funds']
+
+    funds = cached()
+    if funds is not None:
+        return funds
+
+    with _refreshing:
+        # another request may have refreshed it while this one waited
+        funds = cached()
+        if funds is None:
+            funds = compute(fetch_daily(connection), fetch_capital(connection), windows)
+            cache.set(CACHE_KEY, {'watermark': watermark, 'windows': windows, 'funds': funds})
+    return funds
+
+
+def fund_summaries(fund_ids):
+    """
+    Get the performance summary of some funds (`None` for funds with no
+    settled bets).
+    """
+    performance = get_performance()
+    return {fund_id: performance[fund_id]['summary'] if fund_id in performance else None
+            for fund_id in fund_ids}
@@ -0,0 +1,219 @@
+"""
+Rate limiting :: sliding-window counters in front of the auth routes.
+
+Each limit allows `limit` attempts per `window` seconds, per client address
+and per email address. Windows slide: the previous fixed window's count is
+weighted by how much of it still overlaps the sliding one, so a check is
+two counters and a little arithmetic, whatever the traffic.
+
+`rate_limited` checks a `POST` against the limits in `RATELIMITS` before
+the view runs, so a refused attempt costs no query and no password hash.
+It gets a `429` with a `Retry-After`, and is counted in
+`application.telemetry`.
+
+Counters are kept per process, or in Redis with `RATELIMIT_URL` so every
+worker shares them. Email addresses are hashed before they are used as
+keys. Behind a proxy, let `werkzeug.middleware.proxy_fix.ProxyFix` set the
+client address, or every client shares the proxy's.
+"""
+import functools
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Response, current_app, request
+
+from application.telemetry import RATELIMIT_REJECTED
+
+# limit name -> key kind -> (attempts, window seconds)
+DEFAULT_LIMITS = {
+    'login': {'ip': (20, 60), 'email': (5, 300)},
+    'signup': {'ip': (5, 600), 'email': (3, 600)},
+}
+
+
+def _estimate(previous, current, elapsed, window):
+    """
+    The attempts in the sliding window, from the fixed windows' counts.
+    """
+    return previous * (1 - elapsed / window) + current
+
+
+def _retry_after(previous, current, limit, elapsed, window):
+    """
+    Seconds until the sliding window has room for another attempt.
+    """
+    if current >= limit:
+        # wait for the next window, then for this one's weight to drop
+        seconds = window - elapsed + window * (1 - limit / current)
+    else:
+        seconds = window * (1 - (limit - current) / previous) - elapsed
+    # the estimate is exactly `limit` at `seconds`, so strictly after it
+    return max(math.floor(seconds) + 1, 1)
+
+
+class MemoryBackend:
+    """
+    Sliding-window counters in this process, bounded to `maxsize` keys
+    (the least recently used are dropped).
+    """
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._windows = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, key, limit, window):
+        """
+        Count an attempt, unless it is over the limit.
+
+        Returns
+        -------
+        int
+            0 if allowed, otherwise the seconds to wait.
+        """
+        index, elapsed = divmod(time.monotonic(), window)
+        with self._lock:
+            start, previous, current = self._windows.get(key, (index, 0, 0))
+            if start != index:
+                previous, current = (current if start == index - 1 else 0), 0
+
+            if _estimate(previous, current, elapsed, window) >= limit:
+                self._windows[key] = (index, previous, current)
+                return _retry_after(previous, current, limit, elapsed, window)
+
+            self._windows[key] = (index, previous, current + 1)
+            self._windows.move_to_end(key)
+            if len(self._windows) > self.maxsize:
+                self._windows.popitem(last=False)
+            return 0
+
+    def clear(self):
+        with self._lock:
+            self._windows.clear()
+
+
+class RedisBackend:
+    """
+    Sliding-window counters in Redis, shared by every worker process.
+    Requires the `redis` package.
+
+    Parameters
+    ----------
+    url : str
+        The Redis URL, i.e. `redis://localhost:6379/0`.
+    namespace : str
+        Prefix for every key.
+    """
+
+    def __init__(self, url, namespace='ratelimit'):
+        try:
+            import redis
+        except ImportError:
+            raise ImportError('The `redis` package is required for a Redis rate limit backend.')
+
+        self.client = redis.Redis.from_url(url)
+        self.namespace = namespace
+
+    def hit(self, key, limit, window):
+        """
+        Count an attempt, unless it is over the limit (see `MemoryBackend`).
+        """
+        index, elapsed = divmod(time.time(), window)
+        current_key = f'{self.namespace}:{key}:{int(index)}'
+        previous, current = self.client.mget(f'{self.namespace}:{key}:{int(index) - 1}', current_key)
+        previous, current = int(previous or 0), int(current or 0)
+
+        if _estimate(previous, current, elapsed, window) >= limit:
+            return _retry_after(previous, current, limit, elapsed, window)
+
+        pipeline = self.client.pipeline()
+        pipeline.incr(current_key)
+        pipeline.expire(current_key, int(window * 2) + 1)
+        pipeline.execute()
+        return 0
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=f'{self.namespace}:*'))
+        if keys:
+            self.client.delete(*keys)
+
+
+def make_backend(url=None, maxsize=100000):
+    """
+    Create a backend for a URL: `redis://...` for Redis, anything else
+    (including `None`) for this process.
+    """
+    if url and url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisBackend(url)
+    return MemoryBackend(maxsize)
+
+
+def init_app(app):
+    """
+    Create the rate limit backend from the app configuration.
+    """
+    app.extensions['ratelimit'] = make_backend(
+        app.config.get('RATELIMIT_URL'),
+        maxsize=app.config.get('RATELIMIT_SIZE', 100000)
+    )
+
+
+def get_backend():
+    """
+    Get the rate limit backend of the current app.
+    """
+    return current_app.extensions['ratelimit']
+
+
+def _keys():
+    """
+    The keys of the current request: its client address and, if it has
+    one, the email address it was submitted with.
+    """
+    keys = {'ip': request.remote_addr or 'unknown'}
+    email_address = (request.form.get('email_address') or '').strip().lower()
+    if email_address:
+        keys['email'] = hashlib.sha1(email_address.encode()).hexdigest()
+    return keys
+
+
+def check(name):
+    """
+    Count an attempt against a named limit.
+
+    Returns
+    -------
+    int
+        0 if allowed, otherwise the seconds to wait.
+    """
+    limits = current_app.config.get('RATELIMITS', DEFAULT_LIMITS).get(name, {})
+    backend = get_backend()
+    for kind, value in _keys().items():
+        if kind not in limits:
+            continue
+        limit, window = limits[kind]
+        retry_after = backend.hit(f'{name}:{kind}:{value}', limit, window)
+        if retry_after:
+            RATELIMIT_REJECTED.inc(name, kind)
+            return retry_after
+    return 0
+
+
+def rate_limited(name):
+    """
+    Refuse `POST`s over a named limit, before the view does any work.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method == 'POST' and current_app.config.get('RATELIMIT_ENABLED', True):
+                retry_after = check(name)
+                if retry_after:
+                    return Response('Too many attempts, please try again later.', status=429,
+                                    headers={'Retry-After': str(retry_after)})
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,284 @@
+"""
+Settlement :: turn settled lines into results and ledger postings.
+
+For a batch of settled lines, every unsettled investment on them is paid
+out at once with NumPy, each fund's P&L is posted to `fund_ledgers`, and
+pro-rated to its members by their share of the fund (their running
+balance) in `fund_user_ledgers`. Everything is written with bulk inserts
+in a single transaction.
+
+All of the math is done on `int64` arrays of cents, so the postings of a
+batch add up exactly.
+
+Settling is idempotent: investments that already have a result are
+skipped, and `results.investment_id` is unique, so a retried (or
+concurrent) batch can't pay anything twice.
+"""
+import json
+from datetime import datetime
+
+import click
+import numpy as np
+from flask.cli import with_appcontext
+from sqlalchemy import and_, exists, func, select
+
+from application import balances, db
+from application.database import MAX_IN_PARAMS
+from application.models import (FundLedger, FundUser, FundUserBalance,
+                                FundUserLedger, Investment, Line, Result)
+from application.money import Money
+
+WIN = 'win'
+LOSS = 'loss'
+PUSH = 'push'
+OUTCOMES = (WIN, LOSS, PUSH)
+
+
+def decimal_odds(details):
+    """
+    Get the decimal odds of a line from its details.
+
+    Uses `details["odds"]` when present, otherwise converts the american
+    `details["price"]` (i.e. -150 -> 1.667, +120 -> 2.2).
+    """
+    if details.get('odds') is not None:
+        return float(details['odds'])
+
+    price = float(details['price'])
+    if price > 0:
+        return 1 + price / 100
+    return 1 + 100 / -price
+
+
+def _chunks(values, size=MAX_IN_PARAMS):
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def _unsettled_investments(connection, line_ids):
+    """
+    Get the investments on `line_ids` that have no result yet.
+    """
+    investments = Investment.__table__
+    results = Result.__table__
+
+    rows = []
+    for chunk in _chunks(line_ids):
+        query = select([investments.c.id, investments.c.fund_id, investments.c.line_id,
+                        investments.c.amount]) \
+            .where(and_(investments.c.line_id.in_(chunk),
+                        ~exists().where(results.c.investment_id == investments.c.id))) \
+            .order_by(investments.c.id)
+        if connection.dialect.name == 'postgresql':
+            query = query.with_for_update(of=investments)
+        rows.extend(connection.execute(query).fetchall())
+    return rows
+
+
+def _line_odds(connection, line_ids):
+    """
+    Get the decimal odds of every line in `line_ids`.
+
+    Raises
+    ------
+    ValueError
+        If any of the lines has no usable odds.
+    """
+    lines = Line.__table__
+    odds, invalid = {}, []
+    for chunk in _chunks(line_ids):
+        for line_id, details in connection.execute(
+                select([lines.c.id, lines.c.details]).where(lines.c.id.in_(chunk))):
+            try:
+                value = decimal_odds(details or {})
+            except (KeyError, TypeError, ValueError, ZeroDivisionError):
+                value = None
+            if value is None or not np.isfinite(value) or value < 1:
+                invalid.append(line_id)
+            else:
+                odds[line_id] = value
+
+    if invalid:
+        raise ValueError(f"No valid odds for line(s) `{'`, `'.join(sorted(invalid))}`.")
+    return odds
+
+
+def _members(connection, fund_ids):
+    """
+    Get the members of `fund_ids` with their running balance.
+    """
+    fund_users = FundUser.__table__
+    member_balances = FundUserBalance.__table__
+
+    rows = []
+    for chunk in _chunks(fund_ids):
+        rows.extend(connection.execute(
+            select([fund_users.c.id, fund_users.c.fund_id,
+                    func.coalesce(member_balances.c.balance, 0)])
+            .select_from(fund_users.outerjoin(
+                member_balances, member_balances.c.fund_user_id == fund_users.c.id))
+            .where(fund_users.c.fund_id.in_(chunk))
+            .order_by(fund_users.c.id)
+        ).fetchall())
+    return rows
+
+
+def payouts(stakes, odds, outcomes):
+    """
+    Compute the P&L of a batch of investments.
+
+    Parameters
+    ----------
+    stakes : np.ndarray of int64
+        The amount invested in each investment, in cents.
+    odds : np.ndarray
+        The decimal odds of each investment.
+    outcomes : np.ndarray of str
+        `win`, `loss` or `push` for each investment.
+
+    Returns
+    -------
+    np.ndarray of int64
+        The profit (or loss) of each investment, in cents.
+    """
+    winnings = np.rint(stakes * (odds - 1)).astype(np.int64)
+    return np.where(outcomes == WIN, winnings,
+                    np.where(outcomes == LOSS, -stakes, 0)).astype(np.int64)
+
+
+def pro_rate(amounts, member_funds, member_balances):
+    """
+    Split each fund's amount between its members.
+
+    Members share in proportion to their (positive) balance; a fund whose
+    members have no balance splits evenly. Each split is rounded to cents,
+    with the rounding residue given to the member with the largest share,
+    so the members always add up to the fund exactly.
+
+    Parameters
+    ----------
+    amounts : dict
+        Fund identifier to the amount to split, in cents.
+    member_funds, member_balances : np.ndarray
+        The fund and balance (in cents) of every member.
+
+    Returns
+    -------
+    np.ndarray of int64
+        The amount for each member, in cents.
+    """
+    weights = np.maximum(member_balances.astype(np.float64), 0)
+
+    funds, member_idx = np.unique(member_funds, return_inverse=True)
+    totals = np.bincount(member_idx, weights=weights, minlength=len(funds))
+    counts = np.bincount(member_idx, minlength=len(funds))
+
+    # even split where nobody has a balance
+    empty = totals[member_idx] == 0
+    shares = np.where(empty, 1 / counts[member_idx],
+                      weights / np.where(totals == 0, 1, totals)[member_idx])
+
+    fund_amounts = np.array([amounts.get(int(f), 0) for f in funds], dtype=np.int64)
+    split = np.rint(fund_amounts[member_idx] * shares).astype(np.int64)
+
+    # give the rounding residue to the largest member of each fund
+    allocated = np.zeros(len(funds), dtype=np.int64)
+    np.add.at(allocated, member_idx, split)
+    order = np.lexsort((-shares, member_idx))
+    first = order[np.r_[0, np.flatnonzero(np.diff(member_idx[order])) + 1]]
+    split[first] += (fund_amounts - allocated)[member_idx[first]]
+    return split
+
+
+def settle(outcomes, timestamp=None, connection=None):
+    """
+    Settle a batch of lines.
+
+    Parameters
+    ----------
+    outcomes : dict
+        Line identifier to `win`, `loss` or `push`.
+    timestamp : datetime, optional
+        When the postings happen. Defaults to now (UTC).
+    connection : sqlalchemy.engine.Connection, optional
+        Settle inside an existing transaction instead of a new one.
+
+    Returns
+    -------
+    dict
+        Counts of `investments` settled, `funds` and `members` posted to,
+        and the total `pnl` (a `Money`).
+    """
+    for line_id, outcome in outcomes.items():
+        if outcome not in OUTCOMES:
+            raise ValueError(f'Unknown outcome `{outcome}` for line `{line_id}`.')
+
+    if connection is None:
+        with db.engine.begin() as connection:
+            return settle(outcomes, timestamp, connection)
+
+    timestamp = timestamp or datetime.utcnow()
+    summary = {'investments': 0, 'funds': 0, 'members': 0, 'pnl': Money(0)}
+
+    investments = _unsettled_investments(connection, outcomes)
+    if not investments:
+        return summary
+
+    # only winnings need odds, a loss or a push pays the stake or nothing
+    investment_ids, fund_ids, line_ids, stakes = zip(*investments)
+    odds = _line_odds(connection, {line_id for line_id in line_ids if outcomes[line_id] == WIN})
+
+    stakes = np.array([int(stake) for stake in stakes], dtype=np.int64)
+    pnl = payouts(stakes,
+                  np.array([odds.get(line_id, 1.0) for line_id in line_ids]),
+                  np.array([outcomes[line_id] for line_id in line_ids]))
+
+    connection.execute(Result.__table__.insert(), [
+        {'investment_id': investment_id, 'amount': amount, 'is_win': outcomes[line_id] == WIN}
+        for investment_id, line_id, amount in zip(investment_ids, line_ids, pnl.tolist())
+    ])
+
+    # each fund's P&L
+    funds, fund_idx = np.unique(np.array(fund_ids), return_inverse=True)
+    fund_pnl = np.zeros(len(funds), dtype=np.int64)
+    np.add.at(fund_pnl, fund_idx, pnl)
+    fund_rows = [{'fund_id': fund_id, 'amount': amount, 'timestamp': timestamp}
+                 for fund_id, amount in zip(funds.tolist(), fund_pnl.tolist()) if amount != 0]
+    if fund_rows:
+        connection.execute(FundLedger.__table__.insert(), fund_rows)
+        balances.apply_rows(connection, balances.FUND, fund_rows)
+
+    # and each member's share of it
+    members = _members(connection, funds.tolist())
+    member_rows = []
+    if members:
+        member_ids, member_funds, member_balances = zip(*members)
+        member_ids, member_funds = np.array(member_ids), np.array(member_funds)
+        member_balances = np.array([int(b) for b in member_balances], dtype=np.int64)
+        split = pro_rate(dict(zip(funds.tolist(), fund_pnl.tolist())),
+                         member_funds, member_balances)
+        member_rows = [{'fund_user_id': member_id, 'amount': amount, 'timestamp': timestamp}
+                       for member_id, amount in zip(member_ids.tolist(), split.tolist()) if amount != 0]
+    if member_rows:
+        connection.execute(FundUserLedger.__table__.insert(), member_rows)
+        balances.apply_rows(connection, balances.FUND_USER, member_rows)
+
+    summary.update(investments=len(investments), funds=len(fund_rows),
+                   members=len(member_rows), pnl=Money(pnl.sum()))
+    return summary
+
+
+@click.command('settle')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@with_appcontext
+def settle_command(path):
+    """
+    Settle lines from a JSON file of `{"line_id": "win|loss|push"}`.
+    """
+    with open(path) as f:
+        outcomes = json.load(f)
+
+    summary = settle(outcomes)
+    click.echo(f"Settled {summary['investments']} investments: {summary['funds']} fund and "
+               f"{summary['members']} member postings, P&L {summary['pnl']}.")
@@ -2,11 +2,14 @@ from flask import Blueprint, flash, redirect, render_template, url_for
 
 from application.forms import SignUpForm
 from application.models import User, db
+from application.passwords import HashingBusy
+from application.ratelimit import rate_limited
 
 signup_bp = Blueprint('signup_bp', __name__, template_folder='templates')
 
 
 @signup_bp.route('/signup', methods=['GET', 'POST'])
+@rate_limited('signup')
 def signup():
     """
     End point for sign up page.
@@ -30,7 +33,11 @@ def signup():
                 last_name=last_name,
                 email_address=email_address
             )
-            user.set_password(password)
+            try:
+                user.set_password(password)
+            except HashingBusy:
+                flash('We are experiencing heavy traffic, please try again.')
+                return redirect(url_for('signup_bp.signup'))
 
             db.session.add(user)
             db.session.commit()
@@ -0,0 +1,181 @@
+"""
+App startup :: lazily loaded blueprints, and preloading before a fork.
+
+With `LAZY_BLUEPRINTS`, a blueprint (its views, forms and their imports)
+is only imported and registered when a request first reaches one of its
+paths, or a URL to one of its endpoints is first built. A worker then
+boots with the models and plug-ins alone, and pays for each part of the
+site when it is used. Lazy loading is off in debug mode, where Flask
+refuses late registrations.
+
+`preload` does the opposite, for servers that load the app once and fork
+the workers from it (`PRELOAD_APP`, see `gunicorn.conf.py`): everything is
+loaded and compiled in the master, then frozen out of the garbage
+collector, so the workers share those pages copy-on-write instead of each
+building (and touching) their own. Threads don't survive the fork, so
+background threads are `ProcessThread`s, started in each process on first
+use.
+"""
+import gc
+import logging
+import os
+import threading
+
+from flask import url_for
+from sqlalchemy import orm
+from werkzeug.utils import import_string
+
+logger = logging.getLogger(__name__)
+
+
+def _serves(paths, path):
+    """
+    Whether a path is one of `paths`, or under one of them.
+    """
+    return any(path == prefix or (prefix != '/' and path.startswith(prefix + '/'))
+               for prefix in paths)
+
+
+class LazyBlueprints:
+    """
+    Middleware registering blueprints on the app the first time they are
+    needed.
+
+    Parameters
+    ----------
+    app : flask.Flask
+        The app.
+    blueprints : iterable
+        `(import path, paths, options)` of each blueprint, where `paths`
+        are the paths (and prefixes) its routes serve, and `options` are
+        passed to `register_blueprint`.
+    """
+
+    def __init__(self, app, blueprints):
+        self.app = app
+        self.wsgi_app = app.wsgi_app
+        self._pending = {import_path.rpartition('.')[2]: (import_path, paths, options)
+                         for import_path, paths, options in blueprints}
+        self._lock = threading.Lock()
+
+    def load(self, name):
+        """
+        Import and register a blueprint, by name, if it isn't yet.
+        """
+        with self._lock:
+            if name not in self._pending:
+                return False
+            import_path, _, options = self._pending[name]
+            self.app.register_blueprint(import_string(import_path), **options)
+            del self._pending[name]
+        logger.debug('Loaded the %s blueprint.', name)
+        return True
+
+    def load_all(self):
+        """
+        Register every blueprint left.
+        """
+        for name in list(self._pending):
+            self.load(name)
+
+    def build_error(self, error, endpoint, values):
+        """
+        A URL build error handler: load the endpoint's blueprint, and
+        build the URL again.
+        """
+        name, _, _ = endpoint.partition('.')
+        if not self.load(name):
+            raise error
+        return url_for(endpoint, **values)
+
+    def __call__(self, environ, start_response):
+        if self._pending:
+            path = environ.get('PATH_INFO') or '/'
+            for name, (_, paths, _) in list(self._pending.items()):
+                if _serves(paths, path):
+                    self.load(name)
+        return self.wsgi_app(environ, start_response)
+
+
+def register_blueprints(app, blueprints):
+    """
+    Register the blueprints now, or when needed with `LAZY_BLUEPRINTS`
+    (outside debug mode).
+    """
+    if app.config.get('LAZY_BLUEPRINTS') and not app.debug:
+        lazy = LazyBlueprints(app, blueprints)
+        app.wsgi_app = lazy
+        app.url_build_error_handlers.append(lazy.build_error)
+        app.extensions['lazy_blueprints'] = lazy
+        return
+
+    for import_path, paths, options in blueprints:
+        blueprint = import_string(import_path)
+        app.register_blueprint(blueprint, **options)
+
+        # a route outside its listed paths would 404 when loaded lazily
+        if app.debug:
+            for rule in app.url_map.iter_rules():
+                if rule.endpoint.startswith(blueprint.name + '.') and not _serves(paths, rule.rule):
+                    logger.warning('%s is not under the paths listed for %s.', rule.rule, blueprint.name)
+
+
+def preload(app):
+    """
+    Load and compile everything the workers share, then freeze it.
+    Call this in the master, before forking the workers.
+    """
+    lazy = app.extensions.get('lazy_blueprints')
+    if lazy is not None:
+        lazy.load_all()
+
+    with app.app_context():
+        orm.configure_mappers()
+        for name in app.jinja_env.list_templates(extensions=('html',)):
+            app.jinja_env.get_template(name)
+
+        # connections must not be shared with the workers
+        from application.database import get_engines
+        for engine in get_engines(app).values():
+            engine.dispose()
+
+    gc.collect()
+    gc.freeze()
+
+
+class ProcessThread:
+    """
+    A daemon thread started on first use in each process: a forked worker
+    starts its own, the parent's isn't running there.
+
+    Parameters
+    ----------
+    target : callable
+        What the thread runs.
+    name : str
+        The thread name.
+    """
+
+    def __init__(self, target, name):
+        self.target = target
+        self.name = name
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def start(self):
+        """
+        Start the thread, unless it already runs in this process.
+
+        Returns
+        -------
+        bool
+            Whether it was started.
+        """
+        if self._pid == os.getpid():
+            return False
+        with self._lock:
+            if self._pid == os.getpid():
+                return False
+            self._pid = os.getpid()
+        threading.Thread(target=self.target, name=self.name, daemon=True).start()
+        return True
@@ -0,0 +1,379 @@
+"""
+Strategy engine :: turn `Strategy.details` into investments.
+
+A strategy definition looks like
+
+    {
+        "filters": [{"key": "sport", "op": "eq", "value": "NBA"},
+                    {"key": "price", "op": "gt", "value": 0}],
+        "sizing": {"method": "fraction", "fraction": 0.02, "max": "100.00"},
+        "max_lines": 10
+    }
+
+* `filters` are on details keys (all must match), with the operators of
+  `application.lines.OPERATORS`. Ordering operators (`lt`, `lte`, `gt`,
+  `gte`) need a number, or a date on a promoted date key.
+* `sizing` is either a `fixed` amount per line, or a `fraction` of the
+  fund's balance per line (optionally capped by `max`). Amounts are in
+  dollars.
+* `max_lines` caps the lines taken per run, earliest starting first.
+
+Each definition is compiled once into a `Plan`, cached by strategy and a
+hash of its details (so editing a strategy recompiles it). A plan runs
+over column arrays of a whole batch of lines, and the columns are built
+once per batch, however many strategies use them.
+"""
+from datetime import datetime
+
+import click
+import numpy as np
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import and_, func, select
+
+from application import db
+from application.cache import LRUCache
+from application.database import MAX_IN_PARAMS
+from application.lines import OPERATORS as LINE_OPERATORS
+from application.lines import PROMOTED, details_hash, line_filters, parse_datetime
+from application.models import Fund, FundBalance, Investment, Line, Strategy
+from application.money import Money, dollars_to_cents
+
+DEFAULT_SIZING = {'method': 'fixed', 'amount': '10.00'}
+
+
+# the operators of `line_filters`, over column arrays
+OPERATORS = {**LINE_OPERATORS, 'in': lambda column, value: np.isin(column, list(value))}
+
+# operators that only compare numbers and dates (missing values, `NaN`
+# and `NaT`, never match)
+ORDERING = ('lt', 'lte', 'gt', 'gte')
+
+lines = Line.__table__
+investments = Investment.__table__
+
+# compiled plans, by (strategy id, details hash)
+_plans = LRUCache(maxsize=256, ttl=None)
+
+
+class StrategyError(ValueError):
+    """
+    A strategy definition that can't be compiled.
+    """
+
+
+def _kind(value):
+    """
+    How a filter value (and so its column) compares.
+    """
+    if isinstance(value, (list, tuple, set)):
+        value = next(iter(value), None)
+    if isinstance(value, bool) or value is None:
+        return 'object'
+    if isinstance(value, (int, float)):
+        return 'number'
+    return 'object'
+
+
+def _datetime64(value):
+    return np.datetime64(parse_datetime(value), 'us')
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+class LineBatch:
+    """
+    A batch of lines, with their details keys as (lazily built) columns.
+
+    Parameters
+    ----------
+    rows : list
+        `lines` rows, with `id`, `details` and the promoted columns.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.ids = np.array([row.id for row in rows], dtype=object)
+        self.starts_at = np.array([parse_datetime(row.starts_at) for row in rows],
+                                  dtype='datetime64[us]')
+        self._columns = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def column(self, key, kind):
+        """
+        Get a details key as a column: floats (`NaN` when missing) for
+        `number`, datetimes for `datetime`, Python objects otherwise.
+        """
+        if (key, kind) not in self._columns:
+            if key in PROMOTED:
+                name, _ = PROMOTED[key]
+                values = [getattr(row, name) for row in self.rows]
+            else:
+                values = [(row.details or {}).get(key) for row in self.rows]
+
+            if kind == 'number':
+                column = np.fromiter((_number(v) for v in values), dtype=np.float64, count=len(values))
+            elif kind == 'datetime':
+                column = np.array([parse_datetime(v) for v in values], dtype='datetime64[us]')
+            else:
+                column = np.array(values, dtype=object)
+            self._columns[key, kind] = column
+        return self._columns[key, kind]
+
+
+class Plan:
+    """
+    A compiled strategy: a predicate over a `LineBatch`, and a sizing rule.
+    """
+
+    def __init__(self, strategy_id, filters, method, amount, fraction, maximum, max_lines):
+        self.strategy_id = strategy_id
+        self.filters = filters
+        self.method = method
+        self.amount = amount
+        self.fraction = fraction
+        self.maximum = maximum
+        self.max_lines = max_lines
+
+    def mask(self, batch):
+        """
+        Get a mask of the lines of a batch that pass every filter.
+        """
+        mask = np.ones(len(batch), dtype=bool)
+        for key, kind, compare, value in self.filters:
+            mask &= compare(batch.column(key, kind), value)
+        return mask
+
+    def select(self, batch):
+        """
+        Get the indices of the lines of a batch the strategy takes.
+        """
+        selected = np.flatnonzero(self.mask(batch))
+        if self.max_lines is not None and len(selected) > self.max_lines:
+            order = np.argsort(batch.starts_at[selected], kind='stable')
+            selected = np.sort(selected[order[:self.max_lines]])
+        return selected
+
+    def size(self, balances):
+        """
+        Get the stake per line of each fund, in cents.
+
+        Parameters
+        ----------
+        balances : np.ndarray of int64
+            The balance of each fund, in cents.
+        """
+        if self.method == 'fixed':
+            stakes = np.full(len(balances), self.amount, dtype=np.int64)
+        else:
+            stakes = np.floor(np.maximum(balances, 0) * self.fraction).astype(np.int64)
+        if self.maximum is not None:
+            stakes = np.minimum(stakes, self.maximum)
+        return stakes
+
+
+def compile_strategy(strategy_id, details):
+    """
+    Compile a strategy definition into a `Plan`.
+
+    Raises
+    ------
+    StrategyError
+        If the definition is invalid.
+    """
+    filters = []
+    for f in details.get('filters', []):
+        try:
+            key, op, value = f['key'], f.get('op', 'eq'), f['value']
+        except (KeyError, TypeError):
+            raise StrategyError(f'Strategy `{strategy_id}`: invalid filter `{f}`.')
+        if op not in OPERATORS:
+            raise StrategyError(f'Strategy `{strategy_id}`: unknown operator `{op}`.')
+
+        kind = _kind(value)
+        if key in PROMOTED and PROMOTED[key][1] is parse_datetime:
+            kind = 'datetime'
+            value = [_datetime64(v) for v in value] if op == 'in' else _datetime64(value)
+        if op in ORDERING and kind == 'object':
+            raise StrategyError(f'Strategy `{strategy_id}`: `{op}` needs a number or a date, '
+                                f'not `{value!r}`.')
+        filters.append((key, kind, OPERATORS[op], value))
+
+    sizing = details.get('sizing', DEFAULT_SIZING)
+    method = sizing.get('method')
+    if method not in ('fixed', 'fraction'):
+        raise StrategyError(f'Strategy `{strategy_id}`: unknown sizing `{method}`.')
+    try:
+        if method == 'fixed':
+            amount, fraction = dollars_to_cents(sizing['amount']), None
+        else:
+            amount, fraction = None, float(sizing['fraction'])
+        maximum = dollars_to_cents(sizing['max']) if sizing.get('max') is not None else None
+        max_lines = int(details['max_lines']) if details.get('max_lines') is not None else None
+    except (KeyError, TypeError, ValueError, ArithmeticError) as e:
+        raise StrategyError(f'Strategy `{strategy_id}`: invalid sizing ({e}).')
+
+    return Plan(strategy_id, filters, method, amount, fraction, maximum, max_lines)
+
+
+def get_plan(strategy_id, details):
+    """
+    Get the compiled plan of a strategy, compiling it on first use.
+    """
+    key = (strategy_id, details_hash(details))
+    plan = _plans.get(key)
+    if plan is None:
+        plan = compile_strategy(strategy_id, details)
+        _plans.set(key, plan)
+    return plan
+
+
+def fetch_open_lines(now=None, connection=None):
+    """
+    Get the open lines that haven't started yet, as a `LineBatch`.
+    """
+    connection = connection or db.session.connection()
+    now = now or datetime.utcnow()
+    rows = connection.execute(
+        select([lines.c.id, lines.c.details] + [lines.c[name] for name, _ in PROMOTED.values()])
+        .where(and_(*line_filters(status='open', start_time__gt=now)))
+        .order_by(lines.c.starts_at, lines.c.id)
+    ).fetchall()
+    return LineBatch(rows)
+
+
+def _existing(connection, fund_ids, line_ids):
+    """
+    Get the (fund, line) pairs that are already invested.
+
+    Both IN lists are chunked, each to half the bound parameter limit.
+    """
+    size = MAX_IN_PARAMS // 2
+    pairs = set()
+    fund_ids, line_ids = list(fund_ids), list(line_ids)
+    for i in range(0, len(fund_ids), size):
+        for j in range(0, len(line_ids), size):
+            pairs.update((fund_id, line_id) for fund_id, line_id in connection.execute(
+                select([investments.c.fund_id, investments.c.line_id])
+                .where(and_(investments.c.fund_id.in_(fund_ids[i:i + size]),
+                            investments.c.line_id.in_(line_ids[j:j + size])))
+            ))
+    return pairs
+
+
+def propose(batch=None, strategy_ids=None, connection=None):
+    """
+    Propose investments for every fund, from its strategy.
+
+    Parameters
+    ----------
+    batch : LineBatch, optional
+        The lines to evaluate. Defaults to the open lines.
+    strategy_ids : list of int, optional
+        Only run these strategies.
+
+    Returns
+    -------
+    list of dict
+        `fund_id`, `line_id` and `amount` (cents) of each proposed
+        investment. Lines a fund already invested in are left out.
+    """
+    connection = connection or db.session.connection()
+    batch = batch if batch is not None else fetch_open_lines(connection=connection)
+    if not len(batch):
+        return []
+
+    funds = Fund.__table__
+    fund_balances = FundBalance.__table__
+    query = select([funds.c.id, funds.c.strategy_id, func.coalesce(fund_balances.c.balance, 0)]) \
+        .select_from(funds.outerjoin(fund_balances, fund_balances.c.fund_id == funds.c.id)) \
+        .order_by(funds.c.id)
+    if strategy_ids is not None:
+        query = query.where(funds.c.strategy_id.in_(list(strategy_ids)))
+    fund_rows = connection.execute(query).fetchall()
+    if not fund_rows:
+        return []
+
+    fund_ids, fund_strategies, balances = zip(*fund_rows)
+    fund_ids = np.array(fund_ids, dtype=np.int64)
+    fund_strategies = np.array(fund_strategies, dtype=np.int64)
+    balances = np.array([int(b) for b in balances], dtype=np.int64)
+
+    strategies = Strategy.__table__
+    definitions = dict(connection.execute(
+        select([strategies.c.id, strategies.c.details])
+        .where(strategies.c.id.in_(np.unique(fund_strategies).tolist()))
+    ).fetchall())
+
+    proposals = []
+    for strategy_id, details in definitions.items():
+        try:
+            plan = get_plan(strategy_id, details)
+        except StrategyError as e:
+            current_app.logger.warning(str(e))
+            continue
+
+        selected = plan.select(batch)
+        members = np.flatnonzero(fund_strategies == strategy_id)
+        if not len(selected) or not len(members):
+            continue
+
+        stakes = plan.size(balances[members])
+        proposals.append((np.repeat(fund_ids[members], len(selected)),
+                          np.tile(batch.ids[selected], len(members)),
+                          np.repeat(stakes, len(selected))))
+
+    if not proposals:
+        return []
+
+    fund_col, line_col, amount_col = (np.concatenate(c) for c in zip(*proposals))
+    existing = _existing(connection, np.unique(fund_col).tolist(), set(line_col.tolist()))
+    return [{'fund_id': fund_id, 'line_id': line_id, 'amount': amount}
+            for fund_id, line_id, amount in zip(fund_col.tolist(), line_col.tolist(), amount_col.tolist())
+            if amount > 0 and (fund_id, line_id) not in existing]
+
+
+def place(proposals, timestamp=None, connection=None):
+    """
+    Insert proposed investments with a single `executemany`.
+    """
+    if not proposals:
+        return 0
+    connection = connection or db.session.connection()
+    timestamp = timestamp or datetime.utcnow()
+    connection.execute(investments.insert(), [dict(p, timestamp=timestamp) for p in proposals])
+    return len(proposals)
+
+
+strategies_cli = AppGroup('strategies', help='Run the fund strategies.')
+
+
+@strategies_cli.command('run')
+@click.option('--strategy', 'codes', multiple=True, help='Only run these strategies (by code).')
+@click.option('--dry-run', is_flag=True, help='Only print the proposed investments.')
+def run_command(codes, dry_run):
+    """
+    Propose (and place) investments on the open lines.
+    """
+    strategy_ids = None
+    if codes:
+        strategy_ids = [s.id for s in Strategy.query.filter(Strategy.code.in_(codes))]
+
+    proposals = propose(strategy_ids=strategy_ids)
+    total = Money(sum(p['amount'] for p in proposals))
+    if dry_run:
+        for p in proposals:
+            click.echo(f"fund {p['fund_id']}: {Money(p['amount'])} on {p['line_id']}")
+        click.echo(f'{len(proposals)} investments proposed ({total}).')
+        return
+
+    place(proposals)
+    db.session.commit()
+    click.echo(f'{len(proposals)} investments placed ({total}).')
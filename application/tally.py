@@ -0,0 +1,247 @@
+"""
+Vote tallies :: which lines each fund takes on a given day.
+
+The day's votes are pulled in one query as columns, and all the grouping
+is done with NumPy instead of walking ORM objects row by row.
+
+New votes publish the updated totals of their lines to the fund's live
+dashboards (`application.events`) when they are committed.
+"""
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import and_, case, event, func, select
+from sqlalchemy.orm import Session
+
+from application import db, events
+from application.database import MAX_IN_PARAMS
+from application.models import FundUser, LineVote
+
+# a vote with no units counts as a single unit
+DEFAULT_UNITS = 1
+
+
+def _day_bounds(day):
+    """
+    Get the [start, end) datetimes of a day.
+    """
+    start = datetime(day.year, day.month, day.day)
+    return start, start + timedelta(days=1)
+
+
+def fetch_votes(day, fund_ids=None, connection=None):
+    """
+    Pull every vote cast on a day as column arrays.
+
+    Parameters
+    ----------
+    day : date or datetime
+        The day to tally.
+    fund_ids : list of int, optional
+        Only include votes from members of these funds.
+
+    Returns
+    -------
+    dict of np.ndarray
+        `fund_id`, `fund_user_id`, `line_id` and `units` columns.
+    """
+    connection = connection or db.session.connection()
+    start, end = _day_bounds(day)
+
+    conditions = [LineVote.timestamp >= start, LineVote.timestamp < end]
+    if fund_ids is not None:
+        conditions.append(FundUser.fund_id.in_(list(fund_ids)))
+
+    result = connection.execute(
+        select([FundUser.fund_id, LineVote.fund_user_id, LineVote.line_id, LineVote.units])
+        .select_from(LineVote.__table__.join(FundUser.__table__, FundUser.id == LineVote.fund_user_id))
+        .where(and_(*conditions))
+    )
+
+    # none of these columns need result processing, so read the DBAPI
+    # cursor directly rather than building a row object per vote
+    rows = result.cursor.fetchall()
+    result.close()
+
+    if not rows:
+        return {
+            'fund_id': np.empty(0, dtype=np.int64),
+            'fund_user_id': np.empty(0, dtype=np.int64),
+            'line_id': np.empty(0, dtype=object),
+            'units': np.empty(0, dtype=np.float64)
+        }
+
+    fund_id, fund_user_id, line_id, units = zip(*rows)
+    return {
+        'fund_id': np.fromiter(fund_id, dtype=np.int64, count=len(rows)),
+        'fund_user_id': np.fromiter(fund_user_id, dtype=np.int64, count=len(rows)),
+        'line_id': np.array(line_id, dtype=object),
+        'units': np.fromiter((DEFAULT_UNITS if u is None else u for u in units),
+                             dtype=np.float64, count=len(rows))
+    }
+
+
+def _factorize(values):
+    """
+    Encode line identifiers as integer codes, in sorted order.
+
+    Hashing the strings once is much cheaper than `np.unique` on an
+    object array, which has to sort every vote's identifier.
+    """
+    codes = {}
+    idx = np.fromiter((codes.setdefault(v, len(codes)) for v in values),
+                      dtype=np.int64, count=len(values))
+
+    # renumber the codes so they follow the sorted identifiers
+    uniques = np.array(list(codes), dtype=object)
+    order = np.argsort(uniques)
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    return uniques[order], rank[idx]
+
+
+def tally(votes, member_cap=None, top=None):
+    """
+    Rank lines per fund by the units voted on them.
+
+    Parameters
+    ----------
+    votes : dict of np.ndarray
+        Column arrays, as returned by `fetch_votes`.
+    member_cap : float, optional
+        The most units a single member can put behind all of their votes
+        for the day. Members over the cap have every vote scaled down
+        proportionally.
+    top : int, optional
+        Only keep this many lines per fund.
+
+    Returns
+    -------
+    dict
+        Fund identifier to a list of `{'line_id', 'units', 'votes'}`
+        dicts, ranked by units (most first).
+    """
+    if len(votes['units']) == 0:
+        return {}
+
+    weights = votes['units']
+    if member_cap is not None:
+        members, member_idx = np.unique(votes['fund_user_id'], return_inverse=True)
+        member_totals = np.bincount(member_idx, weights=weights, minlength=len(members))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scale = np.where(member_totals > member_cap, member_cap / member_totals, 1.0)
+        weights = weights * scale[member_idx]
+
+    # group by (fund, line) with a single combined key
+    funds, fund_idx = np.unique(votes['fund_id'], return_inverse=True)
+    lines, line_idx = _factorize(votes['line_id'])
+    keys, key_idx = np.unique(fund_idx.astype(np.int64) * len(lines) + line_idx, return_inverse=True)
+
+    totals = np.bincount(key_idx, weights=weights, minlength=len(keys))
+    counts = np.bincount(key_idx, minlength=len(keys))
+    key_fund = keys // len(lines)
+    key_line = keys % len(lines)
+
+    # order by fund, then units descending, then line for stable ties
+    order = np.lexsort((key_line, -totals, key_fund))
+    boundaries = np.flatnonzero(np.diff(key_fund[order])) + 1
+
+    # build the output from plain lists, indexing numpy scalars is slow
+    line_ids = lines[key_line[order]].tolist()
+    units = totals[order].tolist()
+    n_votes = counts[order].tolist()
+    fund_ids = funds[key_fund[order[np.r_[0, boundaries]]]].tolist()
+
+    ranked = {}
+    for fund_id, start, end in zip(fund_ids, np.r_[0, boundaries].tolist(),
+                                   np.r_[boundaries, len(order)].tolist()):
+        if top is not None:
+            end = min(end, start + top)
+        ranked[fund_id] = [
+            {'line_id': line_ids[i], 'units': units[i], 'votes': n_votes[i]}
+            for i in range(start, end)
+        ]
+    return ranked
+
+
+def tally_day(day, fund_ids=None, member_cap=None, top=None):
+    """
+    Fetch and tally every vote cast on a day.
+
+    See `fetch_votes` and `tally` for the parameters.
+    """
+    return tally(fetch_votes(day, fund_ids), member_cap=member_cap, top=top)
+
+
+def line_totals(connection, day, fund_user_ids, line_ids):
+    """
+    Get the units and votes of some lines on a day, for the funds of some
+    members.
+
+    Returns
+    -------
+    dict
+        Fund identifier to `{line_id: {'units', 'votes'}}`.
+    """
+    start, end = _day_bounds(day)
+    votes, fund_users = LineVote.__table__, FundUser.__table__
+    units = case([(votes.c.units.is_(None), DEFAULT_UNITS)], else_=votes.c.units)
+
+    # the members' funds first, so the IN lists are funds and lines, each
+    # chunked to half the bound parameter limit
+    fund_user_ids, fund_ids = list(fund_user_ids), set()
+    for i in range(0, len(fund_user_ids), MAX_IN_PARAMS):
+        fund_ids.update(fund_id for fund_id, in connection.execute(
+            select([fund_users.c.fund_id]).distinct()
+            .where(fund_users.c.id.in_(fund_user_ids[i:i + MAX_IN_PARAMS]))
+        ))
+
+    size = MAX_IN_PARAMS // 2
+    fund_ids, line_ids = sorted(fund_ids), list(line_ids)
+    totals = {}
+    for i in range(0, len(fund_ids), size):
+        for j in range(0, len(line_ids), size):
+            for fund_id, line_id, total, count in connection.execute(
+                select([fund_users.c.fund_id, votes.c.line_id, func.sum(units), func.count()])
+                .select_from(votes.join(fund_users, fund_users.c.id == votes.c.fund_user_id))
+                .where(and_(fund_users.c.fund_id.in_(fund_ids[i:i + size]),
+                            votes.c.line_id.in_(line_ids[j:j + size]),
+                            votes.c.timestamp >= start, votes.c.timestamp < end))
+                .group_by(fund_users.c.fund_id, votes.c.line_id)
+            ):
+                totals.setdefault(fund_id, {})[line_id] = {'units': float(total), 'votes': count}
+    return totals
+
+
+def publish_votes(connection, votes):
+    """
+    Publish the new totals of the lines some votes were cast on, once the
+    transaction commits.
+
+    Parameters
+    ----------
+    votes : iterable of dict
+        The new votes, with `fund_user_id`, `line_id` and `timestamp`.
+    """
+    if not events.wanted():
+        return
+
+    days = {}
+    for vote in votes:
+        day = (vote.get('timestamp') or datetime.utcnow()).date()
+        fund_user_ids, line_ids = days.setdefault(day, (set(), set()))
+        fund_user_ids.add(vote['fund_user_id'])
+        line_ids.add(vote['line_id'])
+
+    for day, (fund_user_ids, line_ids) in days.items():
+        for fund_id, lines in line_totals(connection, day, fund_user_ids, line_ids).items():
+            events.publish(fund_id, 'votes', {'fund_id': fund_id, 'day': day.isoformat(), 'lines': lines},
+                           connection)
+
+
+@event.listens_for(Session, 'after_flush')
+def _publish_new_votes(session, flush_context):
+    votes = [{'fund_user_id': vote.fund_user_id, 'line_id': vote.line_id, 'timestamp': vote.timestamp}
+             for vote in session.new if isinstance(vote, LineVote)]
+    if votes:
+        publish_votes(session.connection(), votes)
@@ -0,0 +1,463 @@
+"""
+Request metrics :: latency, in-flight requests, response sizes and password
+hashing time, in the Prometheus text exposition format (see `/metrics`).
+
+Recording is lock-free: an observation is one `deque.append` (atomic under
+the GIL). A background thread per process drains the deque into that
+process's values, and since it is their only writer it needs no lock
+either. Values lag observations by at most `METRICS_FLUSH_INTERVAL`.
+
+Under gunicorn every worker is its own process. With `METRICS_DIR` set,
+each keeps its values in memory-mapped files of that directory
+(`<pid>.db`, and `live_<pid>.db` for gauges that only count live
+processes), and `/metrics` sums the files of every worker, whichever
+worker serves it. `gunicorn.conf.py` empties the directory on start and
+drops the live gauges of workers that exit. Without `METRICS_DIR`, values
+stay in the process.
+"""
+import bisect
+import glob
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import deque
+
+from flask import g, request
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# request latency, in seconds
+LATENCY_BUCKETS = (.005, .01, .025, .05, .075, .1, .25, .5, .75, 1.0, 2.5, 5.0, 10.0)
+
+# response sizes, in bytes
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+# password hashing, in seconds (the profiles run from ~1ms to ~1s)
+HASH_BUCKETS = (.001, .005, .01, .05, .1, .25, .5, 1.0, 2.5)
+
+
+class MmapValues:
+    """
+    Float values by key, in a memory-mapped file with a single writer.
+
+    The file is an 8 byte header (the bytes used), then one entry per key:
+    its length (4 bytes), the key (padded so the value is 8 byte aligned)
+    and the value (a double).
+
+    Parameters
+    ----------
+    path : str
+        The file, created if missing.
+    """
+
+    INITIAL_SIZE = 1 << 16
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'a+b')
+        size = os.fstat(self._file.fileno()).st_size
+        if size < self.INITIAL_SIZE:
+            self._file.truncate(self.INITIAL_SIZE)
+            size = self.INITIAL_SIZE
+        self._mmap = mmap.mmap(self._file.fileno(), size)
+        self._used = struct.unpack_from('Q', self._mmap, 0)[0] or 8
+        self._positions = {key: position for key, _, position in _entries(self._mmap, self._used)}
+
+    def _insert(self, key):
+        encoded = key.encode()
+        padding = (8 - (4 + len(encoded)) % 8) % 8
+        entry = struct.pack('i', len(encoded)) + encoded + b' ' * padding + struct.pack('d', 0.0)
+
+        if self._used + len(entry) > len(self._mmap):
+            size = len(self._mmap)
+            while self._used + len(entry) > size:
+                size *= 2
+            self._mmap.close()
+            self._file.truncate(size)
+            self._mmap = mmap.mmap(self._file.fileno(), size)
+
+        # write the entry before the header, so readers never see half of it
+        self._mmap[self._used:self._used + len(entry)] = entry
+        position = self._used + len(entry) - 8
+        self._used += len(entry)
+        struct.pack_into('Q', self._mmap, 0, self._used)
+        self._positions[key] = position
+        return position
+
+    def add(self, key, amount):
+        position = self._positions.get(key)
+        if position is None:
+            position = self._insert(key)
+        value = struct.unpack_from('d', self._mmap, position)[0]
+        struct.pack_into('d', self._mmap, position, value + amount)
+
+    def items(self):
+        return [(key, value) for key, value, _ in _entries(self._mmap, self._used)]
+
+
+def _entries(buffer, used):
+    """
+    Yield the `(key, value, value position)` of every entry of a values file.
+    """
+    position = 8
+    while position < used:
+        length = struct.unpack_from('i', buffer, position)[0]
+        key = bytes(buffer[position + 4:position + 4 + length]).decode()
+        position += 4 + length + (8 - (4 + length) % 8) % 8
+        yield key, struct.unpack_from('d', buffer, position)[0], position
+        position += 8
+
+
+def read_values(path):
+    """
+    Read every `(key, value)` of a values file (written by any process).
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < 8:
+        return []
+    used = struct.unpack_from('Q', data, 0)[0]
+    return [(key, value) for key, value, _ in _entries(data, min(used, len(data)))]
+
+
+class DictValues:
+    """
+    Float values by key, in the process.
+    """
+
+    def __init__(self):
+        self._values = {}
+
+    def add(self, key, amount):
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def items(self):
+        return list(self._values.items())
+
+
+class Registry:
+    """
+    Every metric, and the values of this process.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.enabled = False
+        self.directory = None
+        self.interval = 1.0
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._values = None
+        self._live = None
+        self._thread = None
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def configure(self, directory=None, interval=1.0):
+        """
+        Start recording, to `directory` when shared between processes.
+        """
+        self.directory = directory
+        self.interval = interval
+        self.enabled = True
+
+    def _forked(self):
+        # the parent's values, queue and flusher don't carry over
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._values = self._live = self._thread = None
+
+    def record(self, metric, labels, value):
+        """
+        Queue an observation.
+        """
+        if not self.enabled:
+            return
+        if self._thread is None:
+            self._start()
+        self._queue.append((metric, labels, value))
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='metrics-flusher', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def _open(self):
+        if self.directory:
+            pid = os.getpid()
+            self._values = MmapValues(os.path.join(self.directory, f'{pid}.db'))
+            self._live = MmapValues(os.path.join(self.directory, f'live_{pid}.db'))
+        else:
+            self._values = DictValues()
+            self._live = DictValues()
+
+    def flush(self):
+        """
+        Apply the queued observations to this process's values.
+        """
+        with self._lock:
+            if self._values is None:
+                self._open()
+            queue = self._queue
+            while queue:
+                metric, labels, value = queue.popleft()
+                metric.apply(self._live if metric.live else self._values, labels, value)
+
+    def collect(self):
+        """
+        Sum the values of every process (or just this one).
+
+        Returns
+        -------
+        dict
+            Key to value.
+        """
+        self.flush()
+        if self.directory:
+            items = []
+            for path in glob.glob(os.path.join(self.directory, '*.db')):
+                try:
+                    items += read_values(path)
+                except OSError:
+                    # a worker exited while we were reading
+                    continue
+        else:
+            items = self._values.items() + self._live.items()
+
+        totals = {}
+        for key, value in items:
+            totals[key] = totals.get(key, 0.0) + value
+        return totals
+
+    def exposition(self):
+        """
+        Render every metric in the text exposition format.
+        """
+        samples = {}
+        for key, value in self.collect().items():
+            name, suffix, labels, le = json.loads(key)
+            samples.setdefault(name, []).append((suffix, tuple(labels), le, value))
+
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.family} {metric.documentation}')
+            lines.append(f'# TYPE {metric.family} {metric.kind}')
+            lines += metric.render(samples.get(metric.name, []))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+os.register_at_fork(after_in_child=REGISTRY._forked)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_labels(names, values, le=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _key(name, suffix, labels, le=None):
+    return json.dumps([name, suffix, list(labels), le])
+
+
+class Metric:
+    """
+    A named metric with some labels. Label values are passed positionally,
+    in the order of `labelnames`.
+    """
+    kind = None
+    live = False
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.registry = registry
+        registry.register(self)
+
+    @property
+    def family(self):
+        """
+        The name of the metric family in the exposition.
+        """
+        return self.name
+
+    def apply(self, values, labels, value):
+        values.add(_key(self.name, '', labels), value)
+
+    def render(self, samples):
+        return [f'{self.name}{suffix}{_format_labels(self.labelnames, labels)} {value}'
+                for suffix, labels, _, value in sorted(samples)]
+
+
+class Counter(Metric):
+    """
+    A count that only goes up.
+    """
+    kind = 'counter'
+
+    @property
+    def family(self):
+        # its samples are `<name>_total`, and so must be its HELP and TYPE
+        return f'{self.name}_total'
+
+    def inc(self, *labels, amount=1):
+        self.registry.record(self, labels, amount)
+
+    def apply(self, values, labels, value):
+        values.add(_key(self.name, '_total', labels), value)
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down, summed over the live processes.
+    """
+    kind = 'gauge'
+    live = True
+
+    def inc(self, *labels, amount=1):
+        self.registry.record(self, labels, amount)
+
+    def dec(self, *labels, amount=1):
+        self.registry.record(self, labels, -amount)
+
+
+class Histogram(Metric):
+    """
+    Observations counted in buckets, with their sum and count.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(buckets)
+        self._les = [repr(float(bound)) for bound in self.buckets] + ['+Inf']
+
+    def observe(self, value, *labels):
+        self.registry.record(self, labels, value)
+
+    def apply(self, values, labels, value):
+        # buckets are stored per bucket, and made cumulative on render
+        le = self._les[bisect.bisect_left(self.buckets, value)]
+        values.add(_key(self.name, '_bucket', labels, le), 1)
+        values.add(_key(self.name, '_sum', labels), value)
+        values.add(_key(self.name, '_count', labels), 1)
+
+    def render(self, samples):
+        series = {}
+        for suffix, labels, le, value in samples:
+            buckets, totals = series.setdefault(labels, ({}, {}))
+            if suffix == '_bucket':
+                buckets[le] = value
+            else:
+                totals[suffix] = value
+
+        lines = []
+        for labels in sorted(series):
+            buckets, totals = series[labels]
+            cumulative = 0.0
+            for le in self._les:
+                cumulative += buckets.get(le, 0.0)
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}')
+            for suffix in ('_sum', '_count'):
+                lines.append(f'{self.name}{suffix}{_format_labels(self.labelnames, labels)} '
+                             f'{totals.get(suffix, 0.0)}')
+        return lines
+
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'Request latency, until the response is fully sent.',
+    ('blueprint', 'endpoint', 'method'), LATENCY_BUCKETS)
+REQUESTS = Counter(
+    'http_requests', 'Requests served.', ('blueprint', 'endpoint', 'method', 'status'))
+IN_FLIGHT = Gauge(
+    'http_requests_in_flight', 'Requests being served.')
+RESPONSE_SIZE = Histogram(
+    'http_response_size_bytes', 'Response body sizes (of responses with a known length).',
+    ('blueprint', 'endpoint'), SIZE_BUCKETS)
+PASSWORD_HASH = Histogram(
+    'password_hash_seconds', 'Time spent hashing or checking a password (excluding queueing).',
+    ('operation',), HASH_BUCKETS)
+PASSWORD_HASH_BUSY = Counter(
+    'password_hash_busy', 'Password hashes refused because the hashing pool was full.')
+RATELIMIT_REJECTED = Counter(
+    'ratelimit_rejected', 'Attempts refused by a rate limit, by limit and key kind.', ('limit', 'key'))
+
+
+def _labels():
+    return request.blueprint or '', request.endpoint or 'unknown'
+
+
+def _before_request():
+    g.metrics_start = time.perf_counter()
+    IN_FLIGHT.inc()
+
+
+def _after_request(response):
+    g.metrics_status = response.status_code
+    size = response.calculate_content_length()
+    if size is not None:
+        RESPONSE_SIZE.observe(size, *_labels())
+    return response
+
+
+def _teardown_request(exception=None):
+    start = g.pop('metrics_start', None)
+    if start is None:
+        return
+    blueprint, endpoint = _labels()
+    REQUEST_LATENCY.observe(time.perf_counter() - start, blueprint, endpoint, request.method)
+    REQUESTS.inc(blueprint, endpoint, request.method, str(g.pop('metrics_status', 500)))
+    IN_FLIGHT.dec()
+
+
+def init_app(app):
+    """
+    Record request metrics for the app.
+    """
+    if not app.config.get('METRICS_ENABLED', True):
+        return
+
+    directory = app.config.get('METRICS_DIR')
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    REGISTRY.configure(directory, app.config.get('METRICS_FLUSH_INTERVAL', 1.0))
+    app.extensions['telemetry'] = REGISTRY
+
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+
+
+def mark_process_dead(pid, directory):
+    """
+    Drop the live gauges of a dead worker (its counters stay, they are
+    still part of the totals).
+    """
+    try:
+        os.remove(os.path.join(directory, f'live_{pid}.db'))
+    except FileNotFoundError:
+        pass
+
+
+def clear_directory(directory):
+    """
+    Remove every values file, i.e. when the server (re)starts.
+    """
+    for path in glob.glob(os.path.join(directory, '*.db')):
+        os.remove(path)
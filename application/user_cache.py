@@ -0,0 +1,97 @@
+"""
+Cached user loading for Flask-Login.
+
+Flask-Login already keeps the loaded user on `g` for the rest of a
+request, so this only has to avoid the `users` lookup across requests.
+Users are cached by id as plain column values (never the password hash),
+and re-attached to the session without a query on a hit. Any ORM update
+or delete of a `User` invalidates its entry.
+
+Invalidation only reaches the cache it's made in. With the default
+in-process cache, a user edited or deleted through another worker or the
+CLI is served stale (still logged in, if deleted) until the entry
+expires, after `USER_CACHE_TTL` seconds: production keeps that to 10
+seconds, unless `USER_CACHE_URL` shares a Redis cache between every
+process.
+"""
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import make_transient_to_detached, object_session
+
+from application import db, login_manager
+from application.cache import make_cache
+from application.models import User
+
+# the password is lazy loaded on the rare request that needs it
+CACHED_COLUMNS = [c.key for c in User.__table__.columns if c.key != 'password']
+
+
+def init_app(app):
+    """
+    Create the user cache from the app configuration.
+    """
+    app.extensions['user_cache'] = make_cache(
+        app.config.get('USER_CACHE_URL'),
+        namespace='users',
+        maxsize=app.config.get('USER_CACHE_SIZE', 10000),
+        ttl=app.config.get('USER_CACHE_TTL', 300)
+    )
+
+
+def get_cache():
+    """
+    Get the user cache of the current app.
+    """
+    return current_app.extensions['user_cache']
+
+
+def invalidate(user_id):
+    """
+    Drop a user from the cache.
+    """
+    if has_app_context() and 'user_cache' in current_app.extensions:
+        get_cache().delete(user_id)
+
+
+@login_manager.user_loader
+def load_user(user_id):
+    """
+    Check if user is logged-in on every page load.
+    """
+    if user_id is None:
+        return None
+
+    try:
+        user_id = int(user_id)
+    except ValueError:
+        return None
+
+    cache = get_cache()
+    data = cache.get(user_id)
+    if data is None:
+        user = User.query.get(user_id)
+        if user is not None:
+            cache.set(user_id, {c: getattr(user, c) for c in CACHED_COLUMNS})
+        return user
+
+    # rebuild the user as if it had just been loaded, and attach it
+    # to the session without going back to the database
+    user = User(**data)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def invalidate_user(mapper, connection, target):
+    invalidate(target.id)
+
+    # and again on commit, in case another request cached the old
+    # row between this flush and the commit
+    object_session(target).info.setdefault('modified_users', set()).add(target.id)
+
+
+@event.listens_for(db.session, 'after_commit')
+def invalidate_committed(session):
+    for user_id in session.info.pop('modified_users', ()):
+        invalidate(user_id)
@@ -0,0 +1,297 @@
+"""
+Vote submission :: a member's whole slate of votes, written in bulk.
+
+A slate is checked in one query (the member belongs to the fund, every
+line exists and is open), then handed to the app's `CoalescingWriter`.
+The writer holds the slates of concurrent requests for up to
+`VOTES_FLUSH_INTERVAL` seconds (or until `VOTES_FLUSH_ROWS` votes are
+waiting) and writes them together, in one bulk upsert. A storm of
+game-day requests becomes a handful of statements, and a request returns
+once its votes are committed. A request that times out first gets a 503
+if its votes were still waiting (they are withdrawn), or a 202 if the
+writer already has them.
+
+A member has one vote per line and day, enforced by a unique index:
+voting on a line again replaces the vote, so a retried slate is not
+counted twice, whichever process writes it. New totals are published to
+the fund's live dashboards (see `application.tally`).
+"""
+import logging
+import threading
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import and_, select
+
+from application import db, tally
+from application.models import FundUser, Line, LineVote
+from application.startup import ProcessThread
+
+logger = logging.getLogger(__name__)
+
+# only open lines take votes
+OPEN = 'open'
+
+
+class InvalidVotes(ValueError):
+    """
+    Raised for a malformed slate, or votes on unknown or closed lines.
+    """
+
+
+class VotesBusy(Exception):
+    """
+    Raised when the writer is too far behind to take more votes.
+    """
+
+
+def parse_slate(payload, max_votes=100, max_units=100):
+    """
+    Parse a slate: `{"fund_id": 1, "votes": [{"line_id": "...", "units": 2}]}`.
+
+    Returns
+    -------
+    tuple
+        The fund identifier, and a dict of line identifier to units.
+    """
+    if not isinstance(payload, dict):
+        raise InvalidVotes('Expected a JSON object.')
+
+    fund_id = payload.get('fund_id')
+    if not isinstance(fund_id, int) or isinstance(fund_id, bool):
+        raise InvalidVotes('`fund_id` must be an integer.')
+
+    votes = payload.get('votes')
+    if not isinstance(votes, list) or not votes:
+        raise InvalidVotes('`votes` must be a non-empty list.')
+    if len(votes) > max_votes:
+        raise InvalidVotes(f'At most {max_votes} votes at a time.')
+
+    slate = {}
+    for vote in votes:
+        line_id = vote.get('line_id') if isinstance(vote, dict) else None
+        units = vote.get('units') if isinstance(vote, dict) else None
+        if not isinstance(line_id, str) or not line_id:
+            raise InvalidVotes('Every vote needs a `line_id`.')
+        if not isinstance(units, int) or isinstance(units, bool) or not 1 <= units <= max_units:
+            raise InvalidVotes(f'`units` must be an integer from 1 to {max_units}.')
+        if line_id in slate:
+            raise InvalidVotes(f'Line `{line_id}` is voted on twice.')
+        slate[line_id] = units
+    return fund_id, slate
+
+
+def validate(user_id, fund_id, line_ids, connection=None):
+    """
+    Check a user belongs to a fund, and that some lines are open, in one
+    query.
+
+    Returns
+    -------
+    int or None
+        The user's fund user identifier, `None` if they aren't a member.
+    """
+    connection = connection or db.session.connection()
+    fund_users, lines = FundUser.__table__, Line.__table__
+    rows = connection.execute(
+        select([fund_users.c.id, lines.c.id, lines.c.status])
+        .select_from(fund_users.outerjoin(lines, lines.c.id.in_(list(line_ids))))
+        .where(and_(fund_users.c.fund_id == fund_id, fund_users.c.user_id == user_id))
+    ).fetchall()
+    if not rows:
+        return None
+
+    found = {line_id: status for _, line_id, status in rows if line_id is not None}
+    unknown = sorted(line_id for line_id in line_ids if line_id not in found)
+    if unknown:
+        raise InvalidVotes(f"Unknown lines: {', '.join(unknown)}.")
+    closed = sorted(line_id for line_id, status in found.items() if status != OPEN)
+    if closed:
+        raise InvalidVotes(f"Lines not open for votes: {', '.join(closed)}.")
+    return rows[0][0]
+
+
+def _upsert(connection, rows):
+    """
+    Insert votes, replacing the vote of the same member, line and day.
+    """
+    table = LineVote.__table__
+    if connection.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+
+        statement = insert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.fund_user_id, table.c.line_id, table.c.vote_day],
+            set_={'units': statement.excluded.units, 'timestamp': statement.excluded.timestamp}
+        )
+    else:
+        # SQLite
+        statement = table.insert().prefix_with('OR REPLACE')
+    connection.execute(statement, rows)
+
+
+def write_votes(connection, votes):
+    """
+    Upsert votes: replace each member's vote on a line that day, or add it.
+
+    Parameters
+    ----------
+    votes : list of dict
+        `fund_user_id`, `line_id`, `units` and `timestamp` of each vote.
+        Later votes win over earlier ones for the same member, line and day.
+
+    Returns
+    -------
+    int
+        The votes written.
+    """
+    latest = {(vote['fund_user_id'], vote['line_id'], vote['timestamp'].date()): vote for vote in votes}
+    if not latest:
+        return 0
+
+    _upsert(connection, [{**vote, 'vote_day': day} for (_, _, day), vote in latest.items()])
+    tally.publish_votes(connection, list(latest.values()))
+    return len(latest)
+
+
+class Submission:
+    """
+    One request's votes, waiting to be written.
+    """
+
+    def __init__(self, votes):
+        self.votes = votes
+        self.error = None
+        self.done = threading.Event()
+
+
+class CoalescingWriter:
+    """
+    Writes the votes of concurrent requests together.
+
+    Parameters
+    ----------
+    app : flask.Flask
+        The app, for its database.
+    interval : float
+        Seconds votes wait for others before they are written.
+    max_rows : int
+        Write straight away once this many votes are waiting.
+    max_pending : int
+        The most votes waiting; past that `VotesBusy` is raised.
+    timeout : float
+        Seconds a request waits for its votes to be written.
+    """
+
+    def __init__(self, app, interval=0.05, max_rows=1000, max_pending=20000, timeout=5.0):
+        self.app = app
+        self.interval = interval
+        self.max_rows = max_rows
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._pending = []
+        self._rows = 0
+        self._wake = threading.Event()
+        self._full = threading.Event()
+        self._writer = ProcessThread(self._run, 'votes-writer')
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            # let the other requests of the burst join in
+            self._full.wait(self.interval)
+            with self._lock:
+                batch, self._pending, self._rows = self._pending, [], 0
+                self._wake.clear()
+                self._full.clear()
+            self.flush(batch)
+
+    def flush(self, batch):
+        """
+        Write some submissions in one transaction. If that fails, write
+        them one at a time, so one bad slate doesn't fail the others.
+        """
+        with self.app.app_context():
+            try:
+                with db.engine.begin() as connection:
+                    written = write_votes(
+                        connection, [vote for submission in batch for vote in submission.votes])
+                logger.debug('Wrote %d slates: %d votes.', len(batch), written)
+            except Exception as error:
+                if len(batch) == 1:
+                    batch[0].error = error
+                else:
+                    for submission in batch:
+                        self.flush([submission])
+            finally:
+                for submission in batch:
+                    submission.done.set()
+
+    def submit(self, votes):
+        """
+        Queue votes, and wait until they are written.
+
+        Returns
+        -------
+        bool
+            `True` once the votes are committed, `False` if the writer
+            took them but is still writing them after `timeout`.
+        """
+        self._writer.start()
+        submission = Submission(votes)
+        with self._lock:
+            if self._rows + len(votes) > self.max_pending:
+                raise VotesBusy('Too many votes waiting to be written.')
+            self._pending.append(submission)
+            self._rows += len(votes)
+            if self._rows >= self.max_rows:
+                self._full.set()
+        self._wake.set()
+
+        if not submission.done.wait(self.timeout):
+            with self._lock:
+                # withdraw the votes if the writer hasn't taken them yet
+                if submission in self._pending:
+                    self._pending.remove(submission)
+                    self._rows -= len(votes)
+                    raise VotesBusy('Timed out waiting for the votes to be written.')
+            return False
+        if submission.error is not None:
+            raise submission.error
+        return True
+
+
+def init_app(app):
+    """
+    Create the vote writer from the app configuration (none, and votes
+    are written by the request itself, with a zero flush interval).
+    """
+    interval = app.config.get('VOTES_FLUSH_INTERVAL', 0.05)
+    if interval:
+        app.extensions['votes'] = CoalescingWriter(
+            app,
+            interval=interval,
+            max_rows=app.config.get('VOTES_FLUSH_ROWS', 1000),
+            max_pending=app.config.get('VOTES_QUEUE_ROWS', 20000),
+            timeout=app.config.get('VOTES_TIMEOUT', 5.0)
+        )
+
+
+def submit(fund_user_id, slate, timestamp=None):
+    """
+    Write a member's slate of votes (line identifier to units).
+
+    Returns `True` once the votes are committed, `False` if they were
+    accepted but are still being written.
+    """
+    timestamp = timestamp or datetime.utcnow()
+    votes = [{'fund_user_id': fund_user_id, 'line_id': line_id, 'units': units, 'timestamp': timestamp}
+             for line_id, units in slate.items()]
+
+    writer = current_app.extensions.get('votes')
+    if writer is None:
+        with db.engine.begin() as connection:
+            write_votes(connection, votes)
+        return True
+    return writer.submit(votes)
@@ -0,0 +1,84 @@
+"""
+Benchmark line ingestion throughput.
+
+Writes a JSONL feed of `--lines` lines, ingests it into an empty table,
+then ingests a second feed where `--changed` of the lines have new odds,
+and reports lines per second for each pass.
+
+The benchmark database is dropped and recreated, so it is a scratch one
+(`--database-url` or `BENCH_DATABASE_URL`), never `DATABASE_URL`.
+
+    $ python benchmarks/bench_ingest.py --lines 100000
+    $ python benchmarks/bench_ingest.py --database-url postgresql://localhost/betfund_bench
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from random import Random
+
+from application import create_app, db
+from application.ingest import ingest, read_feed
+
+SCRATCH_DATABASE_URL = os.environ.get(
+    'BENCH_DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.gettempdir(), 'betfund_bench.db'))
+
+SPORTS = ['NFL', 'NBA', 'MLB', 'NHL']
+
+
+def write_feed(path, n, rand, changed=0.0):
+    """
+    Write a feed of `n` lines, with a fraction of the prices moved.
+    """
+    with open(path, 'w') as f:
+        for i in range(n):
+            price = 100 + i % 200
+            if rand.random() < changed:
+                price += rand.choice([-5, 5])
+            f.write(json.dumps({
+                'id': f'{i:064x}',
+                'sport': SPORTS[i % len(SPORTS)],
+                'market_type': 'moneyline',
+                'price': price,
+                'start_time': f'2020-09-{1 + i % 28:02d}T17:00:00',
+                'status': 'open'
+            }) + '\n')
+
+
+def run(label, path, batch_size):
+    """
+    Ingest a feed and print the throughput.
+    """
+    start = time.perf_counter()
+    stats = ingest(read_feed(path), batch_size)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<10} {stats['read']:>8} read {stats['inserted']:>8} inserted "
+          f"{stats['updated']:>8} updated  {stats['read'] / elapsed:>9.0f} lines/s")
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(prog='bench_ingest')
+    parser.add_argument('--lines', type=int, default=100000)
+    parser.add_argument('--changed', type=float, default=0.1,
+                        help="Fraction of lines that change between feeds.")
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--database-url', default=SCRATCH_DATABASE_URL,
+                        help="The scratch database, dropped and recreated.")
+    args = parser.parse_args()
+
+    rand = Random(0)
+    os.environ['DATABASE_URL'] = args.database_url
+    app = create_app()
+    with app.app_context(), tempfile.TemporaryDirectory() as tmp:
+        db.drop_all()
+        db.create_all()
+
+        first, second = os.path.join(tmp, 'first.jsonl'), os.path.join(tmp, 'second.jsonl')
+        write_feed(first, args.lines, rand)
+        write_feed(second, args.lines, rand, args.changed)
+
+        run('initial', first, args.batch_size)
+        run('unchanged', first, args.batch_size)
+        run('changed', second, args.batch_size)
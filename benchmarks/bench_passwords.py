@@ -0,0 +1,51 @@
+"""
+Benchmark password hashing profiles on this host.
+
+Reports hashes per second for each profile, on one thread and across a
+number of threads, to size `PASSWORD_HASH_WORKERS` and the WSGI workers.
+
+    $ python benchmarks/bench_passwords.py --threads 1 2 4
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from application.passwords import PROFILES, _check, _hash
+
+
+def hashes_per_second(method, threads=1, duration=2.0):
+    """
+    Hash and verify passwords for `duration` seconds, and count them.
+    """
+    stop = time.perf_counter() + duration
+
+    def work():
+        count = 0
+        while time.perf_counter() < stop:
+            _check(_hash('correct horse battery staple', method), 'correct horse battery staple')
+            count += 2
+        return count
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        total = sum(pool.map(lambda _: work(), range(threads)))
+    return total / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(prog='bench_passwords')
+    parser.add_argument('--profiles', nargs='+', default=sorted(PROFILES),
+                        help="The profiles to benchmark.")
+    parser.add_argument('--threads', nargs='+', type=int, default=[1, 2, 4],
+                        help="Thread counts to run each profile with.")
+    parser.add_argument('--duration', type=float, default=2.0,
+                        help="Seconds to run each measurement for.")
+    args = parser.parse_args()
+
+    print(f"{'profile':<10} {'method':<24} {'threads':>7} {'hashes/s':>10} {'ms/hash':>9}")
+    for profile in args.profiles:
+        method = PROFILES[profile]
+        for threads in args.threads:
+            rate = hashes_per_second(method, threads, args.duration)
+            print(f'{profile:<10} {method:<24} {threads:>7} {rate:>10.1f} {1000 * threads / rate:>9.2f}')
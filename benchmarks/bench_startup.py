@@ -0,0 +1,178 @@
+"""
+Benchmark app startup: the import-time breakdown of `create_app`, and boot
+and first-request times with and without lazily loaded blueprints.
+
+Every run is a fresh interpreter, so nothing is already imported. Keep the
+JSON reports (`--output`) to track boot time from release to release.
+
+    $ python benchmarks/bench_startup.py --repeat 5 --top 20
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+from collections import defaultdict
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# boot against a scratch database unless told otherwise
+DATABASE_URL = os.environ.get(
+    'DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.gettempdir(), 'betfund_bench.db'))
+
+# run in a fresh interpreter; prints its timings as JSON
+BOOT = '''
+import json, time
+start = time.perf_counter()
+from application import create_app
+imported = time.perf_counter()
+app = create_app()
+created = time.perf_counter()
+client = app.test_client()
+firsts = {}
+for path in PATHS:
+    before = time.perf_counter()
+    client.get(path)
+    firsts[path] = time.perf_counter() - before
+print(json.dumps({
+    'import': imported - start,
+    'create_app': created - imported,
+    'first_requests': firsts
+}))
+'''
+
+MODES = {
+    'eager': {'LAZY_BLUEPRINTS': '0'},
+    'lazy': {'LAZY_BLUEPRINTS': '1'}
+}
+
+PATHS = ('/', '/login', '/dashboard')
+
+
+def _environ(mode):
+    environ = dict(os.environ, DATABASE_URL=DATABASE_URL, **MODES[mode])
+    # lazy blueprints are off in debug mode, which the test config enables
+    environ.setdefault('FLASK_CONFIGURATION', 'production')
+    environ.setdefault('SECRET_KEY', 'bench')
+    environ['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, environ.get('PYTHONPATH')]))
+    return environ
+
+
+def boot(mode, paths=PATHS):
+    """
+    Boot the app in a fresh interpreter, and request some paths.
+
+    Returns
+    -------
+    dict
+        Seconds importing `application`, in `create_app`, and serving
+        each path for the first time.
+    """
+    code = f'PATHS = {tuple(paths)!r}\n' + BOOT
+    output = subprocess.check_output([sys.executable, '-c', code], env=_environ(mode), cwd=ROOT)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def import_times(mode):
+    """
+    Import `application` and create the app under `-X importtime`.
+
+    Returns
+    -------
+    list of tuple
+        `(module, depth, self seconds, cumulative seconds)` per import.
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'from application import create_app; create_app()'],
+        env=_environ(mode), cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+
+    imports = []
+    for line in result.stderr.decode().splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), depth, int(self_us) / 1e6, int(cumulative_us) / 1e6))
+    return imports
+
+
+def breakdown(imports, top=20):
+    """
+    Sum the import times per package (`application` per module), and pick
+    the slowest imports (their own imports included).
+    """
+    packages = defaultdict(float)
+    for name, _, self_time, _ in imports:
+        parts = name.split('.')
+        packages['.'.join(parts[:2]) if parts[0] == 'application' else parts[0]] += self_time
+
+    slowest = sorted(imports, key=lambda item: -item[3])
+    return {
+        'total': round(sum(item[3] for item in imports if item[1] == 0), 4),
+        'packages': {name: round(seconds, 4) for name, seconds
+                     in sorted(packages.items(), key=lambda item: -item[1])[:top]},
+        'slowest': [{'module': name, 'cumulative': round(cumulative, 4)}
+                    for name, _, _, cumulative in slowest[:top]]
+    }
+
+
+def _median(runs, key):
+    return round(statistics.median(run[key] for run in runs), 4)
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(prog='bench_startup')
+    parser.add_argument('--modes', nargs='+', default=list(MODES), choices=list(MODES),
+                        help="Eager and/or lazy blueprint loading.")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="Boots per mode (the medians are reported).")
+    parser.add_argument('--top', type=int, default=20,
+                        help="Packages and imports to list.")
+    parser.add_argument('--output', help="Write the JSON report here.")
+    args = parser.parse_args()
+
+    report = {
+        'created': datetime.utcnow().isoformat(),
+        'commit': _commit(),
+        'python': platform.python_version(),
+        'modes': {}
+    }
+    for mode in args.modes:
+        runs = [boot(mode) for _ in range(args.repeat)]
+        imports = breakdown(import_times(mode), args.top)
+        report['modes'][mode] = result = {
+            'import': _median(runs, 'import'),
+            'create_app': _median(runs, 'create_app'),
+            'first_requests': {path: round(statistics.median(run['first_requests'][path] for run in runs), 4)
+                               for path in PATHS},
+            'imports': imports
+        }
+
+        print(f"\n{mode}: import {result['import'] * 1000:.0f} ms, "
+              f"create_app {result['create_app'] * 1000:.0f} ms "
+              f"(importtime total {imports['total'] * 1000:.0f} ms)")
+        for path, seconds in result['first_requests'].items():
+            print(f'  first {path:<12} {seconds * 1000:8.1f} ms')
+        print('  by package (self time):')
+        for name, seconds in imports['packages'].items():
+            print(f'    {name:<36} {seconds * 1000:8.1f} ms')
+        print('  slowest imports (cumulative):')
+        for item in imports['slowest']:
+            print(f"    {item['module']:<36} {item['cumulative'] * 1000:8.1f} ms")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,129 @@
+"""
+Benchmark the vectorized vote tally against a naive per-row ORM loop.
+
+The benchmark database is dropped and reseeded, so it is a scratch one
+(`--database-url` or `BENCH_DATABASE_URL`), never `DATABASE_URL`.
+
+    $ python benchmarks/bench_tally.py --votes 100000
+"""
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+from random import Random
+
+from application import create_app, db
+from application.models import (Fund, FundUser, Line, LineVote, Strategy,
+                                User)
+from application.tally import tally_day
+
+SCRATCH_DATABASE_URL = os.environ.get(
+    'BENCH_DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.gettempdir(), 'betfund_bench.db'))
+
+DAY = datetime(2020, 9, 13)
+
+
+def insert(model, rows, batch_size=10000):
+    """
+    Bulk insert rows in batches.
+    """
+    for i in range(0, len(rows), batch_size):
+        db.session.execute(model.__table__.insert(), rows[i:i + batch_size])
+
+
+def seed(n_votes, n_funds, n_members, n_lines, seed=0):
+    """
+    Fill a fresh database with funds, members, lines and a day of votes.
+    """
+    rand = Random(seed)
+    db.drop_all()
+    db.create_all()
+
+    insert(Strategy, [{'id': 1, 'name': 'Bench', 'code': 'bench', 'details': {}}])
+    insert(Fund, [{'id': i, 'name': f'Fund {i}', 'description': '', 'strategy_id': 1}
+                  for i in range(1, n_funds + 1)])
+    insert(User, [{'id': i, 'first_name': 'Bench', 'last_name': str(i),
+                   'email_address': f'bench{i}@example.com', 'password': '-'}
+                  for i in range(1, n_funds * n_members + 1)])
+    insert(FundUser, [{'id': i, 'fund_id': (i - 1) // n_members + 1, 'user_id': i}
+                      for i in range(1, n_funds * n_members + 1)])
+    insert(Line, [{'id': f'line-{i}', 'details': {}} for i in range(n_lines)])
+    # one vote per member and line on the day
+    votes = {}
+    for _ in range(n_votes):
+        vote = {
+            'line_id': f'line-{rand.randrange(n_lines)}',
+            'fund_user_id': rand.randint(1, n_funds * n_members),
+            'units': rand.randint(1, 5),
+            'timestamp': DAY + timedelta(seconds=rand.randrange(86400))
+        }
+        votes[vote['fund_user_id'], vote['line_id']] = vote
+    insert(LineVote, list(votes.values()))
+    db.session.commit()
+    return len(votes)
+
+
+def naive_tally(day):
+    """
+    The per-row ORM loop the tally engine replaces.
+    """
+    start = datetime(day.year, day.month, day.day)
+    votes = LineVote.query.filter(LineVote.timestamp >= start,
+                                  LineVote.timestamp < start + timedelta(days=1))
+
+    totals = {}
+    for vote in votes:
+        fund_user = FundUser.query.get(vote.fund_user_id)
+        key = (fund_user.fund_id, vote.line_id)
+        totals[key] = totals.get(key, 0) + (vote.units or 1)
+
+    ranked = {}
+    for (fund_id, line_id), units in totals.items():
+        ranked.setdefault(fund_id, []).append((line_id, units))
+    for lines in ranked.values():
+        lines.sort(key=lambda item: (-item[1], item[0]))
+    return ranked
+
+
+def timed(func, *args, repeat=3, **kwargs):
+    """
+    Best wall time over `repeat` runs, with the last result.
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        db.session.expunge_all()
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(prog='bench_tally')
+    parser.add_argument('--votes', type=int, default=100000)
+    parser.add_argument('--funds', type=int, default=200)
+    parser.add_argument('--members', type=int, default=25,
+                        help="Members per fund.")
+    parser.add_argument('--lines', type=int, default=300)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--skip-naive', action='store_true')
+    parser.add_argument('--database-url', default=SCRATCH_DATABASE_URL,
+                        help="The scratch database, dropped and reseeded.")
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = args.database_url
+    app = create_app()
+    with app.app_context():
+        n_votes = seed(args.votes, args.funds, args.members, args.lines)
+
+        vectorized, ranked = timed(tally_day, DAY, repeat=args.repeat)
+        print(f'vectorized tally : {vectorized * 1000:9.1f} ms  ({n_votes} votes, {len(ranked)} funds)')
+
+        if not args.skip_naive:
+            naive, expected = timed(naive_tally, DAY, repeat=1)
+            print(f'naive ORM loop   : {naive * 1000:9.1f} ms  ({naive / vectorized:.0f}x slower)')
+
+            # both approaches must agree on the ranking
+            assert {f: [(l['line_id'], l['units']) for l in lines] for f, lines in ranked.items()} == expected
@@ -0,0 +1,568 @@
+"""
+Load test the WSGI app with mixed traffic, at several data scales.
+
+For every scale, a scratch database is seeded, `create_app` is served by a
+threaded server in a child process, and `--concurrency` simulated members
+(each with its own keep-alive connection and session) run a weighted mix
+of scenarios for `--duration` seconds:
+
+* signup    : the sign up form, with a new email address
+* login     : the log in form, as an existing member
+* dashboard : the dashboard, logged in
+* admin     : a page of the admin `lines` export, logged in
+* vote      : a batch of votes (`POST /dashboard/votes`), logged in;
+              skipped when the app has no such route
+
+The report has throughput, p50/p95/p99 latency and errors per scenario,
+and the app's own statement counts per endpoint (from `/metrics/sql`), as
+JSON that can be diffed between commits:
+
+    $ python benchmarks/loadtest.py --scales small,medium --output before.json
+    $ python benchmarks/loadtest.py --scales small,medium --compare before.json
+
+`--compare` prints every figure next to an earlier report's, and exits
+non-zero when a latency regressed by more than `--tolerance`, or an
+endpoint issues a statement more per request.
+
+The scratch database is dropped for every scale, so it is never
+`DATABASE_URL`: pass `--database-url` or set `BENCH_DATABASE_URL`.
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from random import Random
+from urllib.parse import urlencode
+
+import numpy as np
+
+from application import create_app, db
+from application.balances import SPECS, rebuild
+from application.ingest import parse_record
+from application.models import (Fund, FundLedger, FundUser, FundUserLedger,
+                                Investment, Line, LineVote, Result, Strategy,
+                                User)
+from application.passwords import hash_password
+
+SCRATCH_DATABASE_URL = os.environ.get(
+    'BENCH_DATABASE_URL', 'sqlite:///' + os.path.join(tempfile.gettempdir(), 'betfund_load.db'))
+
+HOST = '127.0.0.1'
+PASSWORD = 'load-test-password'
+
+SCALES = {
+    'small': {'users': 200, 'funds': 10, 'members': 10, 'lines': 500,
+              'votes': 5000, 'investments': 2000, 'ledger_rows': 5000},
+    'medium': {'users': 2000, 'funds': 50, 'members': 25, 'lines': 5000,
+               'votes': 50000, 'investments': 20000, 'ledger_rows': 50000},
+    'large': {'users': 20000, 'funds': 200, 'members': 50, 'lines': 50000,
+              'votes': 500000, 'investments': 200000, 'ledger_rows': 500000},
+}
+
+DEFAULT_MIX = 'dashboard=50,admin=10,vote=20,login=15,signup=5'
+
+PERCENTILES = (50, 95, 99)
+
+_CSRF = re.compile(r'name="csrf_token"[^>]*value="([^"]*)"')
+
+
+def insert(model, rows, batch_size=10000):
+    """
+    Bulk insert rows in batches.
+    """
+    for i in range(0, len(rows), batch_size):
+        db.session.execute(model.__table__.insert(), rows[i:i + batch_size])
+
+
+def seed(scale, seed=0):
+    """
+    Fill a fresh database for a scale.
+
+    Returns
+    -------
+    dict
+        What the load generator needs: `members` (email, fund and line
+        identifiers to vote on) and the row `counts`.
+    """
+    rand = Random(seed)
+    now = datetime.utcnow()
+    db.drop_all()
+    db.create_all()
+
+    n_users, n_funds, n_members = scale['users'], scale['funds'], scale['members']
+    password = hash_password(PASSWORD)
+    insert(Strategy, [{'id': 1, 'name': 'Load', 'code': 'load', 'details': {}}])
+    insert(User, [{'id': i, 'first_name': 'Load', 'last_name': str(i),
+                   'email_address': f'load{i}@example.com', 'password': password}
+                  for i in range(1, n_users + 1)])
+    insert(Fund, [{'id': i, 'name': f'Fund {i}', 'description': '', 'strategy_id': 1}
+                  for i in range(1, n_funds + 1)])
+
+    fund_users = []
+    for fund_id in range(1, n_funds + 1):
+        for user_id in rand.sample(range(1, n_users + 1), min(n_members, n_users)):
+            fund_users.append({'id': len(fund_users) + 1, 'fund_id': fund_id, 'user_id': user_id})
+    insert(FundUser, fund_users)
+
+    # half the lines are settled history, half are open
+    lines = []
+    for i in range(scale['lines']):
+        settled = i % 2 == 0
+        start = now + (-1 if settled else 1) * timedelta(minutes=rand.randint(60, 30 * 24 * 60))
+        lines.append(parse_record({'id': f'line-{i}', 'details': {
+            'sport': rand.choice(['NFL', 'NBA', 'MLB', 'NHL']),
+            'market_type': rand.choice(['moneyline', 'spread', 'total']),
+            'price': rand.choice([-1, 1]) * rand.randint(100, 300),
+            'start_time': start.isoformat(),
+            'status': 'settled' if settled else 'open'
+        }}))
+    insert(Line, lines)
+    settled = [line for line in lines if line['status'] == 'settled']
+    open_ids = [line['id'] for line in lines if line['status'] == 'open']
+
+    # one vote per member, line and day
+    votes = {}
+    for _ in range(scale['votes']):
+        vote = {'line_id': rand.choice(open_ids),
+                'fund_user_id': rand.randint(1, len(fund_users)),
+                'units': rand.randint(1, 5),
+                'timestamp': now - timedelta(seconds=rand.randrange(86400))}
+        votes[vote['fund_user_id'], vote['line_id'], vote['timestamp'].date()] = vote
+    insert(LineVote, list(votes.values()))
+
+    investments, results = [], []
+    for i in range(1, scale['investments'] + 1):
+        line = rand.choice(settled)
+        amount = rand.randint(1000, 50000)
+        investments.append({'id': i, 'fund_id': rand.randint(1, n_funds), 'line_id': line['id'],
+                            'amount': amount, 'timestamp': line['starts_at'] - timedelta(hours=1)})
+        is_win = rand.random() < 0.5
+        price = line['details']['price']
+        win = amount * price // 100 if price > 0 else amount * 100 // -price
+        results.append({'investment_id': i, 'is_win': is_win, 'amount': win if is_win else -amount})
+    insert(Investment, investments)
+    insert(Result, results)
+
+    for model, owner, owners in ((FundLedger, 'fund_id', n_funds),
+                                 (FundUserLedger, 'fund_user_id', len(fund_users))):
+        insert(model, [{owner: rand.randint(1, owners), 'amount': rand.randint(1000, 100000),
+                        'timestamp': now - timedelta(seconds=rand.randrange(30 * 86400))}
+                       for _ in range(scale['ledger_rows'])])
+    for spec in SPECS:
+        rebuild(spec)
+    db.session.commit()
+
+    emails = {i: f'load{i}@example.com' for i in range(1, n_users + 1)}
+    return {
+        'members': [{'email': emails[fu['user_id']], 'fund_id': fu['fund_id']} for fu in fund_users],
+        'open_lines': open_ids,
+        'counts': {'users': n_users, 'funds': n_funds, 'fund_users': len(fund_users),
+                   'lines': len(lines), 'line_votes': len(votes),
+                   'investments': len(investments), 'ledger_rows': 2 * scale['ledger_rows']}
+    }
+
+
+def serve(port, ready):
+    """
+    Serve the app on a threaded HTTP/1.1 server (in a child process).
+    """
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class Handler(WSGIRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_request(self, *args, **kwargs):
+            pass
+
+    app = create_app()
+    # every simulated member signs up and logs in from this one address
+    app.config['RATELIMIT_ENABLED'] = False
+    server = make_server(HOST, port, app, threaded=True, request_handler=Handler)
+    ready.set()
+    server.serve_forever()
+
+
+class Client:
+    """
+    A keep-alive HTTP connection with its own cookies.
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self.cookies = {}
+        self.location = None
+        self.connection = http.client.HTTPConnection(HOST, port, timeout=60)
+
+    def request(self, method, path, body=None, headers=None):
+        """
+        Send a request, reconnecting once if the server dropped the
+        connection.
+
+        Returns
+        -------
+        status : int
+        body : bytes
+        """
+        headers = dict(headers or {})
+        if self.cookies:
+            headers['Cookie'] = '; '.join(f'{k}={v}' for k, v in self.cookies.items())
+
+        for attempt in range(2):
+            try:
+                self.connection.request(method, path, body=body, headers=headers)
+                response = self.connection.getresponse()
+                data = response.read()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                self.connection.close()
+                self.connection = http.client.HTTPConnection(HOST, self.port, timeout=60)
+                if attempt:
+                    raise
+
+        # a rejected body may be left unread, which breaks keep-alive
+        if body is not None and response.status >= 400:
+            self.connection.close()
+            self.connection = http.client.HTTPConnection(HOST, self.port, timeout=60)
+
+        self.location = response.headers.get('Location')
+        for cookie in response.headers.get_all('Set-Cookie') or []:
+            name, _, value = cookie.split(';', 1)[0].partition('=')
+            self.cookies[name.strip()] = value
+        return response.status, data
+
+    def submit(self, path, fields):
+        """
+        Fill in a form: get it for its CSRF token, then post it.
+        """
+        status, page = self.request('GET', path)
+        match = _CSRF.search(page.decode())
+        if match:
+            fields = {'csrf_token': match.group(1), **fields}
+        return self.request('POST', path, body=urlencode(fields),
+                            headers={'Content-Type': 'application/x-www-form-urlencoded'})
+
+    def close(self):
+        self.connection.close()
+
+
+def scenario_signup(client, member, data, rand):
+    visitor = Client(client.port)
+    try:
+        email = f'signup-{uuid.uuid4().hex}@example.com'
+        status, _ = visitor.submit('/signup', {
+            'first_name': 'Load', 'last_name': 'Test', 'email_address': email,
+            'password': PASSWORD, 'password_check': PASSWORD
+        })
+        return status == 302 and visitor.location.endswith('/success')
+    finally:
+        visitor.close()
+
+
+def scenario_login(client, member, data, rand):
+    visitor = Client(client.port)
+    try:
+        other = rand.choice(data['members'])
+        status, _ = visitor.submit('/login', {'email_address': other['email'], 'password': PASSWORD})
+        return status == 302 and visitor.location.endswith('/dashboard')
+    finally:
+        visitor.close()
+
+
+def scenario_dashboard(client, member, data, rand):
+    status, _ = client.request('GET', '/dashboard')
+    return status == 200
+
+
+def scenario_admin(client, member, data, rand):
+    status, _ = client.request('GET', '/admin/lines?limit=100')
+    return status == 200
+
+
+def scenario_vote(client, member, data, rand):
+    votes = [{'line_id': line_id, 'units': rand.randint(1, 5)}
+             for line_id in rand.sample(data['open_lines'], rand.randint(1, 5))]
+    status, _ = client.request('POST', '/dashboard/votes',
+                               body=json.dumps({'fund_id': member['fund_id'], 'votes': votes}),
+                               headers={'Content-Type': 'application/json'})
+    return 200 <= status < 300
+
+
+SCENARIOS = {
+    'signup': scenario_signup,
+    'login': scenario_login,
+    'dashboard': scenario_dashboard,
+    'admin': scenario_admin,
+    'vote': scenario_vote,
+}
+
+
+def parse_mix(mix):
+    """
+    Parse `name=weight,...` into a dict of weights.
+    """
+    weights = {}
+    for item in mix.split(','):
+        name, _, weight = item.partition('=')
+        if name not in SCENARIOS:
+            raise SystemExit(f'Unknown scenario `{name}`, pick from {", ".join(SCENARIOS)}.')
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def log_in(client, member):
+    status, _ = client.submit('/login', {'email_address': member['email'], 'password': PASSWORD})
+    if status != 302 or not client.location.endswith('/dashboard'):
+        raise RuntimeError(f'Could not log in as {member["email"]} ({status}).')
+
+
+def drive(port, data, weights, duration, concurrency, seed=0):
+    """
+    Run the traffic mix with `concurrency` members for `duration` seconds.
+
+    Returns
+    -------
+    dict
+        Scenario name to `(latencies, errors)`.
+    """
+    names = list(weights)
+    probabilities = np.array([weights[name] for name in names])
+    probabilities /= probabilities.sum()
+    deadline = time.perf_counter() + duration
+    results = {name: ([], [0]) for name in names}
+    lock = threading.Lock()
+
+    def member_loop(i):
+        rand = Random(seed * 1000 + i)
+        member = data['members'][i % len(data['members'])]
+        client = Client(port)
+        log_in(client, member)
+        latencies = {name: [] for name in names}
+        errors = dict.fromkeys(names, 0)
+        picks = np.random.RandomState(seed * 1000 + i)
+        try:
+            while time.perf_counter() < deadline:
+                name = names[picks.choice(len(names), p=probabilities)]
+                start = time.perf_counter()
+                try:
+                    ok = SCENARIOS[name](client, member, data, rand)
+                except (OSError, http.client.HTTPException):
+                    ok = False
+                latencies[name].append(time.perf_counter() - start)
+                errors[name] += not ok
+        finally:
+            client.close()
+
+        with lock:
+            for name in names:
+                results[name][0].extend(latencies[name])
+                results[name][1][0] += errors[name]
+
+    threads = [threading.Thread(target=member_loop, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {name: (latencies, errors[0]) for name, (latencies, errors) in results.items()}
+
+
+def summarize(results, duration):
+    """
+    Throughput and latency percentiles (milliseconds) per scenario.
+    """
+    scenarios = {}
+    total = 0
+    for name, (latencies, errors) in results.items():
+        total += len(latencies)
+        latencies = np.array(latencies) * 1000
+        scenarios[name] = {
+            'count': len(latencies),
+            'errors': errors,
+            'per_second': round(len(latencies) / duration, 2),
+            'mean_ms': round(float(latencies.mean()), 2) if len(latencies) else None,
+            **{f'p{p}_ms': round(float(np.percentile(latencies, p)), 2) if len(latencies) else None
+               for p in PERCENTILES}
+        }
+    return {'throughput': round(total / duration, 2), 'scenarios': scenarios}
+
+
+def metrics_headers():
+    """
+    The bearer token of the metrics endpoints, from `METRICS_TOKEN`.
+    """
+    token = os.environ.get('METRICS_TOKEN')
+    return {'Authorization': f'Bearer {token}'} if token else None
+
+
+def sql_metrics(client):
+    """
+    Statement counts and DB time per endpoint, from the app.
+    """
+    status, body = client.request('GET', '/metrics/sql', headers=metrics_headers())
+    if status != 200:
+        return {}
+    return {endpoint: {key: stats[key] for key in ('requests', 'queries_per_request', 'max_queries',
+                                                   'db_time_per_request', 'nplusone_requests')}
+            for endpoint, stats in json.loads(body)['endpoints'].items()}
+
+
+def run_scale(name, args, weights):
+    """
+    Seed, serve and load test one scale.
+    """
+    app = create_app()
+    with app.app_context():
+        start = time.perf_counter()
+        data = seed(SCALES[name], args.seed)
+        seeded = time.perf_counter() - start
+        dialect = db.engine.dialect.name
+        db.session.remove()
+        db.engine.dispose()
+
+    context = multiprocessing.get_context('spawn')
+    ready = context.Event()
+    server = context.Process(target=serve, args=(args.port, ready), daemon=True)
+    server.start()
+    try:
+        if not ready.wait(60):
+            raise RuntimeError('The server did not start.')
+
+        admin = Client(args.port)
+        log_in(admin, data['members'][0])
+
+        # skip scenarios the app doesn't serve
+        weights = dict(weights)
+        if 'vote' in weights and admin.request('OPTIONS', '/dashboard/votes')[0] == 404:
+            print(f'  {name}: no vote endpoint, skipping the vote scenario')
+            del weights['vote']
+
+        if args.warmup:
+            drive(args.port, data, weights, args.warmup, args.concurrency, args.seed)
+        admin.request('DELETE', '/metrics/sql', headers=metrics_headers())
+
+        results = drive(args.port, data, weights, args.duration, args.concurrency, args.seed)
+        report = {
+            'dialect': dialect,
+            'seed_seconds': round(seeded, 2),
+            'rows': data['counts'],
+            **summarize(results, args.duration),
+            'endpoints': sql_metrics(admin)
+        }
+        admin.close()
+    finally:
+        server.terminate()
+        server.join()
+    return report
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, baseline, tolerance):
+    """
+    Print every figure against a baseline report.
+
+    Returns
+    -------
+    list of str
+        The regressions.
+    """
+    regressions = []
+    for scale, current in report['scales'].items():
+        previous = baseline['scales'].get(scale)
+        if previous is None:
+            continue
+        print(f'\n{scale}: throughput {previous["throughput"]} -> {current["throughput"]} /s')
+
+        for name, stats in current['scenarios'].items():
+            before = previous['scenarios'].get(name)
+            if not before or not stats['count'] or not before['count']:
+                continue
+            changes = []
+            for p in PERCENTILES:
+                old, new = before[f'p{p}_ms'], stats[f'p{p}_ms']
+                changes.append(f'p{p} {old:.1f} -> {new:.1f}ms ({(new / old - 1) * 100:+.0f}%)')
+                if new > old * (1 + tolerance):
+                    regressions.append(f'{scale} {name} p{p}: {old:.1f} -> {new:.1f}ms')
+            print(f'  {name:<10} ' + ', '.join(changes))
+
+        for endpoint, stats in current['endpoints'].items():
+            before = previous['endpoints'].get(endpoint)
+            if not before:
+                continue
+            old, new = before['queries_per_request'], stats['queries_per_request']
+            if old != new:
+                print(f'  {endpoint:<30} queries/request {old} -> {new}')
+            if new >= old + 1:
+                regressions.append(f'{scale} {endpoint}: {old} -> {new} queries/request')
+    return regressions
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(prog='loadtest')
+    parser.add_argument('--scales', default='small',
+                        help=f"Comma separated data scales, of {', '.join(SCALES)}.")
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help="Scenario weights, as `name=weight,...`.")
+    parser.add_argument('--duration', type=float, default=20,
+                        help="Seconds of measured traffic per scale.")
+    parser.add_argument('--warmup', type=float, default=3,
+                        help="Seconds of unmeasured traffic first.")
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help="Simulated members sending requests at once.")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--database-url', default=SCRATCH_DATABASE_URL,
+                        help="The scratch database, dropped and reseeded per scale.")
+    parser.add_argument('--output', help="Write the JSON report here.")
+    parser.add_argument('--compare', help="A previous report to compare against.")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="Latency increase (fraction) that counts as a regression.")
+    args = parser.parse_args()
+
+    # the server processes inherit it
+    os.environ['DATABASE_URL'] = args.database_url
+    weights = parse_mix(args.mix)
+    report = {
+        'created': datetime.utcnow().isoformat(),
+        'commit': _commit(),
+        'python': platform.python_version(),
+        'settings': {'duration': args.duration, 'concurrency': args.concurrency,
+                     'mix': weights, 'seed': args.seed},
+        'scales': {}
+    }
+    for name in args.scales.split(','):
+        if name not in SCALES:
+            raise SystemExit(f'Unknown scale `{name}`, pick from {", ".join(SCALES)}.')
+        print(f'{name}: seeding and running for {args.duration:.0f}s ...')
+        report['scales'][name] = scale = run_scale(name, args, weights)
+        print(f'  {scale["throughput"]} scenarios/s')
+        for scenario, stats in scale['scenarios'].items():
+            print(f"  {scenario:<10} {stats['count']:>7} runs  {stats['errors']:>5} errors  "
+                  f"p50 {stats['p50_ms']} ms  p95 {stats['p95_ms']} ms  p99 {stats['p99_ms']} ms")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print('\nRegressions:\n  ' + '\n  '.join(regressions))
+            sys.exit(1)
@@ -0,0 +1,79 @@
+"""
+Gunicorn settings :: `gunicorn -c gunicorn.conf.py wsgi:app`.
+
+Every open dashboard holds a server-sent event stream (`/dashboard/events`),
+so the workers are gevent: each connection is a greenlet, and thousands of
+idle streams don't pin a thread or a process each. With more than one
+worker, set `EVENTS_URL` so live updates reach the streams of every worker.
+Patched threads are greenlets on the worker's one hub, so password hashes
+run on a gevent pool of real threads (`PASSWORD_HASH_WORKERS` of them per
+worker, see `application.passwords`) and don't stall the other requests.
+
+Set `METRICS_DIR` so `/metrics` adds up the requests of every worker, and
+`METRICS_TOKEN` for the scraper to send (`/metrics` isn't served without
+one in production).
+
+Set `PRELOAD_APP=1` to load the app once in the master and fork the workers
+from it, sharing its memory copy-on-write; or `LAZY_BLUEPRINTS=1` for
+workers that boot fast and load each blueprint on first use (see
+`application.startup`).
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() + 1))
+worker_class = 'gevent'
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 2000))
+timeout = 30
+keepalive = 5
+
+metrics_dir = os.environ.get('METRICS_DIR')
+
+preload_app = os.environ.get('PRELOAD_APP') == '1'
+if preload_app:
+    # the app's locks and events have to be gevent's, so patch before the
+    # master loads it rather than in each worker
+    from gevent import monkey
+    monkey.patch_all()
+
+
+def on_starting(server):
+    """
+    Start the metrics from zero.
+    """
+    if metrics_dir:
+        from application.telemetry import clear_directory
+        os.makedirs(metrics_dir, exist_ok=True)
+        clear_directory(metrics_dir)
+
+
+def when_ready(server):
+    """
+    Load everything the workers share, and freeze it, before they fork.
+    """
+    if preload_app:
+        from application.startup import preload
+        preload(server.app.wsgi())
+
+
+def post_fork(server, worker):
+    """
+    Make psycopg2 cooperative, so a query yields to the other greenlets
+    instead of blocking the whole worker.
+    """
+    try:
+        from psycogreen.gevent import patch_psycopg
+    except ImportError:
+        worker.log.warning('psycogreen is not installed, database calls will block the worker.')
+        return
+    patch_psycopg()
+
+
+def child_exit(server, worker):
+    """
+    Stop counting a dead worker's in-flight requests.
+    """
+    if metrics_dir:
+        from application.telemetry import mark_process_dead
+        mark_process_dead(worker.pid, metrics_dir)
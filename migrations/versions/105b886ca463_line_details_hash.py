@@ -0,0 +1,28 @@
+"""line details hash
+
+Revision ID: 105b886ca463
+Revises: 638cb37c2f99
+Create Date: 2026-10-18 13:40:12.871344
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '105b886ca463'
+down_revision = '638cb37c2f99'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # existing lines are left without a hash, so the next feed that
+    # mentions them rewrites them once
+    with op.batch_alter_table('lines') as batch_op:
+        batch_op.add_column(sa.Column('details_hash', sa.String(length=64), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('lines') as batch_op:
+        batch_op.drop_column('details_hash')
@@ -0,0 +1,61 @@
+"""money in cents
+
+Revision ID: 3b9e1c7d52a0
+Revises: aec1ea416c39
+Create Date: 2026-10-18 17:42:09.318245
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b9e1c7d52a0'
+down_revision = 'aec1ea416c39'
+branch_labels = None
+depends_on = None
+
+# (table, money column)
+MONEY_COLUMNS = [
+    ('user_ledgers', 'amount'),
+    ('fund_user_ledgers', 'amount'),
+    ('fund_ledgers', 'amount'),
+    ('investments', 'amount'),
+    ('results', 'amount'),
+    ('fund_user_balances', 'balance'),
+    ('fund_user_balance_snapshots', 'balance'),
+    ('fund_balances', 'balance'),
+    ('fund_balance_snapshots', 'balance'),
+]
+
+
+def upgrade():
+    postgresql = op.get_bind().dialect.name == 'postgresql'
+
+    for table, column in MONEY_COLUMNS:
+        if postgresql:
+            op.alter_column(table, column, type_=sa.BigInteger(), existing_type=sa.Float(),
+                            postgresql_using=f'ROUND({column} * 100)::bigint')
+            continue
+
+        # convert in place, then change the type (SQLite stores the
+        # now integral floats as integers when the table is copied)
+        op.execute(f'UPDATE {table} SET {column} = ROUND({column} * 100)')
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.alter_column(column, type_=sa.BigInteger(), existing_type=sa.Float(),
+                                  existing_nullable=False)
+
+
+def downgrade():
+    postgresql = op.get_bind().dialect.name == 'postgresql'
+
+    for table, column in MONEY_COLUMNS:
+        if postgresql:
+            op.alter_column(table, column, type_=sa.Float(), existing_type=sa.BigInteger(),
+                            postgresql_using=f'{column} / 100.0')
+            continue
+
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.alter_column(column, type_=sa.Float(), existing_type=sa.BigInteger(),
+                                  existing_nullable=False)
+        op.execute(f'UPDATE {table} SET {column} = {column} / 100.0')
@@ -0,0 +1,25 @@
+"""line vote day index
+
+Revision ID: 638cb37c2f99
+Revises: d2731dccfb46
+Create Date: 2026-10-18 11:26:05.530912
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '638cb37c2f99'
+down_revision = 'd2731dccfb46'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # covers the daily vote tally, so it never has to visit the table
+    op.create_index('ix_line_votes_timestamp', 'line_votes', ['timestamp', 'fund_user_id', 'line_id', 'units'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_line_votes_timestamp', table_name='line_votes')
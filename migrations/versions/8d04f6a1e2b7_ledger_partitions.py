@@ -0,0 +1,130 @@
+"""ledger partitions
+
+Revision ID: 8d04f6a1e2b7
+Revises: 3b9e1c7d52a0
+Create Date: 2026-10-18 19:05:37.844120
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d04f6a1e2b7'
+down_revision = '3b9e1c7d52a0'
+branch_labels = None
+depends_on = None
+
+# (ledger, owner column, owner table)
+LEDGERS = [
+    ('user_ledgers', 'user_id', 'users'),
+    ('fund_ledgers', 'fund_id', 'funds'),
+    ('fund_user_ledgers', 'fund_user_id', 'fund_users'),
+]
+
+# frozen copies of `application.partitions` helpers as of this revision,
+# so later changes to them don't change what this migration does
+MONTHS_AHEAD = 2
+
+
+def _month_start(when):
+    return datetime(when.year, when.month, 1)
+
+
+def _next_month(start):
+    if start.month == 12:
+        return datetime(start.year + 1, 1, 1)
+    return datetime(start.year, start.month + 1, 1)
+
+
+def _partition(ledger, owner, target):
+    """
+    Turn a ledger into a table partitioned by month, one partition per
+    month of existing data (and the next few), plus a default one.
+    """
+    old = f'{ledger}_unpartitioned'
+    index = f'ix_{ledger}_{owner}_timestamp'
+
+    op.execute(f'ALTER TABLE {ledger} RENAME TO {old}')
+    op.execute(f'DROP INDEX {index}')
+    op.execute(f'CREATE TABLE {ledger} (LIKE {old} INCLUDING DEFAULTS) PARTITION BY RANGE (timestamp)')
+
+    # the primary key of a partitioned table must include the partition
+    # key, so `id` is indexed instead (it stays unique, from the sequence)
+    op.execute(f'ALTER SEQUENCE {ledger}_id_seq OWNED BY {ledger}.id')
+    op.execute(f'CREATE INDEX ix_{ledger}_id ON {ledger} (id)')
+    op.execute(f'CREATE INDEX {index} ON {ledger} ({owner}, timestamp, amount)')
+    op.execute(f'ALTER TABLE {ledger} ADD CONSTRAINT {ledger}_{owner}_fkey '
+               f'FOREIGN KEY ({owner}) REFERENCES {target} (id)')
+
+    first = op.get_bind().execute(sa.text(f'SELECT MIN(timestamp) FROM {old}')).scalar()
+    start = _month_start(first or datetime.utcnow())
+    last = _month_start(datetime.utcnow())
+    for _ in range(MONTHS_AHEAD):
+        last = _next_month(last)
+    while start <= last:
+        end = _next_month(start)
+        op.execute(f'CREATE TABLE {ledger}_p{start:%Y%m} PARTITION OF {ledger} '
+                   f"FOR VALUES FROM ('{start:%Y-%m-%d}') TO ('{end:%Y-%m-%d}')")
+        start = end
+    op.execute(f'CREATE TABLE {ledger}_default PARTITION OF {ledger} DEFAULT')
+
+    op.execute(f'INSERT INTO {ledger} SELECT * FROM {old}')
+    op.execute(f'DROP TABLE {old}')
+
+
+def _unpartition(ledger, owner, target):
+    """
+    Turn a partitioned ledger back into a plain table. Periods that were
+    rolled up (detached) are left as they are.
+    """
+    old = f'{ledger}_partitioned'
+    index = f'ix_{ledger}_{owner}_timestamp'
+
+    op.execute(f'ALTER TABLE {ledger} RENAME TO {old}')
+    op.execute(f'DROP INDEX {index}')
+    op.execute(f'CREATE TABLE {ledger} (LIKE {old} INCLUDING DEFAULTS)')
+    op.execute(f'INSERT INTO {ledger} SELECT * FROM {old}')
+    op.execute(f'ALTER SEQUENCE {ledger}_id_seq OWNED BY {ledger}.id')
+    op.execute(f'DROP TABLE {old} CASCADE')
+
+    op.execute(f'ALTER TABLE {ledger} ADD PRIMARY KEY (id)')
+    op.execute(f'CREATE INDEX {index} ON {ledger} ({owner}, timestamp, amount)')
+    op.execute(f'ALTER TABLE {ledger} ADD CONSTRAINT {ledger}_{owner}_fkey '
+               f'FOREIGN KEY ({owner}) REFERENCES {target} (id)')
+
+
+def upgrade():
+    op.create_table('ledger_periods',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('ledger', sa.String(length=32), nullable=False),
+    sa.Column('table_name', sa.String(length=64), nullable=False),
+    sa.Column('period_start', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('period_end', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('row_count', sa.Integer(), nullable=False),
+    sa.Column('path', sa.String(length=256), nullable=True),
+    sa.Column('is_dropped', sa.Boolean(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('ledger', 'period_start', name='unique_idx_ledger_period_start')
+    )
+
+    for ledger, owner, target in LEDGERS:
+        op.add_column(ledger, sa.Column('is_opening', sa.Boolean(), nullable=False,
+                                        server_default=sa.false()))
+
+        if op.get_bind().dialect.name == 'postgresql':
+            _partition(ledger, owner, target)
+
+
+def downgrade():
+    for ledger, owner, target in LEDGERS:
+        op.execute(f'DROP VIEW IF EXISTS {ledger}_all')
+        if op.get_bind().dialect.name == 'postgresql':
+            _unpartition(ledger, owner, target)
+
+        with op.batch_alter_table(ledger) as batch_op:
+            batch_op.drop_column('is_opening')
+
+    op.drop_table('ledger_periods')
@@ -0,0 +1,28 @@
+"""unique result per investment
+
+Revision ID: aec1ea416c39
+Revises: f71827260486
+Create Date: 2026-10-18 16:21:44.603189
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'aec1ea416c39'
+down_revision = 'f71827260486'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # an investment settles exactly once, which is what makes
+    # settlement batches safe to retry
+    op.drop_index('ix_results_investment_id', table_name='results')
+    op.create_index('ix_results_investment_id', 'results', ['investment_id'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_results_investment_id', table_name='results')
+    op.create_index('ix_results_investment_id', 'results', ['investment_id'], unique=False)
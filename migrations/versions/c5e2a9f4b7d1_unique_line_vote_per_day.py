@@ -0,0 +1,72 @@
+"""unique line vote per day
+
+Revision ID: c5e2a9f4b7d1
+Revises: 8d04f6a1e2b7
+Create Date: 2026-10-18 21:42:10.318604
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5e2a9f4b7d1'
+down_revision = '8d04f6a1e2b7'
+branch_labels = None
+depends_on = None
+
+COLUMNS = 'id, units, timestamp, vote_day, line_id, fund_user_id'
+
+# a vote with a later vote of the same member, line and day (by
+# timestamp, a missing one first, then by id)
+SUPERSEDED = (
+    'EXISTS (SELECT 1 FROM line_votes later '
+    'WHERE later.fund_user_id = line_votes.fund_user_id AND later.line_id = line_votes.line_id '
+    'AND later.vote_day = line_votes.vote_day AND ('
+    'later.timestamp > line_votes.timestamp '
+    'OR (later.timestamp IS NOT NULL AND line_votes.timestamp IS NULL) '
+    'OR ((later.timestamp = line_votes.timestamp '
+    'OR (later.timestamp IS NULL AND line_votes.timestamp IS NULL)) AND later.id > line_votes.id)))'
+)
+
+
+def upgrade():
+    with op.batch_alter_table('line_votes') as batch_op:
+        batch_op.add_column(sa.Column('vote_day', sa.Date(), nullable=True))
+
+    # votes without a timestamp count as votes of the day of the upgrade
+    if op.get_bind().dialect.name == 'sqlite':
+        op.execute('UPDATE line_votes SET vote_day = COALESCE(date(timestamp), CURRENT_DATE)')
+    else:
+        op.execute('UPDATE line_votes SET vote_day = COALESCE(CAST(timestamp AS DATE), CURRENT_DATE)')
+
+    # keep the latest vote of every member, line and day, and move the
+    # others to `line_votes_duplicates` (the downgrade puts them back)
+    op.create_table(
+        'line_votes_duplicates',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('units', sa.Integer(), nullable=True),
+        sa.Column('timestamp', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('vote_day', sa.Date(), nullable=False),
+        sa.Column('line_id', sa.String(length=64), nullable=False),
+        sa.Column('fund_user_id', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.execute(f'INSERT INTO line_votes_duplicates ({COLUMNS}) '
+               f'SELECT {COLUMNS} FROM line_votes WHERE {SUPERSEDED}')
+    op.execute('DELETE FROM line_votes WHERE id IN (SELECT id FROM line_votes_duplicates)')
+
+    with op.batch_alter_table('line_votes') as batch_op:
+        batch_op.alter_column('vote_day', existing_type=sa.Date(), nullable=False)
+
+    # one vote per member, line and day, which makes vote writes upserts
+    op.create_index('uq_line_votes_fund_user_id_line_id_vote_day', 'line_votes',
+                    ['fund_user_id', 'line_id', 'vote_day'], unique=True)
+
+
+def downgrade():
+    op.drop_index('uq_line_votes_fund_user_id_line_id_vote_day', table_name='line_votes')
+    op.execute(f'INSERT INTO line_votes ({COLUMNS}) SELECT {COLUMNS} FROM line_votes_duplicates')
+    op.drop_table('line_votes_duplicates')
+    with op.batch_alter_table('line_votes') as batch_op:
+        batch_op.drop_column('vote_day')
@@ -0,0 +1,45 @@
+"""secondary indexes
+
+Revision ID: d2731dccfb46
+Revises: f5883e8ac327
+Create Date: 2026-10-18 10:03:47.118530
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2731dccfb46'
+down_revision = 'f5883e8ac327'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # login / signup lookups
+    op.create_index('ix_users_email_address', 'users', ['email_address'], unique=False)
+
+    # "which funds am I in" for the dashboard
+    op.create_index('ix_fund_users_user_id', 'fund_users', ['user_id'], unique=False)
+
+    op.create_index('ix_line_votes_line_id_fund_user_id', 'line_votes', ['line_id', 'fund_user_id'], unique=False)
+    op.create_index('ix_investments_fund_id_timestamp', 'investments', ['fund_id', 'timestamp'], unique=False)
+    op.create_index('ix_results_investment_id', 'results', ['investment_id'], unique=False)
+
+    # ledger ranges by owner and time, covering `amount` so tail sums
+    # never have to visit the table
+    op.create_index('ix_user_ledgers_user_id_timestamp', 'user_ledgers', ['user_id', 'timestamp', 'amount'], unique=False)
+    op.create_index('ix_fund_ledgers_fund_id_timestamp', 'fund_ledgers', ['fund_id', 'timestamp', 'amount'], unique=False)
+    op.create_index('ix_fund_user_ledgers_fund_user_id_timestamp', 'fund_user_ledgers', ['fund_user_id', 'timestamp', 'amount'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_fund_user_ledgers_fund_user_id_timestamp', table_name='fund_user_ledgers')
+    op.drop_index('ix_fund_ledgers_fund_id_timestamp', table_name='fund_ledgers')
+    op.drop_index('ix_user_ledgers_user_id_timestamp', table_name='user_ledgers')
+    op.drop_index('ix_results_investment_id', table_name='results')
+    op.drop_index('ix_investments_fund_id_timestamp', table_name='investments')
+    op.drop_index('ix_line_votes_line_id_fund_user_id', table_name='line_votes')
+    op.drop_index('ix_fund_users_user_id', table_name='fund_users')
+    op.drop_index('ix_users_email_address', table_name='users')
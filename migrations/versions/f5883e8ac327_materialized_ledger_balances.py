@@ -0,0 +1,72 @@
+"""materialized ledger balances
+
+Revision ID: f5883e8ac327
+Revises: 38c0f928bff3
+Create Date: 2026-10-18 09:12:31.402115
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f5883e8ac327'
+down_revision = '38c0f928bff3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('fund_balances',
+    sa.Column('fund_id', sa.Integer(), nullable=False),
+    sa.Column('balance', sa.Float(), nullable=False),
+    sa.Column('ledger_id', sa.Integer(), nullable=True),
+    sa.Column('modified_on', sa.DateTime(timezone=True), nullable=True),
+    sa.ForeignKeyConstraint(['fund_id'], ['funds.id'], ),
+    sa.PrimaryKeyConstraint('fund_id')
+    )
+    op.create_table('fund_user_balances',
+    sa.Column('fund_user_id', sa.Integer(), nullable=False),
+    sa.Column('balance', sa.Float(), nullable=False),
+    sa.Column('ledger_id', sa.Integer(), nullable=True),
+    sa.Column('modified_on', sa.DateTime(timezone=True), nullable=True),
+    sa.ForeignKeyConstraint(['fund_user_id'], ['fund_users.id'], ),
+    sa.PrimaryKeyConstraint('fund_user_id')
+    )
+    op.create_table('fund_balance_snapshots',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('balance', sa.Float(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('fund_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['fund_id'], ['funds.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('fund_id', 'timestamp', name='unique_idx_fund_id_timestamp')
+    )
+    op.create_table('fund_user_balance_snapshots',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('balance', sa.Float(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('fund_user_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['fund_user_id'], ['fund_users.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('fund_user_id', 'timestamp', name='unique_idx_fund_user_id_timestamp')
+    )
+
+    # seed the running balances from the existing ledgers
+    op.execute(
+        'INSERT INTO fund_balances (fund_id, balance, ledger_id, modified_on) '
+        'SELECT fund_id, SUM(amount), MAX(id), CURRENT_TIMESTAMP '
+        'FROM fund_ledgers GROUP BY fund_id'
+    )
+    op.execute(
+        'INSERT INTO fund_user_balances (fund_user_id, balance, ledger_id, modified_on) '
+        'SELECT fund_user_id, SUM(amount), MAX(id), CURRENT_TIMESTAMP '
+        'FROM fund_user_ledgers GROUP BY fund_user_id'
+    )
+
+
+def downgrade():
+    op.drop_table('fund_user_balance_snapshots')
+    op.drop_table('fund_balance_snapshots')
+    op.drop_table('fund_user_balances')
+    op.drop_table('fund_balances')
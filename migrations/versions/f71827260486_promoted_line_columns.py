@@ -0,0 +1,108 @@
+"""promoted line columns
+
+Revision ID: f71827260486
+Revises: 105b886ca463
+Create Date: 2026-10-18 14:58:20.114962
+
+"""
+from datetime import datetime, timezone
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f71827260486'
+down_revision = '105b886ca463'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 5000
+
+
+# frozen copies of `application.lines` helpers as of this revision, so
+# later changes to them don't change what this migration does
+def _parse_datetime(value):
+    if value is None or isinstance(value, datetime):
+        parsed = value
+    else:
+        parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+
+    if parsed is not None and parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def _string(value):
+    return None if value is None else str(value)
+
+
+# details key -> (column name, converter)
+PROMOTED = {
+    'sport': ('sport', _string),
+    'market_type': ('market_type', _string),
+    'status': ('status', _string),
+    'start_time': ('starts_at', _parse_datetime),
+}
+
+
+def _promoted_values(details):
+    values = {}
+    for key, (column, convert) in PROMOTED.items():
+        try:
+            values[column] = convert(details.get(key))
+        except (TypeError, ValueError):
+            values[column] = None
+    return values
+
+
+def upgrade():
+    with op.batch_alter_table('lines') as batch_op:
+        batch_op.add_column(sa.Column('sport', sa.String(length=32), nullable=True))
+        batch_op.add_column(sa.Column('market_type', sa.String(length=32), nullable=True))
+        batch_op.add_column(sa.Column('status', sa.String(length=16), nullable=True))
+        batch_op.add_column(sa.Column('starts_at', sa.DateTime(timezone=True), nullable=True))
+
+    # backfill from the details, a batch of lines at a time
+    lines = sa.table('lines',
+                     sa.column('id', sa.String(64)),
+                     sa.column('details', sa.JSON()),
+                     sa.column('sport', sa.String(32)),
+                     sa.column('market_type', sa.String(32)),
+                     sa.column('status', sa.String(16)),
+                     sa.column('starts_at', sa.DateTime(timezone=True)))
+    update = lines.update().where(lines.c.id == sa.bindparam('line_id')).values(
+        sport=sa.bindparam('sport'),
+        market_type=sa.bindparam('market_type'),
+        status=sa.bindparam('status'),
+        starts_at=sa.bindparam('starts_at', type_=sa.DateTime(timezone=True))
+    )
+
+    connection = op.get_bind()
+    after_id = ''
+    while True:
+        rows = connection.execute(
+            sa.select([lines.c.id, lines.c.details])
+            .where(lines.c.id > after_id)
+            .order_by(lines.c.id)
+            .limit(BATCH_SIZE)
+        ).fetchall()
+        if not rows:
+            break
+
+        connection.execute(update, [{'line_id': line_id, **_promoted_values(details or {})}
+                                    for line_id, details in rows])
+        after_id = rows[-1][0]
+
+    op.create_index('ix_lines_sport_status_starts_at', 'lines', ['sport', 'status', 'starts_at'], unique=False)
+    op.create_index('ix_lines_starts_at', 'lines', ['starts_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_lines_starts_at', table_name='lines')
+    op.drop_index('ix_lines_sport_status_starts_at', table_name='lines')
+    with op.batch_alter_table('lines') as batch_op:
+        batch_op.drop_column('starts_at')
+        batch_op.drop_column('status')
+        batch_op.drop_column('market_type')
+        batch_op.drop_column('sport')
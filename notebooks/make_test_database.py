@@ -1,16 +1,54 @@
 import argparse
+import hashlib
 import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from itertools import repeat
 from random import choice, randint
 from string import ascii_lowercase, ascii_uppercase, punctuation
 
 import names
 
 from application import create_app, db
+from application.balances import SPECS, rebuild
 from application.config import TestConfig
-from application.models import User
+from application.ingest import parse_record
+from application.passwords import get_method, hash_password
+from application.models import (Fund, FundLedger, FundUser, FundUserLedger,
+                                Investment, Line, LineVote, Result, Strategy,
+                                User, UserLedger)
 
 POSSIBLE_CHARS = list(ascii_lowercase + ascii_uppercase + punctuation)
 
+# the most distinct names pulled from `names`, which scans a file per call
+NAME_POOL_SIZE = 200
+
+SPORTS = {
+    'NFL': ['Bears', 'Packers', 'Lions', 'Vikings', 'Eagles', 'Giants', 'Cowboys', 'Jets'],
+    'NBA': ['Bulls', 'Celtics', 'Knicks', 'Lakers', 'Heat', 'Nets', 'Suns', 'Bucks'],
+    'MLB': ['Cubs', 'Mets', 'Yankees', 'Dodgers', 'Giants', 'Reds', 'Twins', 'Astros'],
+    'NHL': ['Bruins', 'Rangers', 'Flyers', 'Sharks', 'Kings', 'Oilers', 'Stars', 'Jets'],
+}
+MARKETS = ['moneyline', 'spread', 'total']
+STRATEGIES = [
+    ('Favorites', 'favorites', {
+        'filters': [{'key': 'price', 'op': 'lt', 'value': 0}],
+        'sizing': {'method': 'fixed', 'amount': '25.00'}
+    }),
+    ('Underdogs', 'underdogs', {
+        'filters': [{'key': 'price', 'op': 'gt', 'value': 0}],
+        'sizing': {'method': 'fraction', 'fraction': 0.01, 'max': '100.00'},
+        'max_lines': 20
+    }),
+    ('Basketball', 'basketball', {
+        'filters': [{'key': 'sport', 'op': 'eq', 'value': 'NBA'},
+                    {'key': 'market_type', 'op': 'in', 'value': ['moneyline', 'spread']}],
+        'sizing': {'method': 'fraction', 'fraction': 0.02}
+    }),
+]
+
 
 def make_fake_password(n_chars=10):
     """
@@ -29,6 +67,29 @@ def make_fake_password(n_chars=10):
                    [choice(ascii_lowercase)])
 
 
+def hash_passwords(passwords, method, processes=None):
+    """
+    Hash a list of passwords across a process pool.
+
+    Parameters
+    ----------
+    passwords : list of str
+        The plain text passwords.
+    method : str
+        The hashing method, i.e. `get_method()` of the app.
+    processes : int, optional
+        The number of worker processes.
+        Defaults to the number of CPUs.
+    """
+    processes = processes or os.cpu_count()
+    if processes == 1 or len(passwords) < 100:
+        return [hash_password(p, method) for p in passwords]
+
+    chunksize = max(1, len(passwords) // (processes * 8))
+    with ProcessPoolExecutor(processes) as pool:
+        return list(pool.map(hash_password, passwords, repeat(method), chunksize=chunksize))
+
+
 def make_user_test_data(n=20,
                         add_fake_admin=True,
                         password_chars_range=(8, 15)):
@@ -58,13 +119,18 @@ def make_user_test_data(n=20,
                      'password': 'admin'})
         start += 1
 
+    # draw from a pool of names, so large runs don't hit `names` per user
+    first_names = [names.get_first_name() for _ in range(min(n, NAME_POOL_SIZE))]
+    last_names = [names.get_last_name() for _ in range(min(n, NAME_POOL_SIZE))]
+
     for i in range(start, n + start):
 
-        # get random email address form first initial and last name
-        first_name = names.get_first_name()
-        last_name = names.get_last_name()
+        # get random email address form first initial and last name,
+        # with the id to keep it unique
+        first_name = choice(first_names)
+        last_name = choice(last_names)
         email = choice(['@yahoo.com', '@gmail.com', '@aol.com'])
-        email = ''.join([first_name.title(), last_name, email])
+        email = ''.join([first_name.title(), last_name, str(i), email])
 
         # create a fake password
         password = make_fake_password(randint(password_chars_range[0],
@@ -79,41 +145,257 @@ def make_user_test_data(n=20,
     return data
 
 
+def make_line_test_data(n=200, start=None, days=30):
+    """
+    Make test betting lines, spread over a number of days.
+
+    Lines that started more than a day ago are settled, the rest
+    are open.
+
+    Parameters
+    ----------
+    n : int
+        The number of lines.
+    start : datetime, optional
+        The first day of lines. Defaults to `days` ago.
+    days : int
+        The number of days the lines span.
+    """
+    now = datetime.utcnow()
+    start = start or now - timedelta(days=days)
+    data = []
+    for i in range(n):
+        sport = choice(list(SPORTS))
+        home, away = random.sample(SPORTS[sport], 2)
+        start_time = start + timedelta(minutes=randint(0, days * 24 * 60))
+        price = choice([-1, 1]) * randint(100, 300)
+
+        details = {
+            'sport': sport,
+            'home': home,
+            'away': away,
+            'market_type': choice(MARKETS),
+            'price': price,
+            'start_time': start_time.isoformat(),
+            'status': 'settled' if start_time < now - timedelta(days=1) else 'open'
+        }
+        data.append(parse_record({
+            'id': hashlib.sha256(f'{sport}:{home}:{away}:{i}'.encode()).hexdigest(),
+            'details': details
+        }))
+    return data
+
+
+def make_fund_test_data(n_funds, user_ids, members, n_strategies):
+    """
+    Make test funds and their memberships.
+
+    Each fund gets `members` distinct users (or all users, if fewer).
+    """
+    funds = [{'id': i,
+              'name': f'Test Fund {i}',
+              'description': 'A test fund.',
+              'strategy_id': randint(1, n_strategies)} for i in range(1, n_funds + 1)]
+
+    fund_users = []
+    for fund in funds:
+        for user_id in random.sample(user_ids, min(members, len(user_ids))):
+            fund_users.append({'id': len(fund_users) + 1,
+                               'fund_id': fund['id'],
+                               'user_id': user_id})
+    return funds, fund_users
+
+
+def payout(price, amount, is_win):
+    """
+    The profit (or loss) of a bet at american odds, in cents.
+    """
+    if not is_win:
+        return -amount
+    return round(amount * (price / 100 if price > 0 else 100 / -price))
+
+
+def make_investment_test_data(n, fund_ids, lines):
+    """
+    Make test investments, and results for the ones on settled lines.
+    """
+    investments = []
+    results = []
+    for i in range(1, n + 1):
+        line = choice(lines)
+        start_time = datetime.fromisoformat(line['details']['start_time'])
+        amount = randint(1000, 50000)
+
+        investments.append({'id': i,
+                            'fund_id': choice(fund_ids),
+                            'line_id': line['id'],
+                            'amount': amount,
+                            'timestamp': start_time - timedelta(minutes=randint(5, 600))})
+
+        if line['details']['status'] == 'settled':
+            is_win = random.random() < 0.48
+            results.append({'id': len(results) + 1,
+                            'investment_id': i,
+                            'is_win': is_win,
+                            'amount': payout(line['details']['price'], amount, is_win)})
+    return investments, results
+
+
+def generate_votes(n, fund_user_ids, lines):
+    """
+    Generate test votes, each cast a few hours before the line starts
+    (at most one per member, line and day).
+    """
+    seen = set()
+    for _ in range(n):
+        line = choice(lines)
+        start_time = datetime.fromisoformat(line['details']['start_time'])
+        vote = {'line_id': line['id'],
+                'fund_user_id': choice(fund_user_ids),
+                'units': randint(1, 5),
+                'timestamp': start_time - timedelta(minutes=randint(5, 600))}
+        key = (vote['fund_user_id'], vote['line_id'], vote['timestamp'].date())
+        if key not in seen:
+            seen.add(key)
+            yield vote
+
+
+def generate_ledger(n, owner, owner_ids, start, days):
+    """
+    Generate test ledger rows (amounts in cents): mostly deposits, with
+    some withdrawals.
+    """
+    seconds = days * 24 * 60 * 60
+    for _ in range(n):
+        amount = randint(1000, 100000) if random.random() < 0.8 else -randint(1000, 20000)
+        yield {owner: choice(owner_ids),
+               'amount': amount,
+               'timestamp': start + timedelta(seconds=randint(0, seconds))}
+
+
+def bulk_insert(model, rows, batch_size=10000):
+    """
+    Insert rows with `executemany` in batches. `rows` can be any
+    iterable, so generators are inserted without being held in memory.
+
+    Returns
+    -------
+    int
+        The number of rows inserted.
+    """
+    table = model.__table__
+    count = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            db.session.execute(table.insert(), batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        db.session.execute(table.insert(), batch)
+        count += len(batch)
+
+    db.session.commit()
+    return count
+
+
 if __name__ == '__main__':
 
     # parse the arguments
     parser = argparse.ArgumentParser(prog='make_test_database')
 
-    parser.add_argument('-n', dest='n', default=20,
-                        help="The number of records to create.")
+    parser.add_argument('-n', dest='n', type=int, default=20,
+                        help="The number of users to create.")
+    parser.add_argument('--funds', type=int, default=5,
+                        help="The number of funds to create.")
+    parser.add_argument('--members', type=int, default=10,
+                        help="The number of members per fund.")
+    parser.add_argument('--lines', type=int, default=200,
+                        help="The number of betting lines to create.")
+    parser.add_argument('--votes', type=int, default=1000,
+                        help="The number of line votes to create.")
+    parser.add_argument('--investments', type=int, default=500,
+                        help="The number of investments to create.")
+    parser.add_argument('--ledger-rows', type=int, default=1000,
+                        help="The number of rows to create in each ledger.")
+    parser.add_argument('--days', type=int, default=30,
+                        help="The number of days of history to create.")
+    parser.add_argument('--batch-size', type=int, default=10000,
+                        help="The number of rows per insert statement.")
+    parser.add_argument('--processes', type=int, default=None,
+                        help="Password hashing processes. Defaults to the number of CPUs.")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="Random seed, so runs are reproducible.")
 
     parser.add_argument('-v', '--verbose', action='store_true',
                         help="Whether to print the records at the end.")
 
-    # TODO :: Add other arguments?
-
     args = parser.parse_args()
+    random.seed(args.seed)
 
     # remove the existing database
     if os.path.exists(TestConfig.db_path):
         os.remove(TestConfig.db_path)
 
-    # create test data
-    users = make_user_test_data(args.n)
-
-    # create table
+    # create tables
     app = create_app(test_config=True)
     db.create_all()
+    history_start = datetime.utcnow() - timedelta(days=args.days)
+
+    def timed(label, func, *func_args, **func_kwargs):
+        start = time.perf_counter()
+        count = func(*func_args, **func_kwargs)
+        print(f'{label:<20} {count:>10} rows  {time.perf_counter() - start:8.2f}s')
+
+    # create the users, hashing the passwords in parallel
+    users = make_user_test_data(args.n)
+    with app.app_context():
+        method = get_method()
+    hashed = hash_passwords([u['password'] for u in users], method, args.processes)
+    for user, password in zip(users, hashed):
+        user['password'] = password
+    user_ids = [u['id'] for u in users]
+    timed('users', bulk_insert, User, users, args.batch_size)
+
+    strategies = [{'id': i, 'name': name, 'code': code, 'details': details}
+                  for i, (name, code, details) in enumerate(STRATEGIES, 1)]
+    timed('strategies', bulk_insert, Strategy, strategies)
+
+    funds, fund_users = make_fund_test_data(args.funds, user_ids, args.members, len(strategies))
+    fund_ids = [f['id'] for f in funds]
+    fund_user_ids = [fu['id'] for fu in fund_users]
+    timed('funds', bulk_insert, Fund, funds, args.batch_size)
+    timed('fund_users', bulk_insert, FundUser, fund_users, args.batch_size)
+
+    lines = make_line_test_data(args.lines, history_start, args.days)
+    timed('lines', bulk_insert, Line, lines, args.batch_size)
+
+    if fund_user_ids:
+        timed('line_votes', bulk_insert, LineVote,
+              generate_votes(args.votes, fund_user_ids, lines), args.batch_size)
 
-    # add the test data
-    for user in users:
+    if fund_ids:
+        investments, results = make_investment_test_data(args.investments, fund_ids, lines)
+        timed('investments', bulk_insert, Investment, investments, args.batch_size)
+        timed('results', bulk_insert, Result, results, args.batch_size)
 
-        # we'll want to hash the password
-        password = user.pop('password')
-        user = User(**user)
-        user.set_password(password)
-        db.session.add(user)
+    # the ledgers can run to millions of rows, so they are streamed
+    timed('user_ledgers', bulk_insert, UserLedger,
+          generate_ledger(args.ledger_rows, 'user_id', user_ids, history_start, args.days),
+          args.batch_size)
+    if fund_ids:
+        timed('fund_ledgers', bulk_insert, FundLedger,
+              generate_ledger(args.ledger_rows, 'fund_id', fund_ids, history_start, args.days),
+              args.batch_size)
+    if fund_user_ids:
+        timed('fund_user_ledgers', bulk_insert, FundUserLedger,
+              generate_ledger(args.ledger_rows, 'fund_user_id', fund_user_ids, history_start, args.days),
+              args.batch_size)
 
+    # bulk inserts skip the balance listeners, so rebuild them in one go
+    for spec in SPECS:
+        rebuild(spec)
     db.session.commit()
 
     if args.verbose:
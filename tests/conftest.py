@@ -0,0 +1,35 @@
+"""
+Shared fixtures: the app, on a scratch SQLite database that is created
+empty for every test (never `tests/database/test.db`).
+"""
+import os
+import tempfile
+
+import pytest
+
+# the config reads the database URL when the app is first created
+DATABASE_PATH = os.path.join(tempfile.mkdtemp(prefix='betfund-tests-'), 'test.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{DATABASE_PATH}'
+
+from application import create_app, db  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def app():
+    return create_app()
+
+
+@pytest.fixture
+def database(app):
+    """
+    An empty database, in an app context, removed after the test.
+    """
+    with app.app_context():
+        db.create_all()
+        yield db
+        db.session.remove()
+        db.engine.dispose()
+
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(DATABASE_PATH + suffix):
+            os.remove(DATABASE_PATH + suffix)
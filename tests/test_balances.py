@@ -0,0 +1,112 @@
+import threading
+from datetime import datetime
+
+import pytest
+from sqlalchemy import event, func, select
+
+from application import balances
+from application.models import Fund, FundBalance, FundLedger, Strategy
+from application.money import Money
+
+
+@pytest.fixture
+def funds(database):
+    session = database.session
+    session.execute(Strategy.__table__.insert(),
+                    {'id': 1, 'name': 'Strategy', 'code': 'strategy', 'details': {}})
+    session.execute(Fund.__table__.insert(), [
+        {'id': fund_id, 'name': f'Fund {fund_id}', 'description': '', 'strategy_id': 1}
+        for fund_id in (1, 2, 3)
+    ])
+    session.commit()
+    return database
+
+
+def stored(database):
+    return {row.fund_id: (row.balance, row.ledger_id)
+            for row in database.session.execute(select([FundBalance.__table__])).fetchall()}
+
+
+def test_apply_rows(funds):
+    connection = funds.session.connection()
+    balances.apply_rows(connection, balances.FUND, [
+        {'fund_id': 1, 'amount': Money(100), 'id': 3},
+        {'fund_id': 1, 'amount': -25, 'id': 7},
+        {'fund_id': 2, 'amount': 40}
+    ])
+    balances.apply_rows(connection, balances.FUND, [{'fund_id': 2, 'amount': Money(2), 'id': 9}])
+    assert stored(funds) == {1: (Money(75), 7), 2: (Money(42), 9)}
+
+
+def test_orm_writes_keep_balances_in_sync(funds):
+    session = funds.session
+    deposit = FundLedger(fund_id=1, amount=Money(500), timestamp=datetime(2024, 1, 1))
+    session.add_all([deposit, FundLedger(fund_id=2, amount=Money(10), timestamp=datetime(2024, 1, 1))])
+    session.flush()
+    assert stored(funds) == {1: (Money(500), deposit.id), 2: (Money(10), deposit.id + 1)}
+
+    deposit.amount = Money(300)
+    session.flush()
+    assert balances.get_balance(balances.FUND, 1) == Money(300)
+
+    deposit.fund_id = 2
+    session.flush()
+    assert balances.get_balance(balances.FUND, 1) == Money(0)
+    assert balances.get_balance(balances.FUND, 2) == Money(310)
+
+    session.delete(deposit)
+    session.flush()
+    assert balances.get_balance(balances.FUND, 2) == Money(10)
+
+
+def test_rebuild_matches_the_running_balances(funds):
+    session = funds.session
+    session.add_all([FundLedger(fund_id=fund_id, amount=Money(amount), timestamp=datetime(2024, 1, 1))
+                     for fund_id, amount in [(1, 100), (1, -30), (2, 5), (3, 0), (2, 12)]])
+    session.flush()
+    running = stored(funds)
+
+    balances.rebuild(balances.FUND)
+    assert stored(funds) == running
+
+
+def test_apply_when_another_writer_creates_the_balance_first(funds):
+    """
+    The update finds no balance, then another writer creates it before
+    the insert: the insert is ignored, and the amount is added by
+    updating again.
+    """
+    connection = funds.session.connection()
+
+    def race(conn, cursor, statement, parameters, context, executemany):
+        if 'OR IGNORE' in statement:
+            cursor.execute('INSERT INTO fund_balances (fund_id, balance) VALUES (1, 100)')
+
+    event.listen(connection, 'before_cursor_execute', race)
+    try:
+        balances._apply(connection, balances.FUND, 1, 40, ledger_id=5)
+    finally:
+        event.remove(connection, 'before_cursor_execute', race)
+    assert stored(funds) == {1: (Money(140), 5)}
+
+
+def test_concurrent_first_rows(funds):
+    engine = funds.engine
+    errors = []
+
+    def apply(amount):
+        try:
+            with engine.begin() as connection:
+                balances.apply_rows(connection, balances.FUND, [{'fund_id': 3, 'amount': amount}])
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=apply, args=(amount,)) for amount in range(1, 21)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert funds.session.execute(select([func.count()]).select_from(FundBalance.__table__)).scalar() == 1
+    assert balances.get_balance(balances.FUND, 3) == Money(sum(range(1, 21)))
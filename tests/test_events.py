@@ -0,0 +1,100 @@
+import json
+
+from application import events
+from application.events import BROADCAST, Broker, member_topic
+
+
+def parse(message):
+    fields = dict(line.split(': ', 1) for line in message.strip().split('\n'))
+    return fields['event'], json.loads(fields['data'])
+
+
+def test_bursts_are_coalesced_per_topic_and_kind():
+    broker = Broker(interval=60)
+    fund, other = broker.subscribe([1]), broker.subscribe([2])
+
+    broker.publish(1, 'votes', {'fund_id': 1, 'lines': {'a': 1}})
+    broker.publish(1, 'votes', {'fund_id': 1, 'lines': {'b': 2}})
+    broker.publish(1, 'votes', {'fund_id': 1, 'lines': {'a': 3}})
+    broker.publish(1, 'balance', {'fund_balance': '1.00'})
+    broker.publish(1, 'balance', {'fund_balance': '2.00'})
+    broker.flush()
+
+    assert [parse(message) for message in fund.get(0)] == [
+        ('votes', {'fund_id': 1, 'lines': {'a': 3, 'b': 2}}),
+        ('balance', {'fund_balance': '2.00'})
+    ]
+    assert other.get(0) == []
+
+
+def test_topics():
+    broker = Broker(interval=60)
+    member, fund = broker.subscribe([1, member_topic(7)]), broker.subscribe([1])
+
+    broker.publish(member_topic(7), 'balance', {'balance': '5.00'})
+    broker.publish(BROADCAST, 'lines', {'lines': {'x': {}}})
+    broker.publish(3, 'balance', {'fund_balance': '0.00'})
+    broker.flush()
+
+    assert [kind for kind, _ in map(parse, member.get(0))] == ['balance', 'lines']
+    assert [kind for kind, _ in map(parse, fund.get(0))] == ['lines']
+
+    # updates to topics nobody follows are dropped, not held
+    assert broker._pending == {}
+
+
+def test_slow_readers_get_a_reset():
+    broker = Broker(interval=60, maxsize=3)
+    subscription = broker.subscribe([1])
+    for i in range(5):
+        broker.publish(1, f'kind-{i}', {})
+        broker.flush()
+
+    # the outbox is full at kind-3, which is replaced (with what's queued)
+    # by a reset
+    messages = subscription.get(0)
+    assert [parse(message)[0] for message in messages] == ['reset', 'kind-4']
+
+
+def test_subscriptions():
+    broker = Broker(interval=60, max_subscribers=2)
+    assert not broker.wanted()
+    first, second = broker.subscribe([1]), broker.subscribe([2])
+    assert broker.wanted()
+    assert broker.subscribe([3]) is None
+
+    stream = broker.stream(first, heartbeat=0)
+    assert next(stream).startswith('retry:')
+    assert next(stream) == ': keep-alive\n\n'
+    stream.close()
+    broker.unsubscribe(second)
+
+    assert not broker.wanted() and broker._subscribers == {}
+    assert broker.subscribe([3]) is not None
+
+
+def test_flusher_delivers():
+    broker = Broker(interval=0.01)
+    subscription = broker.subscribe([1])
+    broker.publish(1, 'balance', {'fund_balance': '1.00'})
+    assert [parse(message) for message in subscription.get(5)] == [('balance', {'fund_balance': '1.00'})]
+
+
+def test_updates_wait_for_the_commit(app, database):
+    broker = events.get_broker()
+    subscription = broker.subscribe([1])
+    try:
+        with database.engine.connect() as connection:
+            transaction = connection.begin()
+            events.publish(1, 'balance', {'fund_balance': 'rolled back'}, connection)
+            transaction.rollback()
+
+            with connection.begin():
+                events.publish(1, 'balance', {'fund_balance': 'committed'}, connection)
+                broker.flush()
+                assert subscription.get(0) == []
+        broker.flush()
+        assert [parse(message) for message in subscription.get(0)] == [
+            ('balance', {'fund_balance': 'committed'})]
+    finally:
+        broker.unsubscribe(subscription)
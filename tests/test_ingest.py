@@ -0,0 +1,50 @@
+from sqlalchemy import select
+
+from application.ingest import ingest
+from application.lines import details_hash
+from application.models import Line
+
+
+def record(line_id, price, status='open'):
+    return {'id': line_id, 'sport': 'NBA', 'price': price, 'status': status,
+            'start_time': '2024-01-01T17:00:00Z'}
+
+
+def stored(database):
+    return {row.id: row for row in database.session.execute(select([Line.__table__])).fetchall()}
+
+
+def test_ingest_inserts_updates_and_skips(database):
+    feed = [record(f'line-{i}', 100 + i) for i in range(10)]
+    assert ingest(feed, batch_size=4) == {
+        'read': 10, 'inserted': 10, 'updated': 0, 'unchanged': 0, 'duplicates': 0}
+
+    feed[3] = record('line-3', 250)
+    feed[7] = record('line-7', 107, status='settled')
+    assert ingest(feed + [record('line-10', 110)], batch_size=4) == {
+        'read': 11, 'inserted': 1, 'updated': 2, 'unchanged': 8, 'duplicates': 0}
+
+    lines = stored(database)
+    assert len(lines) == 11
+    assert lines['line-3'].details['price'] == 250
+    assert lines['line-7'].status == 'settled'
+    assert all(line.details_hash == details_hash(line.details) for line in lines.values())
+    assert lines['line-0'].sport == 'NBA' and lines['line-0'].starts_at is not None
+
+
+def test_ingest_counts_duplicates_in_a_batch(database):
+    feed = [record('line-0', 100), record('line-0', 120), record('line-1', 100)]
+    assert ingest(feed) == {'read': 3, 'inserted': 2, 'updated': 0, 'unchanged': 0, 'duplicates': 1}
+    assert stored(database)['line-0'].details['price'] == 120
+
+    # the last record of a line wins, here going back to the stored one
+    feed = [record('line-0', 130), record('line-0', 120)]
+    assert ingest(feed) == {'read': 2, 'inserted': 0, 'updated': 0, 'unchanged': 1, 'duplicates': 1}
+    assert stored(database)['line-0'].details['price'] == 120
+
+
+def test_ingest_nested_details(database):
+    ingest([{'id': 7, 'details': {'sport': 'NFL', 'odds': 1.9}}])
+    line = stored(database)['7']
+    assert line.details == {'sport': 'NFL', 'odds': 1.9}
+    assert line.sport == 'NFL' and line.status is None
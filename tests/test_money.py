@@ -0,0 +1,70 @@
+from decimal import Decimal
+
+import numpy as np
+import pytest
+from sqlalchemy import select
+
+from application.models import Fund, FundLedger, Strategy
+from application.money import Money, cents, dollars_to_cents, money_sum
+
+
+@pytest.mark.parametrize('dollars', ['0.00', '0.01', '-0.01', '0.10', '12.34', '-12.34', '1000000.99'])
+def test_cents_round_trip(dollars):
+    amount = Money.from_decimal(dollars)
+    assert str(amount) == dollars
+    assert amount.to_decimal() == Decimal(dollars)
+    assert dollars_to_cents(str(amount)) == amount.cents
+    assert cents(amount) == amount.cents
+    assert Money(cents(amount)) == amount
+
+
+@pytest.mark.parametrize('dollars, expected', [
+    ('1.005', 101), ('1.004', 100), ('-1.005', -101), (Decimal('2.675'), 268), (2.675, 268), (3, 300)
+])
+def test_dollars_to_cents_rounds_half_up(dollars, expected):
+    assert dollars_to_cents(dollars) == expected
+
+
+def test_cents_of_integers():
+    assert cents(125) == 125
+    assert cents(np.int64(-7)) == -7
+    assert type(cents(np.int64(-7))) is int
+
+
+@pytest.mark.parametrize('value', [1.5, '1.50', Decimal('1.50'), True, None])
+def test_cents_refuses_dollars(value):
+    with pytest.raises(TypeError):
+        cents(value)
+
+
+@pytest.mark.parametrize('value', [Money(150), True])
+def test_dollars_to_cents_refuses_cents(value):
+    with pytest.raises(TypeError):
+        dollars_to_cents(value)
+
+
+def test_arithmetic():
+    assert Money(150) + Money(-25) == Money(125)
+    assert sum([Money(1), Money(2), Money(3)]) == Money(6)
+    assert Money(100) - Money(250) == Money(-150)
+    assert Money(101) * 0.5 == Money(51)
+    assert Money(-101) * 0.5 == Money(-51)
+    assert Money(0) == 0
+    assert Money(1) > 0
+
+
+def test_money_column_round_trip(database):
+    database.session.execute(Strategy.__table__.insert(),
+                             {'id': 1, 'name': 'Strategy', 'code': 'strategy', 'details': {}})
+    database.session.execute(Fund.__table__.insert(),
+                             {'id': 1, 'name': 'Fund', 'description': '', 'strategy_id': 1})
+    amounts = [Money(1), Money(-250), Money(123456789), Money(0)]
+    database.session.execute(FundLedger.__table__.insert(), [
+        {'fund_id': 1, 'amount': amount} for amount in amounts
+    ])
+
+    stored = [amount for amount, in database.session.execute(
+        select([FundLedger.amount]).order_by(FundLedger.id)).fetchall()]
+    assert stored == amounts
+    assert all(isinstance(amount, Money) for amount in stored)
+    assert database.session.execute(select([money_sum(FundLedger.amount)])).scalar() == sum(amounts)
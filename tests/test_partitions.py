@@ -0,0 +1,127 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import select
+
+from application import balances, db, partitions
+from application.models import Fund, FundLedger, Strategy
+from application.money import Money, money_sum
+
+LEDGER = partitions.LEDGERS['fund_ledgers']
+
+ROWS = [
+    (1, 100, datetime(2020, 1, 5)),
+    (2, 500, datetime(2020, 1, 10)),
+    (1, 250, datetime(2020, 1, 20)),
+    (1, -75, datetime(2020, 2, 10)),
+    (2, 30, datetime(2020, 2, 28, 23, 59)),
+    (1, 40, datetime(2020, 3, 15))
+]
+
+AS_OF = [datetime(2020, 1, 31), datetime(2020, 2, 1), datetime(2020, 2, 15),
+         datetime(2020, 3, 1), datetime(2020, 3, 20), datetime.utcnow()]
+
+
+def expected(fund_id, as_of):
+    return Money(sum(amount for owner, amount, timestamp in ROWS
+                     if owner == fund_id and timestamp <= as_of))
+
+
+def assert_balances(as_of=AS_OF):
+    for fund_id in (1, 2):
+        for when in as_of:
+            assert balances.get_balance_as_of(balances.FUND, fund_id, when) == expected(fund_id, when)
+
+
+@pytest.fixture
+def ledger(database):
+    session = database.session
+    session.execute(Strategy.__table__.insert(),
+                    {'id': 1, 'name': 'Strategy', 'code': 'strategy', 'details': {}})
+    session.execute(Fund.__table__.insert(), [
+        {'id': fund_id, 'name': f'Fund {fund_id}', 'description': '', 'strategy_id': 1}
+        for fund_id in (1, 2)
+    ])
+    session.execute(FundLedger.__table__.insert(), [
+        {'fund_id': fund_id, 'amount': Money(amount), 'timestamp': timestamp}
+        for fund_id, amount, timestamp in ROWS
+    ])
+    session.commit()
+    return LEDGER
+
+
+def history_total(since=None):
+    ledger = partitions.history(LEDGER, since)
+    return db.session.execute(select([money_sum(ledger.c.amount)])).scalar()
+
+
+def test_history_before_roll_up(ledger):
+    assert partitions.history(ledger).name == 'fund_ledgers_live'
+    assert history_total() == Money(845)
+    assert_balances()
+
+
+def test_roll_up(ledger):
+    assert partitions.roll_up(ledger, datetime(2020, 3, 1)) == 2
+    assert [period.table_name for period in partitions.get_periods(ledger)] == [
+        'fund_ledgers_p202001', 'fund_ledgers_p202002']
+    assert partitions.live_since(ledger) is not None
+
+    # the live table only holds March, and the opening balances
+    live = db.session.execute(
+        select([FundLedger.fund_id, FundLedger.amount, FundLedger.is_opening])
+        .order_by(FundLedger.is_opening, FundLedger.fund_id)
+    ).fetchall()
+    assert [tuple(row) for row in live] == [
+        (1, Money(40), False), (1, Money(275), True), (2, Money(530), True)]
+
+    # history reads through the cold tables, and skips them after the boundary
+    assert partitions.history(ledger).name == 'fund_ledgers_all'
+    assert history_total() == Money(845)
+    assert partitions.history(ledger, datetime(2020, 3, 1)).name == 'fund_ledgers_live'
+    assert history_total(datetime(2020, 3, 1)) == Money(40)
+    assert_balances()
+
+    # closed months are only rolled up once
+    assert partitions.roll_up(ledger, datetime(2020, 3, 1)) == 0
+    assert_balances()
+
+
+def test_archive(ledger, tmp_path):
+    partitions.roll_up(ledger, datetime(2020, 3, 1))
+    january, _ = partitions.get_periods(ledger)
+
+    path = partitions.archive(ledger, january, str(tmp_path))
+    archived = partitions.load_archive(path)
+    assert archived['fund_id'].tolist() == [1, 2, 1]
+    assert archived['amount'].tolist() == [100, 500, 250]
+    assert archived['timestamp'].tolist() == [timestamp for _, _, timestamp in ROWS[:3]]
+    assert_balances(AS_OF + [datetime(2020, 1, 5), datetime(2020, 1, 10)])
+
+
+def test_archive_and_drop(ledger, tmp_path):
+    partitions.roll_up(ledger, datetime(2020, 3, 1))
+    for period in partitions.get_periods(ledger):
+        partitions.archive(ledger, period, str(tmp_path), drop=True)
+
+    assert all(period.is_dropped for period in partitions.get_periods(ledger))
+    cold = ledger.cold_table('fund_ledgers_p202001')
+    assert db.session.execute(
+        select([cold.c.fund_id, cold.c.amount]).order_by(cold.c.fund_id)
+    ).fetchall() == [(1, Money(350)), (2, Money(500))]
+
+    # exact from each owner's last row in a dropped period on
+    assert history_total() == Money(845)
+    assert_balances()
+
+
+def test_snapshots_across_roll_up_and_archive(ledger, tmp_path):
+    balances.take_snapshots(balances.FUND, datetime(2020, 1, 31))
+    partitions.roll_up(ledger, datetime(2020, 3, 1))
+    balances.take_snapshots(balances.FUND, datetime(2020, 2, 15))
+    assert_balances()
+
+    for period in partitions.get_periods(ledger):
+        partitions.archive(ledger, period, str(tmp_path), drop=True)
+    assert balances.take_snapshots(balances.FUND, datetime(2020, 3, 20)) == 2
+    assert_balances()
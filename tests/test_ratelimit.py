@@ -0,0 +1,124 @@
+import threading
+
+import pytest
+
+from application import ratelimit
+from application.ratelimit import MemoryBackend
+
+
+class Clock:
+    """
+    A `time.monotonic` that only moves when told to.
+    """
+
+    def __init__(self, now=6000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, 'monotonic', clock)
+    return clock
+
+
+def hits(backend, n, key='key', limit=5, window=60):
+    return [backend.hit(key, limit, window) for _ in range(n)]
+
+
+def test_limit_per_window(clock):
+    backend = MemoryBackend()
+    results = hits(backend, 7)
+    assert results[:5] == [0] * 5
+    assert all(retry_after > 0 for retry_after in results[5:])
+
+    # other keys have their own counters
+    assert hits(backend, 1, key='other') == [0]
+
+
+def test_the_window_slides(clock):
+    backend = MemoryBackend()
+    hits(backend, 5)
+
+    # just into the next window the previous one still counts fully
+    clock.now += 60
+    assert hits(backend, 1)[0] > 0
+
+
+def test_sliding_estimate(clock):
+    backend = MemoryBackend()
+    hits(backend, 5)
+    clock.now += 90
+    # half of the previous window's 5 still counts, so 3 more attempts fit
+    results = hits(backend, 4)
+    assert results[:3] == [0, 0, 0] and results[3] > 0
+
+
+@pytest.mark.parametrize('first, later, wait', [(5, 0, 20), (3, 2, 45), (5, 0, 0), (4, 0, 59)])
+def test_retry_after_is_exact(clock, first, later, wait):
+    backend = MemoryBackend()
+    hits(backend, first)
+    clock.now += 60
+    hits(backend, later)
+    clock.now += wait
+    hits(backend, 10)
+    retry_after = hits(backend, 1)[0]
+    assert retry_after > 0
+
+    clock.now += retry_after - 1
+    assert hits(backend, 1)[0] > 0
+    clock.now += 1
+    assert hits(backend, 1) == [0]
+
+
+def test_refused_attempts_are_not_counted(clock):
+    backend = MemoryBackend()
+    hits(backend, 50)
+    # two windows later nothing is left, however many attempts were refused
+    clock.now += 120
+    assert hits(backend, 5) == [0] * 5
+
+
+def test_least_recently_used_keys_are_dropped(clock):
+    backend = MemoryBackend(maxsize=2)
+    hits(backend, 5, key='a')
+    hits(backend, 1, key='b')
+    hits(backend, 1, key='c')
+    assert hits(backend, 1, key='a') == [0]
+
+
+def test_concurrent_hits(clock):
+    backend = MemoryBackend()
+    results = []
+    threads = [threading.Thread(target=lambda: results.extend(hits(backend, 10, limit=50)))
+               for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results.count(0) == 50
+
+
+def test_rate_limited_routes(app, database, clock, monkeypatch):
+    monkeypatch.setitem(app.config, 'RATELIMITS', {'login': {'ip': (10, 60), 'email': (2, 60)}})
+    ratelimit.get_backend().clear()
+    client = app.test_client()
+    try:
+        def login(email_address):
+            return client.post('/login', data={'email_address': email_address, 'password': 'wrong'})
+
+        assert [login('Member@example.com').status_code for _ in range(2)] == [302, 302]
+        response = login(' member@EXAMPLE.com ')
+        assert response.status_code == 429 and int(response.headers['Retry-After']) > 0
+
+        # other addresses from the same client, until the client's limit
+        statuses = [login(f'user{i}@example.com').status_code for i in range(8)]
+        assert statuses == [302] * 7 + [429]
+
+        # only POSTs are limited
+        assert client.get('/login').status_code == 200
+    finally:
+        ratelimit.get_backend().clear()
@@ -0,0 +1,153 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+
+from application import balances
+from application.models import (Fund, FundBalance, FundLedger, FundUser, FundUserLedger,
+                                Investment, Line, Result, Strategy, User)
+from application.money import Money, money_sum
+from application.settlement import pro_rate, settle
+
+
+@pytest.mark.parametrize('amount, balances_', [
+    (100, [1, 1, 1]),
+    (-100, [1, 1, 1]),
+    (1, [5, 5, 5, 5]),
+    (99999, [3, 7, 11, 13, 17]),
+    (100, [0, 0, 0]),
+    (100, [-50, 0, 0]),
+    (7, [1])
+])
+def test_pro_rate_sums_to_the_fund(amount, balances_):
+    split = pro_rate({1: amount}, np.ones(len(balances_), dtype=np.int64), np.array(balances_))
+    assert split.dtype == np.int64
+    assert split.sum() == amount
+
+
+def test_pro_rate_residue_goes_to_the_largest_share():
+    split = pro_rate({1: 100}, np.array([1, 1, 1]), np.array([100, 300, 200]))
+    assert split.tolist() == [17, 50, 33]
+
+
+def test_pro_rate_splits_evenly_without_balances():
+    split = pro_rate({1: 100}, np.array([1, 1, 1]), np.array([0, 0, 0]))
+    assert sorted(split.tolist()) == [33, 33, 34]
+
+
+def test_pro_rate_ignores_negative_balances():
+    split = pro_rate({1: 90}, np.array([1, 1, 1]), np.array([-500, 100, 200]))
+    assert split.tolist() == [0, 30, 60]
+
+
+def test_pro_rate_many_funds():
+    rng = np.random.default_rng(0)
+    member_funds = rng.integers(1, 50, size=5000)
+    member_balances = rng.integers(-1000, 100000, size=5000)
+    member_balances[member_funds % 7 == 0] = 0
+    amounts = {fund_id: int(rng.integers(-10 ** 7, 10 ** 7)) for fund_id in range(1, 50)}
+
+    split = pro_rate(amounts, member_funds, member_balances)
+    for fund_id, amount in amounts.items():
+        assert split[member_funds == fund_id].sum() == amount
+
+
+def seed(session):
+    """
+    Two funds: one with three members (one without a balance) and one
+    without members, each with an investment on the same line.
+    """
+    session.execute(Strategy.__table__.insert(),
+                    {'id': 1, 'name': 'Strategy', 'code': 'strategy', 'details': {}})
+    session.execute(Fund.__table__.insert(), [
+        {'id': fund_id, 'name': f'Fund {fund_id}', 'description': '', 'strategy_id': 1}
+        for fund_id in (1, 2)
+    ])
+    session.execute(User.__table__.insert(), [
+        {'id': user_id, 'first_name': 'First', 'last_name': 'Last',
+         'email_address': f'user{user_id}@example.com', 'password': 'password'}
+        for user_id in (1, 2, 3)
+    ])
+    session.execute(FundUser.__table__.insert(), [
+        {'id': user_id, 'fund_id': 1, 'user_id': user_id} for user_id in (1, 2, 3)
+    ])
+    deposits = [{'fund_user_id': 1, 'amount': Money(10000)}, {'fund_user_id': 2, 'amount': Money(20000)}]
+    session.execute(FundUserLedger.__table__.insert(), deposits)
+    balances.apply_rows(session.connection(), balances.FUND_USER, deposits)
+
+    session.execute(Line.__table__.insert(), {'id': 'line-1', 'details': {'odds': 1.91}})
+    session.execute(Investment.__table__.insert(), [
+        {'id': 1, 'fund_id': 1, 'line_id': 'line-1', 'amount': Money(1001)},
+        {'id': 2, 'fund_id': 2, 'line_id': 'line-1', 'amount': Money(500)}
+    ])
+    session.commit()
+
+
+def ledger_totals(session):
+    return (session.execute(select([money_sum(FundLedger.amount)])).scalar(),
+            session.execute(select([money_sum(FundUserLedger.amount)])).scalar())
+
+
+def test_settle(database):
+    seed(database.session)
+
+    summary = settle({'line-1': 'win'}, datetime(2024, 1, 1))
+    assert summary == {'investments': 2, 'funds': 2, 'members': 2, 'pnl': Money(911 + 455)}
+
+    # members share fund 1's P&L by balance, and add up to it exactly
+    member_pnl = dict(database.session.execute(
+        select([FundUserLedger.fund_user_id, money_sum(FundUserLedger.amount)])
+        .where(FundUserLedger.timestamp == datetime(2024, 1, 1))
+        .group_by(FundUserLedger.fund_user_id)
+    ).fetchall())
+    assert member_pnl == {1: Money(304), 2: Money(607)}
+    assert balances.get_balance(balances.FUND, 1) == Money(911)
+    assert balances.get_balance(balances.FUND, 2) == Money(455)
+
+
+def test_settle_is_idempotent(database):
+    seed(database.session)
+
+    settle({'line-1': 'loss'})
+    results = database.session.execute(select([func.count()]).select_from(Result.__table__)).scalar()
+    totals = ledger_totals(database.session)
+    fund_balances = database.session.execute(select([FundBalance.__table__])).fetchall()
+    assert results == 2
+    assert totals == (Money(-1501), Money(30000 - 1001))
+
+    # settling again, even with another outcome, posts nothing
+    assert settle({'line-1': 'win'})['investments'] == 0
+    assert database.session.execute(select([func.count()]).select_from(Result.__table__)).scalar() == results
+    assert ledger_totals(database.session) == totals
+    assert database.session.execute(select([FundBalance.__table__])).fetchall() == fund_balances
+
+
+def test_one_result_per_investment(database):
+    seed(database.session)
+    settle({'line-1': 'push'})
+
+    with pytest.raises(IntegrityError):
+        database.session.execute(Result.__table__.insert(),
+                                 {'investment_id': 1, 'amount': Money(0), 'is_win': False})
+    database.session.rollback()
+
+
+def test_settle_rejects_unknown_outcomes(database):
+    with pytest.raises(ValueError):
+        settle({'line-1': 'void'})
+
+
+@pytest.mark.parametrize('details', [{}, {'price': 0}, {'odds': 'evens'}, {'odds': 0.5}])
+def test_settle_needs_odds_to_pay_a_win(database, details):
+    seed(database.session)
+    database.session.execute(Line.__table__.update().values(details=details))
+    database.session.commit()
+
+    with pytest.raises(ValueError, match='line-1'):
+        settle({'line-1': 'win'})
+    assert database.session.execute(select([func.count()]).select_from(Result.__table__)).scalar() == 0
+
+    # a loss or a push never needs them
+    assert settle({'line-1': 'loss'})['pnl'] == Money(-1501)
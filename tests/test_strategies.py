@@ -0,0 +1,123 @@
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytest
+
+from application import strategies
+from application.models import Fund, Investment, Line, Strategy
+from application.strategies import LineBatch, StrategyError, compile_strategy, propose
+
+Row = namedtuple('Row', 'id details sport market_type status starts_at')
+
+
+def batch(*details):
+    """
+    A batch of lines, one per details payload, starting an hour apart.
+    """
+    return LineBatch([
+        Row(f'line-{i}', d, d.get('sport'), d.get('market_type'), d.get('status'),
+            datetime(2024, 1, 1) + timedelta(hours=i))
+        for i, d in enumerate(details)
+    ])
+
+
+def mask(filters, lines):
+    return compile_strategy(1, {'filters': filters}).mask(lines).tolist()
+
+
+@pytest.mark.parametrize('details', [
+    {'filters': [{'op': 'eq', 'value': 1}]},
+    {'filters': [{'key': 'price', 'op': 'like', 'value': 1}]},
+    {'filters': [{'key': 'home', 'op': 'lt', 'value': 'M'}]},
+    {'filters': [{'key': 'home', 'op': 'gte', 'value': None}]},
+    {'sizing': {'method': 'kelly'}},
+    {'sizing': {'method': 'fixed'}},
+    {'sizing': {'method': 'fraction', 'fraction': 'half'}},
+    {'max_lines': 'all'}
+])
+def test_compile_rejects_invalid_definitions(details):
+    with pytest.raises(StrategyError):
+        compile_strategy(1, details)
+
+
+def test_compile_sizing_in_dollars():
+    plan = compile_strategy(1, {'sizing': {'method': 'fraction', 'fraction': 0.1, 'max': '25.50'}})
+    assert plan.size(np.array([100000, 20000, -500])).tolist() == [2550, 2000, 0]
+
+    plan = compile_strategy(1, {})
+    assert plan.size(np.array([0, 100000])).tolist() == [1000, 1000]
+
+
+def test_mask_numbers():
+    lines = batch({'price': 150}, {'price': -110}, {}, {'price': 'n/a'}, {'price': '120'})
+    assert mask([{'key': 'price', 'op': 'gt', 'value': 0}], lines) == [True, False, False, False, True]
+    assert mask([{'key': 'price', 'op': 'lte', 'value': 0}], lines) == [False, True, False, False, False]
+    in_ = [{'key': 'price', 'op': 'in', 'value': [150, 120]}]
+    assert mask(in_, lines) == [True, False, False, False, True]
+
+
+def test_mask_objects():
+    lines = batch({'sport': 'NBA', 'home': 'BOS'}, {'sport': 'NFL'}, {'home': 'LAL'})
+    assert mask([{'key': 'sport', 'value': 'NBA'}], lines) == [True, False, False]
+    assert mask([{'key': 'sport', 'op': 'ne', 'value': 'NBA'}], lines) == [False, True, True]
+    assert mask([{'key': 'home', 'op': 'in', 'value': ['BOS', 'LAL']}], lines) == [True, False, True]
+    assert mask([{'key': 'sport', 'value': 'NBA'}, {'key': 'home', 'value': 'LAL'}], lines) == [False] * 3
+
+
+def test_mask_dates():
+    lines = batch({}, {}, {})
+    start = '2024-01-01T01:00:00Z'
+    assert mask([{'key': 'start_time', 'op': 'gte', 'value': start}], lines) == [False, True, True]
+    assert mask([{'key': 'start_time', 'op': 'lt', 'value': start}], lines) == [True, False, False]
+
+
+def test_select_takes_the_earliest_lines():
+    lines = LineBatch([
+        Row(f'line-{i}', {}, None, None, None, datetime(2024, 1, 1) + timedelta(hours=hours))
+        for i, hours in enumerate([5, 1, 3, 2, 4])
+    ])
+    assert compile_strategy(1, {}).select(lines).tolist() == [0, 1, 2, 3, 4]
+    assert compile_strategy(1, {'max_lines': 2}).select(lines).tolist() == [1, 3]
+
+
+def seed(session, strategies_):
+    session.execute(Strategy.__table__.insert(), [
+        {'id': i, 'name': f'Strategy {i}', 'code': f'strategy-{i}', 'details': details}
+        for i, details in enumerate(strategies_, 1)
+    ])
+    session.execute(Fund.__table__.insert(), [
+        {'id': i, 'name': f'Fund {i}', 'description': '', 'strategy_id': i}
+        for i in range(1, len(strategies_) + 1)
+    ])
+    session.execute(Line.__table__.insert(), [
+        {'id': f'line-{i}', 'details': {'price': price}, 'status': 'open',
+         'starts_at': datetime.utcnow() + timedelta(days=1, hours=i)}
+        for i, price in enumerate([150, -110, 200])
+    ])
+
+
+def test_propose(database):
+    seed(database.session, [
+        {'filters': [{'key': 'price', 'op': 'gt', 'value': 0}],
+         'sizing': {'method': 'fixed', 'amount': '5.00'}},
+        {'filters': [{'key': 'home', 'op': 'lt', 'value': 'M'}]}
+    ])
+    database.session.execute(Investment.__table__.insert(),
+                             {'fund_id': 1, 'line_id': 'line-0', 'amount': 500})
+
+    # the invalid strategy is skipped, and existing investments left out
+    assert propose() == [{'fund_id': 1, 'line_id': 'line-2', 'amount': 500}]
+
+
+def test_existing_chunks_both_in_lists(database, monkeypatch):
+    monkeypatch.setattr(strategies, 'MAX_IN_PARAMS', 4)
+    seed(database.session, [{}] * 5)
+    invested = {(fund_id, f'line-{i}') for fund_id in range(1, 6) for i in range(3) if (fund_id + i) % 2}
+    database.session.execute(Investment.__table__.insert(), [
+        {'fund_id': fund_id, 'line_id': line_id, 'amount': 100} for fund_id, line_id in invested
+    ])
+
+    existing = strategies._existing(database.session.connection(), range(1, 6),
+                                    ['line-0', 'line-1', 'line-2'])
+    assert existing == invested
@@ -0,0 +1,78 @@
+from datetime import date, datetime, timedelta
+
+from application import tally
+from application.models import Fund, FundUser, Line, LineVote, Strategy, User
+
+DAY = date(2024, 1, 1)
+
+
+def seed(session):
+    """
+    Three funds of four members each, voting on six lines, with votes on
+    the day before that must not count.
+    """
+    session.execute(Strategy.__table__.insert(),
+                    {'id': 1, 'name': 'Strategy', 'code': 'strategy', 'details': {}})
+    session.execute(Fund.__table__.insert(), [
+        {'id': fund_id, 'name': f'Fund {fund_id}', 'description': '', 'strategy_id': 1}
+        for fund_id in (1, 2, 3)
+    ])
+    session.execute(User.__table__.insert(), [
+        {'id': user_id, 'first_name': 'First', 'last_name': 'Last',
+         'email_address': f'user{user_id}@example.com', 'password': 'password'}
+        for user_id in range(1, 13)
+    ])
+    session.execute(FundUser.__table__.insert(), [
+        {'id': user_id, 'fund_id': (user_id - 1) // 4 + 1, 'user_id': user_id} for user_id in range(1, 13)
+    ])
+    session.execute(Line.__table__.insert(), [{'id': f'line-{i}', 'details': {}} for i in range(6)])
+
+    votes = []
+    for fund_user_id in range(1, 13):
+        for i in range(6):
+            if (fund_user_id + i) % 3:
+                votes.append({'fund_user_id': fund_user_id, 'line_id': f'line-{i}',
+                              'units': None if i == 5 else i + 1,
+                              'timestamp': datetime(2024, 1, 1, 12)})
+        votes.append({'fund_user_id': fund_user_id, 'line_id': 'line-0', 'units': 50,
+                      'timestamp': datetime(2024, 1, 1) - timedelta(minutes=1)})
+    session.execute(LineVote.__table__.insert(), votes)
+    return votes
+
+
+def expected(votes, fund_user_ids, line_ids):
+    funds = {(fund_user_id - 1) // 4 + 1 for fund_user_id in fund_user_ids}
+    totals = {}
+    for vote in votes:
+        fund_id = (vote['fund_user_id'] - 1) // 4 + 1
+        if fund_id in funds and vote['line_id'] in line_ids and vote['timestamp'].date() == DAY:
+            line = totals.setdefault(fund_id, {}).setdefault(vote['line_id'], {'units': 0.0, 'votes': 0})
+            line['units'] += vote['units'] or tally.DEFAULT_UNITS
+            line['votes'] += 1
+    return totals
+
+
+def test_line_totals(database, monkeypatch):
+    votes = seed(database.session)
+    monkeypatch.setattr(tally, 'MAX_IN_PARAMS', 4)
+    connection = database.session.connection()
+
+    for fund_user_ids, line_ids in [
+        (list(range(1, 13)), [f'line-{i}' for i in range(6)]),
+        # only the funds of the members given, and the lines given
+        ([1, 9], ['line-1', 'line-5'])
+    ]:
+        totals = tally.line_totals(connection, DAY, fund_user_ids, line_ids)
+        assert totals == expected(votes, fund_user_ids, line_ids)
+
+
+def test_tally_agrees_with_line_totals(database):
+    votes = seed(database.session)
+    database.session.commit()
+
+    totals = expected(votes, range(1, 13), [f'line-{i}' for i in range(6)])
+    ranked = tally.tally_day(DAY)
+    assert {fund_id: {line['line_id']: {'units': line['units'], 'votes': line['votes']} for line in lines}
+            for fund_id, lines in ranked.items()} == totals
+    for lines in ranked.values():
+        assert [line['units'] for line in lines] == sorted((line['units'] for line in lines), reverse=True)
@@ -0,0 +1,125 @@
+import threading
+import time
+from datetime import datetime
+
+import pytest
+from sqlalchemy import select
+
+from application import votes
+from application.models import Fund, FundUser, Line, LineVote, Strategy, User
+from application.votes import CoalescingWriter, Submission, VotesBusy, write_votes
+
+MORNING = datetime(2024, 1, 1, 9)
+EVENING = datetime(2024, 1, 1, 21)
+NEXT_DAY = datetime(2024, 1, 2, 9)
+
+
+@pytest.fixture
+def members(database):
+    session = database.session
+    session.execute(Strategy.__table__.insert(),
+                    {'id': 1, 'name': 'Strategy', 'code': 'strategy', 'details': {}})
+    session.execute(Fund.__table__.insert(), {'id': 1, 'name': 'Fund', 'description': '', 'strategy_id': 1})
+    session.execute(User.__table__.insert(), [
+        {'id': user_id, 'first_name': 'First', 'last_name': 'Last',
+         'email_address': f'user{user_id}@example.com', 'password': 'password'}
+        for user_id in range(1, 9)
+    ])
+    session.execute(FundUser.__table__.insert(), [
+        {'id': user_id, 'fund_id': 1, 'user_id': user_id} for user_id in range(1, 9)
+    ])
+    session.execute(Line.__table__.insert(), [
+        {'id': f'line-{i}', 'details': {}, 'status': 'open'} for i in range(3)
+    ])
+    session.commit()
+    return list(range(1, 9))
+
+
+def vote(fund_user_id, line_id, units, timestamp=MORNING):
+    return {'fund_user_id': fund_user_id, 'line_id': line_id, 'units': units, 'timestamp': timestamp}
+
+
+def stored(database):
+    database.session.remove()
+    return sorted(
+        (row.fund_user_id, row.line_id, row.vote_day.isoformat(), row.units)
+        for row in database.session.execute(select([LineVote.__table__])).fetchall()
+    )
+
+
+def write(database, rows):
+    with database.engine.begin() as connection:
+        return write_votes(connection, rows)
+
+
+def test_write_votes_upserts(database, members):
+    assert write(database, [vote(1, 'line-0', 1), vote(1, 'line-1', 2)]) == 2
+    assert write(database, [vote(1, 'line-0', 3, EVENING), vote(1, 'line-0', 4, NEXT_DAY)]) == 2
+
+    # a vote again the same day replaces the earlier one
+    assert stored(database) == [
+        (1, 'line-0', '2024-01-01', 3), (1, 'line-0', '2024-01-02', 4), (1, 'line-1', '2024-01-01', 2)
+    ]
+
+
+def test_write_votes_keeps_the_last_vote_of_a_batch(database, members):
+    assert write(database, [vote(2, 'line-0', 1), vote(2, 'line-0', 5, EVENING)]) == 1
+    assert stored(database) == [(2, 'line-0', '2024-01-01', 5)]
+
+
+def test_writer_coalesces_concurrent_slates(app, database, members, monkeypatch):
+    writes = []
+    upsert = votes._upsert
+    monkeypatch.setattr(votes, '_upsert', lambda connection, rows: (writes.append(len(rows)),
+                                                                    upsert(connection, rows)))
+    writer = CoalescingWriter(app, interval=0.2)
+
+    results = []
+    threads = [threading.Thread(target=lambda m=member: results.append(writer.submit([vote(m, 'line-0', m)])))
+               for member in members]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == [True] * len(members)
+    assert sum(writes) == len(members) and len(writes) < len(members)
+    assert stored(database) == [(m, 'line-0', '2024-01-01', m) for m in members]
+
+
+def test_flush_falls_back_to_one_slate_at_a_time(app, database, members):
+    writer = CoalescingWriter(app)
+    batch = [Submission([vote(1, 'line-0', 1)]),
+             Submission([{'fund_user_id': 2, 'line_id': 'line-0', 'units': 1}]),
+             Submission([vote(3, 'line-1', 2)])]
+    writer.flush(batch)
+
+    assert all(submission.done.is_set() for submission in batch)
+    assert [submission.error is None for submission in batch] == [True, False, True]
+    assert stored(database) == [(1, 'line-0', '2024-01-01', 1), (3, 'line-1', '2024-01-01', 2)]
+
+
+def test_submit_withdraws_votes_the_writer_has_not_taken(app, database, members, monkeypatch):
+    writer = CoalescingWriter(app, timeout=0.05)
+    monkeypatch.setattr(writer._writer, 'start', lambda: False)
+
+    with pytest.raises(VotesBusy):
+        writer.submit([vote(1, 'line-0', 1)])
+    assert writer._pending == [] and writer._rows == 0
+
+
+def test_submit_accepts_votes_the_writer_is_writing(app, database, members, monkeypatch):
+    writer = CoalescingWriter(app, interval=0.01, timeout=0.05)
+    flush = writer.flush
+    monkeypatch.setattr(writer, 'flush', lambda batch: (time.sleep(0.2), flush(batch)))
+
+    assert writer.submit([vote(1, 'line-0', 1)]) is False
+    time.sleep(0.5)
+    assert stored(database) == [(1, 'line-0', '2024-01-01', 1)]
+
+
+def test_submit_refuses_votes_past_the_queue_limit(app, database, members, monkeypatch):
+    writer = CoalescingWriter(app, max_pending=2)
+    monkeypatch.setattr(writer._writer, 'start', lambda: False)
+    with pytest.raises(VotesBusy):
+        writer.submit([vote(1, f'line-{i}', 1) for i in range(3)])